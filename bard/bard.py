@@ -2,9 +2,10 @@
 # -*- coding: utf-8 -*-
 from bard.utils import fixTags, calculateFileSHA256, \
     calculateAudioTrackSHA256_audioread, printProperties, printSongsInfo, \
-    getPropertiesAsString, fingerprint_AudioSegment
+    getPropertiesAsString, fingerprint_AudioSegment, parallelMap, \
+    compressFile, dropFromPageCache, decodeFingerprint
 from bard.song import Song, DifferentLengthException, CantCompareSongsException
-from bard.musicdatabase import MusicDatabase
+from bard.musicdatabase import MusicDatabase, prefixUpperBound
 from bard.terminalcolors import TerminalColors
 from bard.comparesongs import compareSongSets
 import chromaprint
@@ -12,6 +13,7 @@ from collections import MutableSet, namedtuple
 import dbus
 import sys
 import os
+import stat
 import datetime
 import re
 import numpy
@@ -20,15 +22,16 @@ import random
 import mutagen
 import argparse
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
 from bard.config import config
 
 ComparisonResult = namedtuple('ComparisonResult', ['offset', 'similarity'])
 
 
-class Query (namedtuple('Query', ['root', 'genre'])):
+class Query (namedtuple('Query', ['root', 'genre', 'search'])):
     def __bool__(self):
-        if self.root or self.genre:
+        if self.root or self.genre or self.search:
             return True
         return False
 
@@ -146,6 +149,14 @@ def normalizeTrack(track):
 
 
 class Bard:
+    readOnlyCommands = ['find-duplicates', 'compare-songs', 'compare-files',
+                        'compare-dirs', 'info', 'list', 'ls', 'search',
+                        'list-genres', 'list-similars', 'play', 'stats',
+                        'backup']
+    # Commands that modify songs of any root in place
+    songWritingCommands = ['fix-mtime', 'fix-checksums', 'add-silences',
+                           'check-songs-existence', 'check-checksums',
+                           'fix-genres']
 
     def __init__(self, ro=False):
         """Construct a Bard object."""
@@ -170,13 +181,12 @@ class Bard:
 
     @staticmethod
     def getMusic(where_clause='', where_values=None, tables=[],
-                 order_by=None, limit=None):
+                 order_by=None, limit=None, loadMetadata=False):
         # print(where_clause)
-        c = MusicDatabase.conn.cursor()
-
         if 'songs' not in tables:
             tables.insert(0, 'songs')
-        statement = ('SELECT id, root, path, mtime, title, artist, album, '
+        statement = ('SELECT id, root, path, mtime, size, inode, device, '
+                     'mode, title, artist, album, '
                      'albumArtist, track, date, genre, discNumber, '
                      'coverWidth, coverHeight, coverMD5 FROM %s %s' %
                      (','.join(tables), where_clause))
@@ -186,53 +196,89 @@ class Bard:
             statement += ' LIMIT %d' % limit
 
         # print(statement, where_values)
-        if where_values:
-            result = c.execute(statement, where_values)
-        else:
-            result = c.execute(statement)
+        result = MusicDatabase.fetchAll(statement, where_values or (),
+                                        asDicts=True)
         r = []
-        for x in result.fetchall():
+        for x in result:
             r.append(Song(x))
+        if loadMetadata:
+            Song.loadSongsMetadata(r)
         return r
 
     @staticmethod
-    def getSongs(path=None, songID=None, query=None):
-        where = ''
-        values = None
+    def iterMusic(conditions=[], values=[], tables=[], afterSongID=None,
+                  pageSize=1000, loadMetadata=False):
+        """Iterate over the songs matching conditions ordered by song id.
+
+        Songs are read in pages of pageSize songs, using the id of the last
+        song of each page as the resume token for the next one, so memory
+        usage doesn't depend on the number of songs in the database.
+        If afterSongID is given, only songs with a greater id are returned.
+        """
+        while True:
+            where = list(conditions)
+            where_values = list(values)
+            if afterSongID is not None:
+                where.insert(0, 'id > ?')
+                where_values.insert(0, afterSongID)
+            where_clause = ('WHERE ' + ' AND '.join(where)) if where else ''
+            page = Bard.getMusic(where_clause=where_clause,
+                                 where_values=where_values,
+                                 tables=list(tables), order_by='id',
+                                 limit=pageSize, loadMetadata=loadMetadata)
+            yield from page
+            if len(page) < pageSize:
+                return
+            afterSongID = page[-1].id
+
+    @staticmethod
+    def songsCondition(path=None, songID=None, query=None):
+        """Return the where clause and values to select songs."""
         if songID:
             where = ['id = ?']
             values = [songID]
-        elif (not path.startswith('/') or path.endswith('/') or
-              os.path.isdir(path)):
-            where = ["path like ?"]
-            values = ['%' + path + '%']
         else:
-            where = ["path = ?"]
-            values = [path]
-        tables = []
+            condition, values = MusicDatabase.pathCondition(path)
+            where = [condition] if condition else []
         if query:
             if query.root:
                 where.append('root = ?')
                 values.append(query.root)
             if query.genre:
-                tables = ['tags']
-                where.append('''id = song_id
-                            AND (name like 'genre' OR name='TCON')
-                            AND value like ?''')
-                values.append(query.genre)
+                condition, genre_values = \
+                    MusicDatabase.genreCondition(query.genre)
+                where.append(condition)
+                values.extend(genre_values)
+            if query.search:
+                condition, search_values = \
+                    MusicDatabase.searchCondition(query.search)
+                if condition:
+                    where.append(condition)
+                    values.extend(search_values)
+
+        where = ('WHERE ' + ' AND '.join(where)) if where else ''
+        return where, values
 
-        where = 'WHERE ' + ' AND '.join(where)
+    @staticmethod
+    def getSongs(path=None, songID=None, query=None, loadMetadata=False):
+        where, values = Bard.songsCondition(path, songID, query)
         return Bard.getMusic(where_clause=where, where_values=values,
-                             tables=tables)
+                             loadMetadata=loadMetadata)
 
-    def getSongsAtPath(self, path, exact=False):
+    def getSongsAtPath(self, path, exact=False, loadMetadata=False):
         if exact:
             where = "WHERE path = ?"
             values = (path,)
         else:
-            where = "WHERE path like ?"
-            values = (path + '%',)
-        return self.getMusic(where_clause=where, where_values=values)
+            upperBound = prefixUpperBound(path)
+            if upperBound is None:
+                where = "WHERE path >= ?"
+                values = (path,)
+            else:
+                where = "WHERE path >= ? AND path < ?"
+                values = (path, upperBound)
+        return self.getMusic(where_clause=where, where_values=values,
+                             loadMetadata=loadMetadata)
 
     def getCurrentlyPlayingSongs(self):
         bus = dbus.SessionBus()
@@ -312,16 +358,67 @@ class Bard:
             elif os.path.isdir(arg):
                 self.addDirectoryRecursively(os.path.normpath(arg), verbose)
 
+    def openDatabase(self, root=None):
+        MusicDatabase.connections.close()
+        self.db = MusicDatabase(root=root)
+
+    def rootOfPath(self, path):
+        """Return the musicPaths entry that contains path."""
+        path = os.path.abspath(os.path.expanduser(path))
+        for root in config['musicPaths']:
+            rootPath = os.path.abspath(os.path.expanduser(root))
+            if path == rootPath or path.startswith(rootPath + '/'):
+                return root
+        return None
+
+    def importPaths(self, paths, verbose=False):
+        if not config['shardedDatabase']:
+            self.add(paths, verbose=verbose)
+            return
+
+        pathsByRoot = {}
+        for path in paths:
+            root = self.rootOfPath(path)
+            if root is None:
+                print('%s is not in any of the musicPaths directories. '
+                      'Skipping.' % path)
+                continue
+            pathsByRoot.setdefault(root, []).append(path)
+
+        for root, rootPaths in pathsByRoot.items():
+            self.openDatabase(root=root)
+            self.add(rootPaths, verbose=verbose)
+        self.openDatabase()
+
+    def update(self, roots, verbose=False):
+        if not config['shardedDatabase']:
+            self.add(roots, verbose=verbose)
+            self.checkSongsExistence(roots, verbose=verbose)
+            return
+
+        # Each root is updated in its own database, so updates of
+        # different roots can run in parallel processes
+        for root in roots:
+            self.openDatabase(root=root)
+            self.add([root], verbose=verbose)
+            self.checkSongsExistence([root], verbose=verbose)
+        self.openDatabase()
+        MusicDatabase.removeOrphanedSongData()
+        MusicDatabase.commit()
+
     def info(self, ids_or_paths, currentlyPlaying=False):
         songs = []
         for id_or_path in ids_or_paths:
-            songs.extend(self.getSongsFromIDorPath(id_or_path))
+            songs.extend(self.getSongsFromIDorPath(id_or_path,
+                                                   loadMetadata=True))
 
         if currentlyPlaying:
             playingSongs = self.getCurrentlyPlayingSongs()
             songs.extend(playingSongs)
 
-        userID = MusicDatabase.getUserID(config['username'])
+        # Don't create the user, info can run on a read-only snapshot. Songs
+        # have the default rating for users that don't exist yet
+        userID = MusicDatabase.getUserID(config['username'], create=False)
 
         for song in songs:
             song.loadMetadataInfo()
@@ -384,30 +481,58 @@ class Bard:
         except ValueError:
             songID = None
         if songID:
-            songs = Bard.getSongs(songID=songID, query=query)
+            where, values = Bard.songsCondition(songID=songID, query=query)
         else:
-            songs = Bard.getSongs(path=path, query=query)
+            where, values = Bard.songsCondition(path=path, query=query)
         if group_by_directory:
-            dirs = {os.path.dirname(song.path()) for song in songs}
-            for directory in sorted(dirs):
+            # Sizes are in KiB like the ones du shows
+            for directory, size, count in \
+                    MusicDatabase.getDirectoriesSizes(where, values):
                 if long_ls:
-                    try:
-                        size = int(subprocess.check_output(['du', '-s',
-                                                            directory]
-                                                           ).split()[0])
-                    except subprocess.CalledProcessError:
-                        size = -1
-                    print('%d - ' % size, end='', flush=True)
-                print("%s" % directory)
+                    print('%d - ' % (((size or 0) + 1023) // 1024), end='')
+                print("%s" % Song.translatePath(directory))
+            return
+
+        songs = Bard.getMusic(where_clause=where, where_values=values)
+        if long_ls:
+            lines = Bard.longListing(songs)
         else:
-            for song in songs:
-                if show_id:
-                    print('%d) ' % song.id, end='', flush=True)
-                if long_ls:
-                    command = ['ls', '-l', song.path()]
-                    subprocess.run(command)
-                else:
-                    print("%s" % song.path())
+            lines = [song.path() for song in songs]
+        for song, line in zip(songs, lines):
+            if show_id:
+                print('%d) %s' % (song.id, line))
+            else:
+                print(line)
+
+    @staticmethod
+    def longListing(songs):
+        """Return ls -l like lines for songs using the data in the db.
+
+        Only songs added before file sizes were stored in the database
+        are looked up in the filesystem.
+        """
+        for song in songs:
+            if song.size() is None:
+                try:
+                    song.setFileStat(os.stat(song.path()))
+                except FileNotFoundError:
+                    pass
+        width = max((len(str(song.size())) for song in songs
+                     if song.size() is not None), default=1)
+        recent = time.time() - 182 * 24 * 3600
+        lines = []
+        for song in songs:
+            if song.size() is None:
+                lines.append('%s: File not found' % song.path())
+                continue
+            mtime = time.localtime(song.mtime())
+            if song.mtime() > recent:
+                date = time.strftime('%b %e %H:%M', mtime)
+            else:
+                date = time.strftime('%b %e  %Y', mtime)
+            lines.append('%s %*d %s %s' % (stat.filemode(song.mode()), width,
+                                           song.size(), date, song.path()))
+        return lines
 
     def listSimilars(self, condition=None, long_ls=False):
         if isinstance(condition, list):
@@ -418,12 +543,12 @@ class Bard:
             song2 = Bard.getSongs(songID=songID2)[0]
             print('------  (%d %d) offset: %d   similarity %f' %
                   (songID1, songID2, offset, similarity))
-            for song in (song1, song2):
-                if long_ls:
-                    command = ['ls', '-l', song.path()]
-                    subprocess.run(command)
-                else:
-                    print("%s" % song.path())
+            if long_ls:
+                lines = Bard.longListing([song1, song2])
+            else:
+                lines = [song1.path(), song2.path()]
+            for line in lines:
+                print(line)
 
     def play(self, ids_or_paths, shuffle, query=None):
         paths = []
@@ -438,9 +563,12 @@ class Bard:
             random.shuffle(paths)
         elif shuffle:
             total_songs = 30
-            songs = self.getMusic('')
+            songs = self.iterMusic()
             probabilities = []
-            userID = MusicDatabase.getUserID(config['username'])
+            # Users that don't exist yet have the default rating for all
+            # songs
+            userID = MusicDatabase.getUserID(config['username'],
+                                             create=False)
             for song in songs:
                 paths.append(song.path())
                 probabilities.append(song.userRating(userID) * 1000)
@@ -462,7 +590,12 @@ class Bard:
         process = subprocess.run(command)
 
     def findDuplicates(self):
-        collection = self.getMusic()
+        duplicatedHashes = ('id IN (SELECT song_id FROM properties '
+                            '       WHERE audio_sha256sum IN '
+                            '       (SELECT audio_sha256sum FROM properties '
+                            '         GROUP BY audio_sha256sum '
+                            '        HAVING COUNT(*) > 1))')
+        collection = self.iterMusic([duplicatedHashes], loadMetadata=True)
         hashes = {}
         for song in collection:
             if song.audioSha256sum() not in hashes:
@@ -479,7 +612,7 @@ class Bard:
                     print(song._path)
 
     def fixMtime(self):
-        collection = self.getMusic()
+        collection = self.iterMusic()
         count = 0
         for song in collection:
             if not song.mtime():
@@ -557,8 +690,11 @@ class Bard:
     def checkSongsExistenceInPath(self, path, verbose=False):
         collection = self.getSongsAtPath(path)
         count = 0
+        changedFileStat = []
         for song in collection:
-            if not os.path.exists(song.path()):
+            try:
+                st = os.stat(song.path())
+            except FileNotFoundError:
                 if os.path.lexists(song.path()):
                     print('Broken symlink at %s' % song.path())
                 else:
@@ -567,8 +703,12 @@ class Bard:
                     self.db.removeSong(song)
                 continue
 
-            if song.mtime() == os.path.getmtime(song.path()):
-                if verbose:
+            if song.mtime() == st.st_mtime:
+                if (song.size(), song.inode(), song.device(), song.mode()) != \
+                   (st.st_size, st.st_ino, st.st_dev, st.st_mode):
+                    song.setFileStat(st)
+                    changedFileStat.append(song)
+                elif verbose:
                     print('Correct in db: %s' % song.path())
                 continue
             song = Song(song.path(), rootDir=song.root())
@@ -580,6 +720,7 @@ class Bard:
             count += 1
             if count % 10:
                 MusicDatabase.commit()
+        MusicDatabase.setSongsFileStat(changedFileStat)
         MusicDatabase.commit()
 
     def checkSongsExistence(self, paths, verbose=False):
@@ -588,9 +729,9 @@ class Bard:
 
     def fixChecksums(self, from_song_id=None):
         if from_song_id:
-            collection = self.getMusic("WHERE id >= ?", (int(from_song_id),))
+            collection = self.iterMusic(afterSongID=int(from_song_id) - 1)
         else:
-            collection = self.getMusic()
+            collection = self.iterMusic()
         count = 0
         forceRecalculate = True
         for song in collection:
@@ -635,30 +776,40 @@ class Bard:
         MusicDatabase.commit()
         print('done')
 
-    def checkChecksums(self, from_song_id=None):
+    def checkChecksums(self, from_song_id=None, jobs=1):
         if from_song_id:
-            collection = self.getMusic("WHERE id >= ?", (int(from_song_id),))
+            collection = self.iterMusic(afterSongID=int(from_song_id) - 1)
         else:
-            collection = self.getMusic()
-        failedSongs = []
-        for song in collection:
+            collection = self.iterMusic()
+
+        def checkSong(song):
             if not os.path.exists(song.path()):
+                return song, None, None
+            return song, song.fileSha256sum(), calculateFileSHA256(song.path())
+
+        if jobs > 1:
+            executor = ThreadPoolExecutor(max_workers=jobs)
+            results = parallelMap(executor, checkSong, collection, jobs * 4)
+        else:
+            results = map(checkSong, collection)
+
+        failedSongs = []
+        for song, sha256InDB, sha256InDisk in results:
+            if sha256InDisk is None:
                 if os.path.lexists(song.path()):
                     print('Broken symlink at %s' % song.path())
                 else:
                     print('Removing song %s from DB: File not found' %
                           song.path())
-                    self.db.removeSong(song)
+                    with MusicDatabase.transaction():
+                        self.db.removeSong(song)
                 continue
-            sha256InDB = song.fileSha256sum()
             if not sha256InDB:
-                print('Calculating SHA256sum for %s' % song.path())
-                sha256InDisk = calculateFileSHA256(song.path())
-                MusicDatabase.addFileSha256sum(song.id, sha256InDisk)
-                MusicDatabase.commit()
+                print('Calculated SHA256sum for %s' % song.path())
+                with MusicDatabase.transaction():
+                    MusicDatabase.addFileSha256sum(song.id, sha256InDisk)
             else:
-                print('Checking %s ... ' % song.path(), end=' ', flush=True)
-                sha256InDisk = calculateFileSHA256(song.path())
+                print('Checking %d %s ... ' % (song.id, song.path()), end=' ')
                 if sha256InDB == sha256InDisk:
                     print(TerminalColors.Ok + 'OK' + TerminalColors.ENDC)
                 else:
@@ -666,6 +817,8 @@ class Bard:
                           ' (db contains %s, disk is %s)' %
                           (sha256InDB, sha256InDisk))
                     failedSongs.append(song)
+        if jobs > 1:
+            executor.shutdown()
 
         if failedSongs:
             print('Failed songs:')
@@ -688,12 +841,18 @@ class Bard:
                not path.startswith('/tmp/')):
                 self.addSong(path)
 
-    def findAudioDuplicates(self, from_song_id=None):
+    def findAudioDuplicates(self, from_song_id=None, topK=None,
+                            minScore=None, coarseSearch=False, useIndex=False,
+                            checkRecall=0, durationWindow=None):
         c = MusicDatabase.conn.cursor()
         info = {}
         print_stats = True
         matchThreshold = 0.8
-        storeThreshold = 0.58
+        storeThreshold = minScore
+        if storeThreshold is None:
+            storeThreshold = config['similaritiesMinScore']
+        if topK is None:
+            topK = config['similaritiesTopK']
         if not from_song_id:
             from_song_id = MusicDatabase.lastSongIDWithCalculatedSimilarities()
         elif from_song_id < 0:
@@ -708,27 +867,90 @@ class Bard:
         from bard.bard_ext import FingerprintManager
         fpm = FingerprintManager()
         fpm.setMaxOffset(100)
+        arena = MusicDatabase.fingerprintArena
+        fpm.openArena(arena.path)
+        if useIndex:
+            # Only compare songs with the ones that have at least 2 of
+            # the 16 high bits of every 4th sub-fingerprint in common
+            # at the same offset
+            fpm.enableIndex(16, 4, 2)
+        if coarseSearch:
+            # Estimate the similarity at each offset with one of every 32
+            # sub-fingerprints and only compare exactly the 4 best offsets
+            # and around them, or all of them if the result is within 0.03
+            # of storeThreshold
+            fpm.setCoarseSearch(32, 4, 0.03)
+        if durationWindow:
+            # Only compare songs whose durations without silences differ in
+            # at most durationWindow seconds
+            fpm.setDurationWindow(durationWindow)
+        # Similarities found and missed by the index in the checked songs
+        recallFound = recallMissed = 0
         speeds = []
         songs_processed = 0
         totalSongsCount = MusicDatabase.getSongsCount()
         fpm.setExpectedSize(totalSongsCount + 5)
-        sql = ('SELECT id, fingerprint, sha256sum, audio_sha256sum, path, '
-               'completeness FROM fingerprints, songs, checksums, '
+        pendingSimilarities = []
+        # Fingerprints decoded in this run that weren't stored decoded yet
+        pendingFingerprints = []
+        # Fingerprints loaded from the database that are not in the arena
+        pendingArena = []
+        # The catalog of a sharded database can't modify the songs' data
+        storeFingerprints = not config['shardedDatabase']
+
+        def storeSimilarities(lastSongID):
+            MusicDatabase.addSongsSimilarities(pendingSimilarities)
+            if lastSongID is not None:
+                MusicDatabase.setState('similarities_last_song_id',
+                                       lastSongID)
+            if storeFingerprints:
+                MusicDatabase.setDecodedFingerprints(pendingFingerprints)
+            MusicDatabase.commit()
+            arena.append(pendingArena)
+            pendingSimilarities.clear()
+            pendingFingerprints.clear()
+            pendingArena.clear()
+
+        lastSongID = None
+        sql = ('SELECT id, sha256sum, audio_sha256sum, path, completeness, '
+               'duration - coalesce(silence_at_start, 0) - '
+               'coalesce(silence_at_end, 0), silence_at_start, '
+               'length(decoded_fingerprint) / 4 '
+               'FROM fingerprints, songs, checksums, '
                'properties where songs.id=fingerprints.song_id and '
                'songs.id = checksums.song_id and '
                'songs.id = properties.song_id order by id')
-
-        for (songID, fingerprint, sha256sum, audioSha256sum, path,
-                completeness) in c.execute(sql):
+        # storeSimilarities modifies the fingerprints table, so it can't be
+        # called while the query is still being stepped
+        songs = c.execute(sql).fetchall()
+
+        for (songID, sha256sum, audioSha256sum, path, completeness,
+                duration, silenceAtStart, decodedLength) in songs:
+            if duration is None:
+                # Songs with an unknown duration are compared with all songs
+                duration = -1
+            if silenceAtStart is None:
+                silenceAtStart = -1
             # print('.', songID,  end='', flush=True)
-            dfp = chromaprint.decode_fingerprint(fingerprint)
-            if not dfp[0]:
-                print("Error calculating fingerprint of song %s (%s)" %
-                      (songID, path))
-                songs_processed += 1
-                continue
+            arenaLength = fpm.arenaFingerprintLength(songID)
+            if arenaLength >= 0 and decodedLength in (None, arenaLength):
+                # The fingerprint manager uses the one in the arena. If the
+                # process died after a song was updated but before its
+                # fingerprint was appended, the arena has the old one
+                dfp = None
+            else:
+                fingerprint, dfp = MusicDatabase.getFingerprint(songID)
+                if dfp is None:
+                    dfp = decodeFingerprint(fingerprint)
+                    if dfp is None:
+                        print("Error calculating fingerprint of song %s "
+                              "(%s)" % (songID, path))
+                        songs_processed += 1
+                        continue
+                    pendingFingerprints.append((dfp, songID))
+                pendingArena.append((songID, dfp))
             if songID < from_song_id:
-                fpm.addSong(songID, dfp[0])
+                fpm.addSong(songID, dfp, duration, silenceAtStart)
                 result = []
             else:
                 if songID == from_song_id:
@@ -736,14 +958,32 @@ class Bard:
                 # if songID > from_song_id:
                 #     return
                 start_time = time.time()
-                result = fpm.addSongAndCompare(songID, dfp[0], storeThreshold)
+                result = fpm.addSongAndCompare(songID, dfp, storeThreshold,
+                                               duration, silenceAtStart)
                 result.sort(key=lambda x: x[0])
+                lastSongID = songID
+                if checkRecall and useIndex and \
+                   songs_processed % checkRecall == 0:
+                    found = {x[0] for x in result}
+                    for x in fpm.compareSongWithPrevious(songID,
+                                                         storeThreshold):
+                        if x[0] in found:
+                            recallFound += 1
+                        else:
+                            recallMissed += 1
+
+                stored = result
+                if topK:
+                    # Only keep the topK most similar songs to this one
+                    stored = sorted(result, key=lambda x: -x[2])[:topK]
+                pendingSimilarities.extend((songID2, songID, offset,
+                                            similarity)
+                                           for songID2, offset, similarity
+                                           in stored)
 
             for (songID2, offset, similarity) in result:
                 print('******** %d %d %d %f' % (songID2, songID,
                                                 offset, similarity))
-                MusicDatabase.addSongsSimilarity(songID2, songID,
-                                                 offset, similarity)
 
                 if similarity >= matchThreshold:
                     # print('''Duplicates found!\n''',
@@ -769,8 +1009,9 @@ class Bard:
                         #       'and %s' % (msg, otherPath, path))
             songs_processed += 1
             info[songID] = (sha256sum, audioSha256sum, path, completeness)
+            if len(pendingSimilarities) >= 1000 or len(pendingArena) >= 1000:
+                storeSimilarities(lastSongID)
             if result:
-                MusicDatabase.commit()
                 if print_stats:
                     delta_time = time.time() - start_time
                     speeds = (speeds[{True: 1, False: 0}[len(speeds) >= 20]:] +
@@ -786,17 +1027,35 @@ class Bard:
                           'estimated end at: %s)' %
                           (delta_time, len(info), totalSongsCount, speeds[-1],
                            avg, totalSongsCount - songs_processed, now + d))
+        storeSimilarities(lastSongID)
+        if recallFound + recallMissed:
+            print('Similarities found using the index in the checked '
+                  'songs: %d of %d (%.2f%%)' %
+                  (recallFound, recallFound + recallMissed,
+                   100 * recallFound / (recallFound + recallMissed)))
+
+    def pruneSimilarities(self, topK=None, minScore=None):
+        if topK is None and minScore is None:
+            topK = config['similaritiesTopK']
+            minScore = config['similaritiesMinScore']
+        removed = MusicDatabase.pruneSimilarities(topK=topK,
+                                                  minScore=minScore)
+        MusicDatabase.commit()
+        print('Removed %d similarities' % removed)
 
-    def getSongsFromIDorPath(self, id_or_path, query=None):
+    def getSongsFromIDorPath(self, id_or_path, query=None,
+                             loadMetadata=False):
         try:
             songID = int(id_or_path)
         except ValueError:
             songID = None
 
         if songID:
-            return Bard.getSongs(songID=songID, query=query)
+            return Bard.getSongs(songID=songID, query=query,
+                                 loadMetadata=loadMetadata)
 
-        return Bard.getSongs(path=id_or_path, query=query)
+        return Bard.getSongs(path=id_or_path, query=query,
+                             loadMetadata=loadMetadata)
 
     def compareSongs(self, song1, song2, verbose=False,
                      showAudioOffsets=False, storeInDB=False,
@@ -824,20 +1083,32 @@ class Bard:
 
         dfp1 = chromaprint.decode_fingerprint(song1.getAcoustidFingerprint())
         dfp2 = chromaprint.decode_fingerprint(song2.getAcoustidFingerprint())
+        # Unknown silences are passed as -1
+        silence1 = song1.silenceAtStart()
+        silence1 = -1 if silence1 is None else silence1
+        silence2 = song2.silenceAtStart()
+        silence2 = -1 if silence2 is None else silence2
         if id1 < id2:
-            fpm.addSong(id1, dfp1[0])
-            fpm.addSong(id2, dfp2[0])
+            fpm.addSong(id1, dfp1[0], -1, silence1)
+            fpm.addSong(id2, dfp2[0], -1, silence2)
         else:
-            fpm.addSong(id2, dfp2[0])
-            fpm.addSong(id1, dfp1[0])
+            fpm.addSong(id2, dfp2[0], -1, silence2)
+            fpm.addSong(id1, dfp1[0], -1, silence1)
 
-        values = fpm.compareSongsVerbose(id1, id2)
-        if showAudioOffsets:
+        values = None
+        if not showAudioOffsets:
+            # Try first the offsets close to the one implied by the silences
+            (offset, similarity) = fpm.compareSongs(id1, id2, storeThreshold)
+            if similarity <= storeThreshold:
+                values = fpm.compareSongsVerbose(id1, id2)
+        else:
+            values = fpm.compareSongsVerbose(id1, id2)
             for offset, similarity in values:
                 if similarity > 0.59:
                     print(offset, similarity)
 
-        (offset, similarity) = max(values, key=lambda x: x[1])
+        if values:
+            (offset, similarity) = max(values, key=lambda x: x[1])
 
         if storeInDB and similarity and similarity >= storeThreshold \
                 and song1.id and song2.id:
@@ -884,8 +1155,8 @@ class Bard:
     #            print(e)
 
     def compareDirectories(self, path1, path2, subset=False, verbose=False):
-        songs1 = self.getSongsAtPath(path1)
-        songs2 = self.getSongsAtPath(path2)
+        songs1 = self.getSongsAtPath(path1, loadMetadata=True)
+        songs2 = self.getSongsAtPath(path2, loadMetadata=True)
         try:
             compareSongSets(songs1, songs2, path1, path2,
                             useSubsetSemantics=subset, verbose=verbose)
@@ -991,25 +1262,233 @@ class Bard:
             print('Setting rating of %s to %d' % (song.path(), rating))
             song.setUserRating(rating, userID)
 
-    def printStats(self):
-        totalSongsCount = MusicDatabase.getSongsCount()
-        totalSongsWithMusicBrainzTags = \
-            MusicDatabase.getSongsWithMusicBrainzTagsCount()
+    def printStats(self, rebuild=False):
+        if rebuild:
+            print('Rebuilding statistics...')
+            MusicDatabase.rebuildStatistics()
+            MusicDatabase.commit()
+        stats = MusicDatabase.getStatistics()
+        totalSongsCount = stats.get('songs', 0)
+        if not totalSongsCount:
+            print('Total songs: 0')
+            return
+
+        def percentage(value):
+            return value * 100.0 / totalSongsCount
+
+        totalDuration = sum(duration for _, _, duration in stats['formats'])
+        losslessSongs = sum(songs for fmt, songs, _ in stats['formats']
+                            if fmt in Song.losslessFormats)
+        totalSongsWithMusicBrainzTags = stats.get('musicbrainz_songs', 0)
         print('Total songs: %d' % (totalSongsCount))
+        print('Total duration: %s' %
+              datetime.timedelta(seconds=round(totalDuration)))
         print('Songs with Musicbrainz tags: %d (%.05g%%)' %
               (totalSongsWithMusicBrainzTags,
-               totalSongsWithMusicBrainzTags * 100.0 / totalSongsCount))
+               percentage(totalSongsWithMusicBrainzTags)))
+        print('Lossless songs: %d (%.05g%%)' %
+              (losslessSongs, percentage(losslessSongs)))
+        print('Songs with duplicated audio tracks: %d (%d extra copies)' %
+              (stats['duplicated_songs'],
+               stats['duplicated_songs'] - stats['duplicated_audio_hashes']))
+        print('Formats:')
+        for fmt, songs, duration in stats['formats']:
+            print('  %-5s %8d songs (%.05g%%)  %s' %
+                  (fmt or '-', songs, percentage(songs),
+                   datetime.timedelta(seconds=round(duration))))
+
+    def maintainDatabase(self, maxTime=None, fullCheck=False,
+                         enableVacuum=False):
+        if config['immutableDatabase']:
+            print("Error: Can't maintain the database: "
+                  "The database is configured as immutable")
+            return
+        deadline = time.time() + maxTime if maxTime else None
+        roots = [root for _, root, _ in MusicDatabase.shards]
+        if roots:
+            # The catalog references songs stored in the root databases,
+            # so its foreign keys can't be checked
+            MusicDatabase.detachShards()
+        self.maintainCurrentDatabase(deadline, fullCheck,
+                                     checkForeignKeys=not roots,
+                                     enableVacuum=enableVacuum)
+        for root in roots:
+            print('Database of %s:' % root)
+            self.openDatabase(root=root)
+            self.maintainCurrentDatabase(deadline, fullCheck,
+                                         enableVacuum=enableVacuum)
+        if roots:
+            self.openDatabase()
+
+    def maintainCurrentDatabase(self, deadline=None, fullCheck=False,
+                                checkForeignKeys=True, enableVacuum=False):
+        def outOfTime(step):
+            if deadline is not None and time.time() >= deadline:
+                print('Skipping %s: maximum time reached' % step)
+                return True
+            return False
+
+        before = MusicDatabase.getDatabaseSizes()
+
+        result = MusicDatabase.checkpoint()
+        if result:
+            print('WAL checkpoint: %d of %d pages written back' %
+                  (result[2], result[1]))
+
+        if not outOfTime('ANALYZE'):
+            print('Updating query planner statistics...')
+            MusicDatabase.analyze(limit=1000 if deadline else None)
+
+        if not outOfTime('integrity check'):
+            print('Checking database integrity...')
+            errors = MusicDatabase.checkIntegrity(
+                full=fullCheck, foreignKeys=checkForeignKeys)
+            for error in errors:
+                print(TerminalColors.Error + error + TerminalColors.ENDC)
+            if not errors:
+                print('Integrity check: ' +
+                      TerminalColors.Ok + 'OK' + TerminalColors.ENDC)
+
+        if enableVacuum and MusicDatabase.enableIncrementalVacuum():
+            print('Enabled incremental vacuum (the database was rebuilt)')
+        elif not outOfTime('incremental vacuum'):
+            freed = MusicDatabase.incrementalVacuum(deadline)
+            if freed is None:
+                print('Incremental vacuum is not enabled. Run db-maintain '
+                      '--enable-incremental-vacuum to enable it (this '
+                      'rebuilds the whole database, which needs free disk '
+                      'space for a copy of it)')
+            elif freed:
+                print('Incremental vacuum: %d free pages released' % freed)
+        MusicDatabase.commit()
+
+        after = MusicDatabase.getDatabaseSizes()
+
+        def size(value):
+            if value >= 1024 * 1024:
+                return '%.1f MB' % (value / (1024 * 1024))
+            return '%d KB' % (value // 1024)
+
+        print('%-30s %12s %12s' % ('', 'Before', 'After'))
+        print('%-30s %12s %12s' % ('Pages', before['page_count'],
+                                   after['page_count']))
+        print('%-30s %12s %12s' %
+              ('Database size',
+               size(before['page_count'] * before['page_size']),
+               size(after['page_count'] * after['page_size'])))
+        print('%-30s %12s %12s' % ('Free pages', before['freelist_count'],
+                                   after['freelist_count']))
+        # Show the largest tables (including their indexes)
+        tables = sorted(after['tables'].items(), key=lambda x: -x[1])
+        for table, tableSize in tables[:10]:
+            print('  %-28s %12s %12s' %
+                  (table, size(before['tables'].get(table, 0)),
+                   size(tableSize)))
+
+    def backup(self, destination, compress=False, pages=256, sleep=0.05,
+               verify=True):
+        destination = os.path.expanduser(destination)
+        if os.path.isdir(destination):
+            name = 'music-%s.db' % \
+                datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+            destination = os.path.join(destination, name)
+        if destination.endswith('.gz'):
+            destination = destination[:-3]
+            compress = True
+
+        databases = [('main', destination)]
+        for shardID, root, path in MusicDatabase.shards:
+            databases.append(('shard%d' % shardID,
+                              '%s.shard%d' % (destination, shardID)))
+
+        for name, path in databases:
+            tmpPath = path + '.tmp'
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+
+            def progress(status, remaining, total):
+                print('\rBacking up %s: %d%%' %
+                      (path, (total - remaining) * 100 // total),
+                      end='', flush=True)
+
+            try:
+                MusicDatabase.backup(tmpPath, pages=pages, sleep=sleep,
+                                     progress=progress, name=name)
+            except Exception as e:
+                print()
+                print(TerminalColors.Error + 'Backup failed: %s' % e +
+                      TerminalColors.ENDC)
+                print('The database does not use a write-ahead log, so '
+                      'other processes writing to it restart the copy. Try '
+                      'again when no other bard process is updating it')
+                if os.path.exists(tmpPath):
+                    os.remove(tmpPath)
+                return False
+            print()
+            if verify:
+                errors, count = MusicDatabase.verifyBackup(tmpPath)
+                if errors:
+                    for error in errors:
+                        print(TerminalColors.Error + error +
+                              TerminalColors.ENDC)
+                    print('Backup verification failed. Removing %s' %
+                          tmpPath)
+                    os.remove(tmpPath)
+                    return False
+                if name == 'main' and MusicDatabase.shards:
+                    # The songs are in the databases of each root
+                    print('Backup verified')
+                else:
+                    print('Backup verified: %d songs' % count)
+            if compress:
+                path += '.gz'
+                compressFile(tmpPath, path)
+                os.remove(tmpPath)
+            else:
+                dropFromPageCache(tmpPath)
+                os.replace(tmpPath, path)
+            print('Backup written to %s (%d bytes)' %
+                  (path, os.path.getsize(path)))
+        return True
+
+    def runInBackground(self, logPath):
+        """Run the current command line again in a detached process."""
+        args = [sys.executable, sys.argv[0]] + \
+            [x for x in sys.argv[1:] if x != '--background']
+        logPath = os.path.expanduser(logPath)
+        os.makedirs(os.path.dirname(logPath), exist_ok=True)
+        with open(logPath, 'a') as log:
+            process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                       stdout=log, stderr=subprocess.STDOUT,
+                                       start_new_session=True)
+        print('Running in the background (pid %d). The output is written '
+              'to %s' % (process.pid, logPath))
 
     def parseCommandLine(self):
         main_parser = ArgumentParser(
             description='Manage your music collection',
                         formatter_class=argparse.RawTextHelpFormatter)
+        main_parser.add_argument('--snapshot', dest='snapshot',
+                                 action='store_true',
+                                 help='Run read-only commands on an '
+                                 'in-memory snapshot of the database')
+        main_parser.add_argument('--snapshot-max-memory', type=int,
+                                 metavar='MB',
+                                 dest='snapshot_max_memory',
+                                 default=config['snapshotMaxMemory'],
+                                 help='Maximum size of the database to copy '
+                                 'in memory with --snapshot. Larger databases '
+                                 'are refused (default: %(default)s)')
         sps = main_parser.add_subparsers(
             dest='command', metavar='command',
             help='''The following commands are available:
 find-duplicates     find duplicate files comparing the checksums
-find-audio-duplicates
+find-audio-duplicates [--top-k K] [--min-score score] [--coarse-search]
+                      [--use-index] [--check-recall N]
+                      [--duration-window seconds]
                     find duplicate files comparing the audio fingerprint
+prune-similarities [--top-k K] [--min-score score]
+                    removes stored similarities out of the retention policy
 compare-songs [-i] [id_or_path] [id_or_path]
                     compares two songs given their paths or song id
 compare-files [-i] [path] [path]
@@ -1026,7 +1505,8 @@ add-silences [-t threshold] [-l length] [-s start] [-e end] [file|song_id ...]
 check-songs-existence [-v] [path]
                     check for removed files to remove them from the
                     database
-check-checksums     check that the imported files haven't been modified
+check-checksums [-j jobs]
+                    check that the imported files haven't been modified
                     since they were imported
 import [file_or_directory [file_or_directory ...]]
                     import new (or update) music. You can specify the
@@ -1035,8 +1515,12 @@ import [file_or_directory [file_or_directory ...]]
                     musicPaths entries in the configuration file are used
 info <file | song id>
                     shows information about a song from the database
-list|ls [-l] [-d] [-i|--id] [-r root] [-g genre] [file | song_id ...]
+list|ls [-l] [-d] [-i|--id] [-r root] [-g genre] [-s text]
+        [file | song_id ...]
                     lists paths to a song from the database
+search [-l] [-d] [-i|--id] [-r root] [-g genre] <text ...>
+                    lists songs whose title, artist, album, album artist
+                    or genre contain all the given texts
 list-similars [-l] [condition]
                     lists files marked as similar in the database
                     (with find-audio-duplicates)
@@ -1044,13 +1528,20 @@ list-genres [-r root] [file | song id]
                     lists genres of songs selected by its name or song id
 fix-genres [file | song id]
                     fix genres of songs selected by its name or song id
-play --shuffle [-r root] [-g genre] [file | song_id ...]
+play --shuffle [-r root] [-g genre] [-s text] [file | song_id ...]
                     play the specified songs using mpv
 fix-tags <file_or_directory [file_or_directory ...]>
                     apply several normalization algorithms to fix tags of
                     files passed as arguments
-update
-                    Update database with new/modified/deleted files''')
+update [-v] [--root root ...]
+                    Update database with new/modified/deleted files
+stats [--rebuild]
+                    print database statistics
+db-maintain [--max-time seconds] [--full-check] [--background]
+            [--enable-incremental-vacuum]
+                    analyzes, checks and vacuums the database
+backup [-z] [--pages pages] [--sleep seconds] [--no-verify] <destination>
+                    copies the database while it's in use''')
         # find-duplicates command
         sps.add_parser('find-duplicates',
                        description='Find duplicate files comparing '
@@ -1062,6 +1553,48 @@ update
         parser.add_argument('--from-song-id', type=int, metavar='from_song_id',
                             help='Starts fixing checksums from a specific '
                                  'song_id')
+        parser.add_argument('--top-k', type=int, dest='top_k',
+                            help='Only store the similarities of each song '
+                            'with its K most similar songs')
+        parser.add_argument('--min-score', type=float, dest='min_score',
+                            help='Only store similarities with at least this '
+                            'score')
+        parser.add_argument('--coarse-search', action='store_true',
+                            dest='coarse_search',
+                            help='Only compare songs at the offsets where a '
+                            'sample of their fingerprints is most similar '
+                            'instead of at every offset. This is about 4.5 '
+                            'times faster but the offset and similarity found '
+                            'may not be the best ones. On the synthetic '
+                            'corpus of scripts/validate_coarse_search.py it '
+                            'found the same results as the full search for '
+                            'all the 1781 similarities of 3 random seeds, but '
+                            'real libraries may differ')
+        parser.add_argument('--use-index', action='store_true',
+                            dest='use_index',
+                            help='Only compare each song with the candidates '
+                            'found with an index of the fingerprints instead '
+                            'of all the other songs. This is faster but can '
+                            'miss similarities near --min-score')
+        parser.add_argument('--check-recall', type=int, dest='check_recall',
+                            metavar='N', default=0,
+                            help='With --use-index, also compare every N-th '
+                            'song with all the other songs and report how '
+                            'many similarities were found using the index')
+        parser.add_argument('--duration-window', type=float,
+                            dest='duration_window', metavar='seconds',
+                            help='Only compare songs whose durations without '
+                            'silences differ in at most this number of '
+                            'seconds')
+        # prune-similarities command
+        parser = sps.add_parser('prune-similarities',
+                                description='Remove stored similarities '
+                                'that are out of the retention policy')
+        parser.add_argument('--top-k', type=int, dest='top_k',
+                            help='Keep only the K most similar songs of '
+                            'each song')
+        parser.add_argument('--min-score', type=float, dest='min_score',
+                            help='Remove similarities lower than this score')
         # compare-songs command
         parser = sps.add_parser('compare-songs',
                                 description='Compares two songs')
@@ -1137,6 +1670,8 @@ update
         parser.add_argument('--from-song-id', type=int, metavar='from_song_id',
                             help='Starts fixing checksums '
                                  'from a specific song_id')
+        parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='Number of files to check in parallel')
         # import command
         parser = sps.add_parser('import',
                                 description='Import new (or update) music. '
@@ -1157,7 +1692,7 @@ update
                                 description='Lists paths to songs '
                                             'from the database')
         parser.add_argument('-l', dest='long_ls', action='store_true',
-                            help='Actually run ls -l')
+                            help='Use a long listing format like ls -l')
         parser.add_argument('-d', dest='group_by_directory',
                             action='store_true',
                             help='Group results by directory')
@@ -1167,12 +1702,14 @@ update
                             help='List only songs in the given root')
         parser.add_argument('-g', '--genre', dest='genre',
                             help='List only songs with the given genre')
+        parser.add_argument('-s', '--search', dest='search',
+                            help='List only songs matching the given text')
         parser.add_argument('paths', nargs='*')
         parser = sps.add_parser('ls',
                                 description='Lists paths to songs '
                                             'from the database')
         parser.add_argument('-l', dest='long_ls', action='store_true',
-                            help='Actually run ls -l')
+                            help='Use a long listing format like ls -l')
         parser.add_argument('-d', dest='group_by_directory',
                             action='store_true',
                             help='Group results by directory')
@@ -1182,7 +1719,29 @@ update
                             help='List only songs in the given root')
         parser.add_argument('-g', '--genre', dest='genre',
                             help='List only songs with the given genre')
+        parser.add_argument('-s', '--search', dest='search',
+                            help='List only songs matching the given text')
         parser.add_argument('paths', nargs='*')
+        # search command
+        parser = sps.add_parser('search',
+                                description='Lists songs whose title, '
+                                            'artist, album, album artist or '
+                                            'genre contain all the given '
+                                            'texts (a text can be restricted '
+                                            'to one of them as in '
+                                            '"artist:beatles")')
+        parser.add_argument('-l', dest='long_ls', action='store_true',
+                            help='Use a long listing format like ls -l')
+        parser.add_argument('-d', dest='group_by_directory',
+                            action='store_true',
+                            help='Group results by directory')
+        parser.add_argument('-i', '--id', dest='show_id', action='store_true',
+                            help='Show the id of each song listed')
+        parser.add_argument('-r', '--root', dest='root',
+                            help='List only songs in the given root')
+        parser.add_argument('-g', '--genre', dest='genre',
+                            help='List only songs with the given genre')
+        parser.add_argument('terms', nargs='+')
         # list-genres command
         parser = sps.add_parser('list-genres',
                                 description='Lists genres of songs '
@@ -1200,7 +1759,7 @@ update
                                 description='List files marked as similar in '
                                             'the database')
         parser.add_argument('-l', dest='long_ls', action='store_true',
-                            help='Run ls -l on the files')
+                            help='Use a long listing format like ls -l')
         parser.add_argument('condition', nargs='*', help='An optional '
                             'condition on similarity (i.e. "> 0.8"). '
                             'By default: ">0.85"')
@@ -1213,6 +1772,8 @@ update
                             help='Play only songs in the given root')
         parser.add_argument('-g', '--genre', dest='genre',
                             help='Play only songs with the given genre')
+        parser.add_argument('-s', '--search', dest='search',
+                            help='Play only songs matching the given text')
         parser.add_argument('paths', nargs='*')
         # fix-tags command
         parser = sps.add_parser('fix-tags',
@@ -1226,6 +1787,10 @@ update
                                 '/deleted files')
         parser.add_argument('-v', '--verbose', dest='verbose',
                             action='store_true', help='Be verbose')
+        parser.add_argument('--root', dest='roots', action='append',
+                            metavar='root',
+                            help='Update only this musicPaths entry (can be '
+                            'given several times)')
         # set-rating command
         parser = sps.add_parser('set-rating',
                                 description='Set ratings for a song or songs')
@@ -1237,11 +1802,73 @@ update
         # stats command
         parser = sps.add_parser('stats',
                                 description='Print database statistics')
+        parser.add_argument('--rebuild', dest='rebuild', action='store_true',
+                            help='Recalculate the statistics from scratch')
+        # db-maintain command
+        parser = sps.add_parser('db-maintain',
+                                description='Update the query planner '
+                                'statistics, check the database integrity '
+                                'and release unused space')
+        parser.add_argument('--max-time', type=int, metavar='seconds',
+                            dest='max_time',
+                            help='Stop starting new maintenance steps after '
+                            'this time')
+        parser.add_argument('--full-check', dest='full_check',
+                            action='store_true',
+                            help='Run a full integrity check (slower)')
+        parser.add_argument('--enable-incremental-vacuum',
+                            dest='enable_vacuum', action='store_true',
+                            help='Enable incremental vacuum if needed. This '
+                            'rebuilds the whole database with VACUUM, '
+                            'which locks it and needs free disk space for '
+                            'a copy of it')
+        parser.add_argument('--background', dest='background',
+                            action='store_true',
+                            help='Run in a detached background process')
+        # backup command
+        parser = sps.add_parser('backup',
+                                description='Copy the database using the '
+                                'sqlite online backup API, without blocking '
+                                'other bard processes')
+        parser.add_argument('-z', '--compress', dest='compress',
+                            action='store_true',
+                            help='Compress the backup with gzip')
+        parser.add_argument('--pages', type=int, default=256,
+                            help='Pages to copy in each step, or -1 to copy '
+                            'the database in one step (default: '
+                            '%(default)s)')
+        parser.add_argument('--sleep', type=float, default=0.05,
+                            metavar='seconds',
+                            help='Time to sleep between steps (default: '
+                            '%(default)s)')
+        parser.add_argument('--no-verify', dest='verify',
+                            action='store_false',
+                            help="Don't check the integrity of the backup")
+        parser.add_argument('destination',
+                            help='Backup file or directory (a timestamped '
+                            'file is created in it)')
         options = main_parser.parse_args()
 
+        if config['shardedDatabase'] and \
+           options.command in self.songWritingCommands:
+            print('The %s command is not supported with the shardedDatabase '
+                  'option' % options.command)
+            sys.exit(1)
+
+        if options.snapshot:
+            if options.command not in self.readOnlyCommands or \
+               getattr(options, 'rebuild', False):
+                print('The %s command modifies the database and can not be '
+                      'run on a snapshot' % options.command)
+                sys.exit(1)
+            MusicDatabase.connections.close()
+            maxMemory = options.snapshot_max_memory * 1024 * 1024
+            self.db = MusicDatabase(snapshot=True,
+                                    snapshotMaxMemory=maxMemory)
+
         if options.command == 'find-duplicates':
             self.findDuplicates()
-        elif options.command == 'find-duplicates':
+        elif options.command == 'fix-mtime':
             self.fixMtime()
         elif options.command == 'fix-checksums':
             self.fixChecksums(options.from_song_id)
@@ -1255,9 +1882,18 @@ update
                 paths = config['musicPaths']
             self.checkSongsExistence(paths, verbose=options.verbose)
         elif options.command == 'check-checksums':
-            self.checkChecksums(options.from_song_id)
+            self.checkChecksums(options.from_song_id, jobs=options.jobs)
         elif options.command == 'find-audio-duplicates':
-            self.findAudioDuplicates(options.from_song_id)
+            self.findAudioDuplicates(options.from_song_id,
+                                     topK=options.top_k,
+                                     minScore=options.min_score,
+                                     coarseSearch=options.coarse_search,
+                                     useIndex=options.use_index,
+                                     checkRecall=options.check_recall,
+                                     durationWindow=options.duration_window)
+        elif options.command == 'prune-similarities':
+            self.pruneSimilarities(topK=options.top_k,
+                                   minScore=options.min_score)
         elif options.command == 'compare-songs':
             self.compareSongIDsOrPaths(options.song1, options.song2,
                                        options.interactive)
@@ -1273,11 +1909,12 @@ update
         elif options.command == 'info':
             self.info(options.paths, options.playing)
         elif options.command == 'list' or options.command == 'ls':
-            if not options.paths and not options.root and not options.genre:
-                print('The list command needs either a path/id/root/genre '
-                      'parameter to list')
+            if not options.paths and not options.root and \
+               not options.genre and not options.search:
+                print('The list command needs either a '
+                      'path/id/root/genre/search parameter to list')
                 sys.exit(1)
-            query = Query(options.root, options.genre)
+            query = Query(options.root, options.genre, options.search)
             if not options.paths:
                 options.paths = ['']
 
@@ -1285,6 +1922,11 @@ update
                 self.list(path, long_ls=options.long_ls,
                           show_id=options.show_id, query=query,
                           group_by_directory=options.group_by_directory)
+        elif options.command == 'search':
+            query = Query(options.root, options.genre, options.terms)
+            self.list('', long_ls=options.long_ls, show_id=options.show_id,
+                      query=query,
+                      group_by_directory=options.group_by_directory)
         elif options.command == 'list-genres':
             self.listGenres(id_or_paths=options.id_or_paths, root=options.root)
         elif options.command == 'fix-genres':
@@ -1293,22 +1935,34 @@ update
             self.listSimilars(condition=options.condition,
                               long_ls=options.long_ls)
         elif options.command == 'play':
-            query = Query(options.root, options.genre)
+            query = Query(options.root, options.genre, options.search)
             self.play(options.paths, options.shuffle, query)
         elif options.command == 'import':
             paths = options.paths
             if not paths:
                 paths = config['musicPaths']
 
-            self.add(paths)
+            self.importPaths(paths)
         elif options.command == 'update':
-            paths = config['musicPaths']
-            self.add(paths, verbose=options.verbose)
-            self.checkSongsExistence(paths, verbose=options.verbose)
+            self.update(options.roots or config['musicPaths'],
+                        verbose=options.verbose)
         elif options.command == 'set-rating':
             self.setRating(options.paths, options.rating, options.playing)
         elif options.command == 'stats':
-            self.printStats()
+            self.printStats(rebuild=options.rebuild)
+        elif options.command == 'db-maintain':
+            if options.background:
+                self.runInBackground('~/.cache/bard/db-maintain.log')
+            else:
+                self.maintainDatabase(maxTime=options.max_time,
+                                      fullCheck=options.full_check,
+                                      enableVacuum=options.enable_vacuum)
+        elif options.command == 'backup':
+            if not self.backup(options.destination,
+                               compress=options.compress,
+                               pages=options.pages, sleep=options.sleep,
+                               verify=options.verify):
+                sys.exit(1)
 
 
 def main():
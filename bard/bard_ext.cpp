@@ -21,11 +21,23 @@
 #include <boost/python/list.hpp>
 #include <boost/python/tuple.hpp>
 #include <boost/python/class.hpp>
+#include <boost/python/overloads.hpp>
 #include <vector>
+#include <deque>
+#include <numeric>
 #include <map>
+#include <unordered_map>
 #include <iostream>
+#include <algorithm>
+#include <cmath>
+#include <climits>
 #include <parallel/algorithm>
-#include <mutex>
+#include <omp.h>
+#include <cstring>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 template<typename T>
 inline
@@ -35,6 +47,74 @@ std::vector<T> to_std_vector( const boost::python::object& iterable )
                            boost::python::stl_input_iterator<T>( ) );
 }
 
+static void raise_error(PyObject *type, const char *message)
+{
+    PyErr_SetString(type, message);
+    boost::python::throw_error_already_set();
+}
+
+/* Holds a contiguous buffer of an object supporting the buffer protocol */
+class BufferView
+{
+public:
+    explicit BufferView(PyObject *obj)
+    {
+        if (PyObject_GetBuffer(obj, &m_view, PyBUF_C_CONTIGUOUS | PyBUF_FORMAT) < 0)
+            boost::python::throw_error_already_set();
+    }
+    ~BufferView()
+    {
+        PyBuffer_Release(&m_view);
+    }
+    BufferView(const BufferView &) = delete;
+    BufferView &operator=(const BufferView &) = delete;
+
+    const Py_buffer &view() const { return m_view; }
+
+private:
+    Py_buffer m_view;
+};
+
+/* Return the sub-fingerprints in a buffer of 32 bit integers (like an
+   array('I') or a numpy uint32 array) or in a buffer of bytes with the
+   sub-fingerprints encoded as uint32 in little endian (as stored in the
+   database) */
+std::vector<int> buffer_to_vector( PyObject *obj )
+{
+    BufferView buffer(obj);
+    const Py_buffer &view = buffer.view();
+    const char *format = view.format ? view.format : "B";
+    char byte_order = '@';
+    if (std::strchr("@=<>!", format[0]))
+        byte_order = *format++;
+    const bool host_little_endian = __BYTE_ORDER__ == __ORDER_LITTLE_ENDIAN__;
+    bool little_endian = true;
+    if (view.itemsize == 1 && format[0] && std::strchr("Bbc", format[0]) && !format[1])
+        little_endian = true;
+    else if (view.itemsize == sizeof(int32_t) && format[0] && std::strchr("iIlL", format[0]) && !format[1])
+        little_endian = byte_order == '<' || ((byte_order == '@' || byte_order == '=') && host_little_endian);
+    else
+        raise_error(PyExc_TypeError, "Fingerprints must be buffers of bytes or 32 bit integers");
+    if (view.len % sizeof(int32_t))
+        raise_error(PyExc_ValueError, "The size of a fingerprint buffer must be a multiple of 4 bytes");
+
+    std::vector<int> v(view.len / sizeof(int32_t));
+    std::memcpy(v.data(), view.buf, view.len);
+    if (little_endian != host_little_endian)
+        for (auto &x : v)
+            x = __builtin_bswap32(x);
+    return v;
+}
+
+/* Return a fingerprint given as a list of ints or as any object supporting
+   the buffer protocol (see buffer_to_vector) */
+std::vector<int> fingerprint_to_vector( const boost::python::object& fingerprint )
+{
+    if (PyObject_CheckBuffer(fingerprint.ptr()))
+        return buffer_to_vector(fingerprint.ptr());
+    return to_std_vector<int>(fingerprint);
+}
+
 template<typename T>
 long greet(boost::python::list &a)
 {
@@ -50,36 +130,376 @@ boost::python::tuple greet2()
    return boost::python::make_tuple(a,2,3);
 }
 
+/* Kernels returning the number of different bits between the n words of a
+   and b. The best one supported by the CPU is chosen at runtime, so the
+   module doesn't need to be built for a specific CPU */
+typedef int (*xor_popcount_function)(const int *a, const int *b, int n);
+
+/* One word at a time, as it was always done. Kept as a reference */
+static int xor_popcount_scalar(const int *a, const int *b, int n)
+{
+    int bits = 0;
+    for (int i = 0; i < n; ++i)
+        bits += __builtin_popcount(a[i] ^ b[i]);
+    return bits;
+}
+
+static inline __attribute__((always_inline))
+int xor_popcount_words64(const int *a, const int *b, int n)
+{
+    int bits = 0;
+    int i = 0;
+    for (; i + 2 <= n; i += 2)
+    {
+        uint64_t x, y;
+        std::memcpy(&x, a + i, sizeof(x));
+        std::memcpy(&y, b + i, sizeof(y));
+        bits += __builtin_popcountll(x ^ y);
+    }
+    if (i < n)
+        bits += __builtin_popcount(a[i] ^ b[i]);
+    return bits;
+}
+
+/* Two words at a time without any special instruction */
+static int xor_popcount_generic(const int *a, const int *b, int n)
+{
+    return xor_popcount_words64(a, b, n);
+}
+
+/* Number of different bits between a[i] and b[i] for i multiple of step
+   lower than n */
+typedef int (*strided_xor_popcount_function)(const int *a, const int *b, int n, int step);
+
+static inline __attribute__((always_inline))
+int strided_xor_popcount_words(const int *a, const int *b, int n, int step)
+{
+    int bits = 0;
+    for (int i = 0; i < n; i += step)
+        bits += __builtin_popcount(a[i] ^ b[i]);
+    return bits;
+}
+
+static int strided_xor_popcount_generic(const int *a, const int *b, int n, int step)
+{
+    return strided_xor_popcount_words(a, b, n, step);
+}
+
+#if defined(__x86_64__) || defined(__i386__)
+#include <immintrin.h>
+
+__attribute__((target("popcnt")))
+static int strided_xor_popcount_popcnt(const int *a, const int *b, int n, int step)
+{
+    return strided_xor_popcount_words(a, b, n, step);
+}
+
+/* Two words at a time using the popcnt instruction */
+__attribute__((target("popcnt")))
+static int xor_popcount_popcnt(const int *a, const int *b, int n)
+{
+    return xor_popcount_words64(a, b, n);
+}
+
+/* Eight words at a time counting the bits of each nibble with a lookup
+   table in a register */
+__attribute__((target("avx2,popcnt")))
+static int xor_popcount_avx2(const int *a, const int *b, int n)
+{
+    const __m256i lookup = _mm256_setr_epi8(0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4,
+                                            0, 1, 1, 2, 1, 2, 2, 3, 1, 2, 2, 3, 2, 3, 3, 4);
+    const __m256i low_mask = _mm256_set1_epi8(0x0f);
+    __m256i acc = _mm256_setzero_si256();
+    int i = 0;
+    for (; i + 8 <= n; i += 8)
+    {
+        const __m256i x = _mm256_xor_si256(_mm256_loadu_si256(reinterpret_cast<const __m256i *>(a + i)),
+                                           _mm256_loadu_si256(reinterpret_cast<const __m256i *>(b + i)));
+        const __m256i lo = _mm256_and_si256(x, low_mask);
+        const __m256i hi = _mm256_and_si256(_mm256_srli_epi16(x, 4), low_mask);
+        const __m256i counts = _mm256_add_epi8(_mm256_shuffle_epi8(lookup, lo),
+                                               _mm256_shuffle_epi8(lookup, hi));
+        acc = _mm256_add_epi64(acc, _mm256_sad_epu8(counts, _mm256_setzero_si256()));
+    }
+    int bits = _mm256_extract_epi64(acc, 0) + _mm256_extract_epi64(acc, 1) +
+               _mm256_extract_epi64(acc, 2) + _mm256_extract_epi64(acc, 3);
+    return bits + xor_popcount_words64(a + i, b + i, n - i);
+}
+
+/* Sixteen words at a time using AVX-512 VPOPCNTDQ */
+__attribute__((target("avx512f,avx512vpopcntdq")))
+static int xor_popcount_avx512(const int *a, const int *b, int n)
+{
+    __m512i acc = _mm512_setzero_si512();
+    int i = 0;
+    for (; i + 16 <= n; i += 16)
+    {
+        const __m512i x = _mm512_xor_si512(_mm512_loadu_si512(a + i),
+                                           _mm512_loadu_si512(b + i));
+        acc = _mm512_add_epi64(acc, _mm512_popcnt_epi64(x));
+    }
+    if (i < n)
+    {
+        const __mmask16 mask = (1u << (n - i)) - 1;
+        const __m512i x = _mm512_xor_si512(_mm512_maskz_loadu_epi32(mask, a + i),
+                                           _mm512_maskz_loadu_epi32(mask, b + i));
+        acc = _mm512_add_epi64(acc, _mm512_popcnt_epi64(x));
+    }
+    return _mm512_reduce_add_epi64(acc);
+}
+
+/* Sixteen strided words at a time using AVX-512 gathers and VPOPCNTDQ */
+__attribute__((target("avx512f,avx512vpopcntdq")))
+static int strided_xor_popcount_avx512(const int *a, const int *b, int n, int step)
+{
+    const __m512i indices = _mm512_mullo_epi32(_mm512_setr_epi32(0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15),
+                                               _mm512_set1_epi32(step));
+    __m512i acc = _mm512_setzero_si512();
+    int i = 0;
+    for (; i + 15 * step < n; i += 16 * step)
+    {
+        const __m512i x = _mm512_xor_si512(_mm512_i32gather_epi32(indices, a + i, 4),
+                                           _mm512_i32gather_epi32(indices, b + i, 4));
+        acc = _mm512_add_epi32(acc, _mm512_popcnt_epi32(x));
+    }
+    return _mm512_reduce_add_epi32(acc) + strided_xor_popcount_words(a + i, b + i, n - i, step);
+}
+#endif
+
+struct XorPopcountKernel
+{
+    const char *name;
+    xor_popcount_function function;
+    strided_xor_popcount_function strided_function;
+    bool (*supported)();
+};
+
+static const XorPopcountKernel xor_popcount_kernels[] = {
+#if defined(__x86_64__) || defined(__i386__)
+    {"avx512vpopcntdq", xor_popcount_avx512, strided_xor_popcount_avx512,
+        []() { return __builtin_cpu_supports("avx512f") && __builtin_cpu_supports("avx512vpopcntdq"); }},
+    {"avx2", xor_popcount_avx2, strided_xor_popcount_popcnt,
+        []() { return __builtin_cpu_supports("avx2") && __builtin_cpu_supports("popcnt"); }},
+    {"popcnt", xor_popcount_popcnt, strided_xor_popcount_popcnt,
+        []() { return bool(__builtin_cpu_supports("popcnt")); }},
+#endif
+    {"generic", xor_popcount_generic, strided_xor_popcount_generic,
+        []() { return true; }},
+    {"scalar", xor_popcount_scalar, strided_xor_popcount_generic,
+        []() { return true; }},
+};
+
+static const XorPopcountKernel *xor_popcount_kernel = nullptr;
+
+/* Use the kernel with the given name, or the best one supported by the CPU
+   if name is empty. Returns false if it's not supported */
+bool setXorPopcountKernel(const std::string &name)
+{
+#if defined(__x86_64__) || defined(__i386__)
+    __builtin_cpu_init();
+#endif
+    for (const auto &kernel : xor_popcount_kernels)
+    {
+        if ((name.empty() || name == kernel.name) && kernel.supported())
+        {
+            xor_popcount_kernel = &kernel;
+            return true;
+        }
+    }
+    return false;
+}
+
+std::string xorPopcountKernel()
+{
+    return xor_popcount_kernel->name;
+}
+
+boost::python::list xorPopcountKernels()
+{
+    boost::python::list result;
+    for (const auto &kernel : xor_popcount_kernels)
+        if (kernel.supported())
+            result.append(std::string(kernel.name));
+    return result;
+}
+
+/* Return the number of different bits between two fingerprints of the same
+   length with the current kernel, only comparing every step-th
+   sub-fingerprint if step is greater than 1. The comparison is run repeat
+   times, so it can be benchmarked without the cost of the conversion */
+int xorPopcount(const boost::python::object &a, const boost::python::object &b, int step=1, long repeat=1)
+{
+    const std::vector<int> v1 = fingerprint_to_vector(a);
+    const std::vector<int> v2 = fingerprint_to_vector(b);
+    if (v1.size() != v2.size())
+        raise_error(PyExc_ValueError, "Both fingerprints must have the same length");
+    if (step < 1 || repeat < 1)
+        raise_error(PyExc_ValueError, "step and repeat must be positive");
+    const int n = v1.size();
+    int bits = 0;
+    for (long i = 0; i < repeat; ++i)
+    {
+        if (step == 1)
+            bits = xor_popcount_kernel->function(v1.data(), v2.data(), n);
+        else
+            bits = xor_popcount_kernel->strided_function(v1.data(), v2.data(), n, step);
+    }
+    return bits;
+}
+BOOST_PYTHON_FUNCTION_OVERLOADS(xorPopcount_overloads, xorPopcount, 2, 4)
+
+/* A fingerprint stored in memory owned by the FingerprintManager or in a
+   fingerprint arena file mapped in memory */
+struct Fingerprint
+{
+    const int *data = nullptr;
+    int size = 0;
+};
+
+/* An occurrence of a key in the inverted index: the index of a song in
+   m_fingerprints and the position of the sub-fingerprint in it */
+struct Posting
+{
+    uint32_t song;
+    uint32_t position;
+};
+
+/* A song found to be similar: its index in m_fingerprints, the offset and
+   the similarity */
+struct Match
+{
+    uint32_t song;
+    int offset;
+    double similarity;
+};
+
+/* Releases the GIL while it exists so other Python threads can run. No
+   Python objects can be used meanwhile */
+class ScopedGILRelease
+{
+public:
+    ScopedGILRelease(): m_state(PyEval_SaveThread()) {}
+    ~ScopedGILRelease()
+    {
+        PyEval_RestoreThread(m_state);
+    }
+    ScopedGILRelease(const ScopedGILRelease &) = delete;
+    ScopedGILRelease &operator=(const ScopedGILRelease &) = delete;
+
+private:
+    PyThreadState *m_state;
+};
+
+/* Chromaprint calculates a sub-fingerprint every 1365 samples of audio
+   resampled to 11025 Hz */
+const double chromaprint_frames_per_second = 11025.0 / 1365;
+
+/* Value of an offset hint when the expected offset is not known */
+const int no_offset_hint = INT_MIN;
+
+/* Songs are compared without holding the GIL, so other Python threads can
+   run meanwhile, but a FingerprintManager must not be used from more than
+   one thread at the same time */
 class FingerprintManager
 {
 public:
     FingerprintManager();
+    ~FingerprintManager();
     void setMaxOffset(int maxoffset);
     int maxOffset() const;
 
     void setExpectedSize(int expectedSize);
     int size() const;
 
-    void addSong(long songID, boost::python::list &fingerprint);
-    boost::python::list addSongAndCompare(long songID, boost::python::list &fingerprint, double cancelThreshold=0.55);
+    bool openArena(const std::string &path);
+    bool isInArena(long songID) const;
+    int arenaFingerprintLength(long songID) const;
+
+    void enableIndex(int keyBits, int stride, int minVotes);
+    void setCoarseSearch(int step, int candidates, double margin);
+    void setDurationWindow(double window);
+    void setOffsetHintWindow(int window);
+
+    void addSong(long songID, const boost::python::object &fingerprint, double duration=-1, double silenceAtStart=-1);
+    void addSongs(const boost::python::object &songIDs, const boost::python::object &offsets, const boost::python::object &fingerprints,
+                  const boost::python::object &durations=boost::python::object(), const boost::python::object &silencesAtStart=boost::python::object());
+    boost::python::list addSongAndCompare(long songID, const boost::python::object &fingerprint, double cancelThreshold=0.55, double duration=-1, double silenceAtStart=-1);
+    boost::python::list compareSongWithPrevious(long songID, double cancelThreshold=0.55);
     std::pair<int, double> compareSongs(long songID1, long songID2, double cancelThreshold=0.55);
     boost::python::list compareSongsVerbose(long songID1, long songID2);
 
-    std::pair<int, double> compareChromaprintFingerprintsAndOffset(const std::vector<int> &fp1, const std::vector<int> &fp2, double cancelThreshold) const;
-    boost::python::list compareChromaprintFingerprintsAndOffsetVerbose(std::vector<int> fp1, std::vector<int> fp2) const;
+    std::pair<int, double> compareChromaprintFingerprintsAndOffset(const Fingerprint &fp1, const Fingerprint &fp2, double cancelThreshold, int offsetHint=no_offset_hint) const;
+    boost::python::list compareChromaprintFingerprintsAndOffsetVerbose(const Fingerprint &fp1, const Fingerprint &fp2) const;
 
 protected:
-    std::vector<int> songFingerprint(int songID);
+    size_t songIndex(long songID) const;
+    Fingerprint songFingerprint(long songID);
+    int offsetHint(uint32_t song1, double silenceAtStart2) const;
+    std::pair<int, double> compareAroundOffset(const Fingerprint &fp1, const Fingerprint &fp2, double cancelThreshold, int offsetHint) const;
+    Fingerprint fingerprintFromObject(long songID, const boost::python::object &fingerprint);
+    static double similarityAtOffset(const Fingerprint &fp1, const Fingerprint &fp2, int offset, double cancelThreshold);
+    static double sampledSimilarityAtOffset(const Fingerprint &fp1, const Fingerprint &fp2, int offset, int step);
+    std::pair<int, double> compareAllOffsets(const Fingerprint &fp1, const Fingerprint &fp2, double cancelThreshold) const;
+    std::pair<int, double> compareCoarseToFine(const Fingerprint &fp1, const Fingerprint &fp2, double cancelThreshold) const;
+
+    uint32_t indexKey(int subfingerprint) const;
+    void indexSong(uint32_t song);
+    std::vector<uint32_t> candidates(const Fingerprint &fp) const;
+    long durationBucket(double duration) const;
+    void addSongDuration(uint32_t song, double duration);
+    std::vector<uint32_t> songsToCompare(const Fingerprint &fp, double duration, size_t count, bool useIndex) const;
+    std::vector<Match> compareWithSongs(const Fingerprint &fp, double silenceAtStart, const std::vector<uint32_t> &songs, double cancelThreshold) const;
+    boost::python::list matchesToList(const std::vector<Match> &matches) const;
 
 private:
     int m_maxoffset;
-    std::vector<std::pair<int,std::vector<int>>> m_fingerprints;
+    std::vector<std::pair<long, Fingerprint>> m_fingerprints;
+    // Fingerprints that are not in the arena (a deque doesn't move them)
+    std::deque<std::vector<int>> m_storage;
+
+    // Memory mapped arena files and the arena fingerprint of each song
+    std::vector<std::pair<void *, size_t>> m_mappings;
+    std::unordered_map<long, Fingerprint> m_arena;
+
+    // Inverted index from the high bits of sub-fingerprints to the songs
+    // containing them. It's empty unless enableIndex is used
+    std::vector<std::vector<Posting>> m_index;
+    int m_keyBits;
+    int m_indexStride;
+    int m_minVotes;
+
+    // Parameters of the coarse-to-fine offset search. It's not used if
+    // m_coarseStep is 0
+    int m_coarseStep;
+    int m_coarseCandidates;
+    double m_coarseMargin;
+
+    // Duration of each song in m_fingerprints (negative if it's unknown) and
+    // songs with a known duration bucketed by duration / m_durationWindow.
+    // Songs are compared with all songs if m_durationWindow is 0
+    std::vector<double> m_durations;
+    double m_durationWindow;
+    std::unordered_map<long, std::vector<uint32_t>> m_durationBuckets;
+    std::vector<uint32_t> m_unknownDurations;
+
+    // Silence at the start of each song in m_fingerprints in seconds
+    // (negative if it's unknown) and the number of offsets around the one
+    // they imply that are compared before comparing all offsets
+    std::vector<double> m_silencesAtStart;
+    int m_offsetHintWindow;
 };
 
-FingerprintManager::FingerprintManager(): m_maxoffset(50)
+FingerprintManager::FingerprintManager(): m_maxoffset(50), m_keyBits(0),
+    m_indexStride(1), m_minVotes(1), m_coarseStep(0), m_coarseCandidates(0),
+    m_coarseMargin(0), m_durationWindow(0), m_offsetHintWindow(5)
 {
 }
 
+FingerprintManager::~FingerprintManager()
+{
+    for (auto & [address, length] : m_mappings)
+        munmap(address, length);
+}
 
 void FingerprintManager::setMaxOffset(int maxoffset)
 {
@@ -101,170 +521,646 @@ int FingerprintManager::size() const
     return m_fingerprints.size();
 }
 
-std::vector<int> FingerprintManager::songFingerprint(int songID)
+/* Map a file read-only in memory. Returns nullptr if it can't be mapped */
+static const char *map_file(const std::string &path, size_t &length)
+{
+    int fd = open(path.c_str(), O_RDONLY);
+    if (fd < 0)
+        return nullptr;
+    struct stat st;
+    void *address = MAP_FAILED;
+    if (fstat(fd, &st) == 0 && st.st_size > 0)
+    {
+        length = st.st_size;
+        address = mmap(nullptr, length, PROT_READ, MAP_SHARED, fd, 0);
+    }
+    close(fd);
+    if (address == MAP_FAILED)
+        return nullptr;
+    return static_cast<const char *>(address);
+}
+
+/* Open the fingerprint arena at path (written by bard.fingerprintarena).
+   Sub-fingerprints are read from path and the (song id, offset, length)
+   records of each song from path.idx. Returns false if the arena doesn't
+   exist or is not valid */
+bool FingerprintManager::openArena(const std::string &path)
+{
+#if __BYTE_ORDER__ == __ORDER_BIG_ENDIAN__
+    return false;
+#endif
+    const char magic[] = "BARDFPA1";
+    const size_t header_size = sizeof(magic) - 1;
+    size_t data_length = 0, index_length = 0;
+    const char *data = map_file(path, data_length);
+    if (!data)
+        return false;
+    m_mappings.emplace_back(const_cast<char *>(data), data_length);
+    const char *index = map_file(path + ".idx", index_length);
+    if (!index)
+        return false;
+    if (index_length < header_size || std::memcmp(index, magic, header_size) != 0)
+    {
+        munmap(const_cast<char *>(index), index_length);
+        return false;
+    }
+
+    madvise(const_cast<char *>(data), data_length, MADV_WILLNEED);
+    const int64_t *record = reinterpret_cast<const int64_t *>(index + header_size);
+    const size_t records = (index_length - header_size) / (3 * sizeof(int64_t));
+    const size_t data_size = data_length / sizeof(int32_t);
+    for (size_t i = 0; i < records; ++i, record += 3)
+    {
+        const int64_t songID = record[0], offset = record[1], size = record[2];
+        // Records of fingerprints that were not completely written are ignored
+        if (offset < 0 || size < 0 || size_t(offset + size) > data_size)
+            continue;
+        // Later records replace earlier ones of the same song
+        m_arena[songID] = Fingerprint{reinterpret_cast<const int *>(data) + offset, int(size)};
+    }
+    // The records were copied to m_arena
+    munmap(const_cast<char *>(index), index_length);
+    return true;
+}
+
+bool FingerprintManager::isInArena(long songID) const
+{
+    return m_arena.count(songID) > 0;
+}
+
+/* Return the number of sub-fingerprints of the song in the arena or -1 if
+   it's not in the arena */
+int FingerprintManager::arenaFingerprintLength(long songID) const
+{
+    auto it = m_arena.find(songID);
+    return it == m_arena.end() ? -1 : it->second.size;
+}
+
+/* Only compare new songs with the songs that have at least minVotes
+   sub-fingerprints whose keyBits high bits are equal to the ones of the new
+   song at the same offset, instead of comparing them with all songs.
+   Every stride-th sub-fingerprint of each song is indexed */
+void FingerprintManager::enableIndex(int keyBits, int stride, int minVotes)
+{
+    m_keyBits = keyBits;
+    m_indexStride = std::max(stride, 1);
+    m_minVotes = std::max(minVotes, 1);
+    m_index.assign(size_t(1) << keyBits, std::vector<Posting>());
+    for (uint32_t song = 0; song < m_fingerprints.size(); ++song)
+        indexSong(song);
+}
+
+/* Compare fingerprints by estimating the similarity at every offset with one
+   out of every step sub-fingerprints, and then only calculating the exact
+   similarity at the candidates offsets with the best estimations and around
+   them. All offsets are compared when the result is less than margin below
+   the threshold. A step of 0 compares all offsets exactly */
+void FingerprintManager::setCoarseSearch(int step, int candidates, double margin)
+{
+    m_coarseStep = std::max(step, 0);
+    m_coarseCandidates = std::max(candidates, 1);
+    m_coarseMargin = std::max(margin, 0.0);
+}
+
+/* Only compare songs whose durations differ in at most window seconds.
+   Songs with an unknown duration are compared with all songs. A window of 0
+   compares all songs */
+void FingerprintManager::setDurationWindow(double window)
+{
+    m_durationWindow = std::max(window, 0.0);
+    m_durationBuckets.clear();
+    m_unknownDurations.clear();
+    for (uint32_t song = 0; song < m_durations.size(); ++song)
+        addSongDuration(song, m_durations[song]);
+}
+
+/* When the silences at the start of two songs are known, first compare
+   the offsets that are at most window positions away from the one implied
+   by the difference of silences, and only compare the rest if that
+   doesn't find a similarity. A negative window always compares all
+   offsets */
+void FingerprintManager::setOffsetHintWindow(int window)
+{
+    m_offsetHintWindow = window;
+}
+
+long FingerprintManager::durationBucket(double duration) const
+{
+    return std::floor(duration / m_durationWindow);
+}
+
+void FingerprintManager::addSongDuration(uint32_t song, double duration)
+{
+    if (m_durationWindow <= 0)
+        return;
+    if (duration < 0)
+        m_unknownDurations.push_back(song);
+    else
+        m_durationBuckets[durationBucket(duration)].push_back(song);
+}
+
+uint32_t FingerprintManager::indexKey(int subfingerprint) const
+{
+    return uint32_t(subfingerprint) >> (32 - m_keyBits);
+}
+
+void FingerprintManager::indexSong(uint32_t song)
+{
+    const Fingerprint &fp = m_fingerprints[song].second;
+    for (int position = 0; position < fp.size; position += m_indexStride)
+        m_index[indexKey(fp.data[position])].push_back(Posting{song, uint32_t(position)});
+}
+
+/* Return the indexes of the songs that have enough keys in common with fp at
+   a consistent offset, sorted */
+std::vector<uint32_t> FingerprintManager::candidates(const Fingerprint &fp) const
+{
+    // Keys found in more places than the number of songs (like the ones of
+    // silences) don't help to tell songs apart
+    const size_t maxPostings = std::max<size_t>(1000, m_fingerprints.size());
+    // Each vote is a (song, offset) pair encoded in 64 bits
+    std::vector<uint64_t> votes;
+    for (int position = 0; position < fp.size; ++position)
+    {
+        const auto &postings = m_index[indexKey(fp.data[position])];
+        if (postings.size() > maxPostings)
+            continue;
+        for (const auto &posting : postings)
+        {
+            const int offset = position - int(posting.position);
+            if (offset <= -m_maxoffset || offset >= m_maxoffset)
+                continue;
+            votes.push_back((uint64_t(posting.song) << 32) | uint32_t(offset + m_maxoffset));
+        }
+    }
+    std::sort(votes.begin(), votes.end());
+
+    std::vector<uint32_t> result;
+    for (size_t i = 0, j; i < votes.size(); i = j)
+    {
+        for (j = i + 1; j < votes.size() && votes[j] == votes[i]; ++j);
+        const uint32_t song = votes[i] >> 32;
+        if (j - i >= size_t(m_minVotes) && (result.empty() || result.back() != song))
+            result.push_back(song);
+    }
+    return result;
+}
+
+/* Return the index of songID in m_fingerprints, or its size if the song
+   wasn't added */
+size_t FingerprintManager::songIndex(long songID) const
 {
     auto it = std::lower_bound( m_fingerprints.begin(), m_fingerprints.end(), songID,
             [](auto x, auto y)
             { return x.first < y;
             });
-    if (it == m_fingerprints.end())
-        return std::vector<int>();
+    if (it == m_fingerprints.end() || it->first != songID)
+        return m_fingerprints.size();
+    return it - m_fingerprints.begin();
+}
+
+Fingerprint FingerprintManager::songFingerprint(long songID)
+{
+    const size_t song = songIndex(songID);
+    if (song == m_fingerprints.size())
+        return Fingerprint();
     else
+        return m_fingerprints[song].second;
+}
+
+/* Return the offset at which the song at index song1 of m_fingerprints is
+   expected to be similar to a song with silenceAtStart2 seconds of silence
+   at its start, or no_offset_hint if it's not known */
+int FingerprintManager::offsetHint(uint32_t song1, double silenceAtStart2) const
+{
+    const double silenceAtStart1 = m_silencesAtStart[song1];
+    if (m_offsetHintWindow < 0 || silenceAtStart1 < 0 || silenceAtStart2 < 0)
+        return no_offset_hint;
+    return std::lround((silenceAtStart2 - silenceAtStart1) * chromaprint_frames_per_second);
+}
+
+/* Return the fingerprint given as a list of ints, a buffer or None, in
+   which case the fingerprint of the song in the arena is used */
+Fingerprint FingerprintManager::fingerprintFromObject(long songID, const boost::python::object &fingerprint)
+{
+    if (fingerprint.is_none())
+    {
+        auto it = m_arena.find(songID);
+        if (it == m_arena.end())
+        {
+            PyErr_SetString(PyExc_KeyError, "Song is not in the fingerprint arena");
+            boost::python::throw_error_already_set();
+        }
         return it->second;
+    }
+    m_storage.push_back(fingerprint_to_vector(fingerprint));
+    return Fingerprint{m_storage.back().data(), int(m_storage.back().size())};
 }
 
-void FingerprintManager::addSong(long songID, boost::python::list &fingerprint)
+void FingerprintManager::addSong(long songID, const boost::python::object &fingerprint, double duration, double silenceAtStart)
 {
-    auto v = to_std_vector<int>(fingerprint);
-    v.insert(v.begin(), m_maxoffset, 0);
-    m_fingerprints.emplace_back(songID, std::move(v));
+    m_fingerprints.emplace_back(songID, fingerprintFromObject(songID, fingerprint));
+    m_durations.push_back(duration);
+    m_silencesAtStart.push_back(silenceAtStart);
+    addSongDuration(m_fingerprints.size() - 1, duration);
+    if (!m_index.empty())
+        indexSong(m_fingerprints.size() - 1);
 }
 
-boost::python::list FingerprintManager::addSongAndCompare(long songID, boost::python::list &fingerprint, double cancelThreshold)
+/* Add many songs at once. fingerprints contains the sub-fingerprints of
+   all the songs (in any format accepted by addSong), and offsets the
+   position at which the fingerprint of each song starts in it. Each one
+   ends where the next one starts. Songs must be sorted by id and their
+   durations and silences at start are optional */
+void FingerprintManager::addSongs(const boost::python::object &songIDs, const boost::python::object &offsets, const boost::python::object &fingerprints,
+                                  const boost::python::object &durations, const boost::python::object &silencesAtStart)
 {
-    std::mutex result_mutex;
-    boost::python::list result;
-    auto v = to_std_vector<int>(fingerprint);
-    v.insert(v.begin(), m_maxoffset, 0);
+    const std::vector<long> ids = to_std_vector<long>(songIDs);
+    const std::vector<long> starts = to_std_vector<long>(offsets);
+    std::vector<double> songDurations(ids.size(), -1), songSilences(ids.size(), -1);
+    if (!durations.is_none())
+        songDurations = to_std_vector<double>(durations);
+    if (!silencesAtStart.is_none())
+        songSilences = to_std_vector<double>(silencesAtStart);
+    if (starts.size() != ids.size() || songDurations.size() != ids.size() || songSilences.size() != ids.size())
+        raise_error(PyExc_ValueError, "All the arguments of addSongs must have one item per song");
+
+    std::vector<int> v = fingerprint_to_vector(fingerprints);
+    for (size_t i = 0; i < ids.size(); ++i)
+    {
+        const long end = i + 1 < starts.size() ? starts[i + 1] : long(v.size());
+        if (starts[i] < 0 || starts[i] > end || end > long(v.size()))
+            raise_error(PyExc_ValueError, "Invalid fingerprint offsets");
+    }
+    m_storage.push_back(std::move(v));
+    const std::vector<int> &data = m_storage.back();
 
-    __gnu_parallel::for_each(m_fingerprints.begin(), m_fingerprints.end(),
-        [&](const auto &itSong)
+    m_fingerprints.reserve(m_fingerprints.size() + ids.size());
+    for (size_t i = 0; i < ids.size(); ++i)
+    {
+        const long end = i + 1 < starts.size() ? starts[i + 1] : long(data.size());
+        m_fingerprints.emplace_back(ids[i], Fingerprint{data.data() + starts[i], int(end - starts[i])});
+        m_durations.push_back(songDurations[i]);
+        m_silencesAtStart.push_back(songSilences[i]);
+        addSongDuration(m_fingerprints.size() - 1, songDurations[i]);
+        if (!m_index.empty())
+            indexSong(m_fingerprints.size() - 1);
+    }
+}
+
+/* Return the sorted indexes of the songs among the first count ones in
+   m_fingerprints that a song with fingerprint fp and the given duration has
+   to be compared with */
+std::vector<uint32_t> FingerprintManager::songsToCompare(const Fingerprint &fp, double duration, size_t count, bool useIndex) const
+{
+    const bool knownDuration = m_durationWindow > 0 && duration >= 0;
+    auto inWindow = [&](uint32_t song)
         {
-            auto & [itSongID, itFingerprint] = itSong;
-            auto [offset, similarity] = compareChromaprintFingerprintsAndOffset(itFingerprint, v, cancelThreshold);
+            const double d = m_durations[song];
+            return d < 0 || std::abs(d - duration) <= m_durationWindow;
+        };
+    std::vector<uint32_t> songs;
+    if (useIndex && !m_index.empty())
+    {
+        songs = candidates(fp);
+        songs.erase(std::lower_bound(songs.begin(), songs.end(), count), songs.end());
+        if (knownDuration)
+            songs.erase(std::remove_if(songs.begin(), songs.end(),
+                                       [&](uint32_t song) { return !inWindow(song); }),
+                        songs.end());
+    }
+    else if (knownDuration)
+    {
+        const long bucket = durationBucket(duration);
+        for (long b = bucket - 1; b <= bucket + 1; ++b)
+        {
+            auto it = m_durationBuckets.find(b);
+            if (it == m_durationBuckets.end())
+                continue;
+            for (uint32_t song : it->second)
+                if (song < count && inWindow(song))
+                    songs.push_back(song);
+        }
+        for (uint32_t song : m_unknownDurations)
+            if (song < count)
+                songs.push_back(song);
+        std::sort(songs.begin(), songs.end());
+    }
+    else
+    {
+        songs.resize(count);
+        std::iota(songs.begin(), songs.end(), 0);
+    }
+    return songs;
+}
+
+/* Compare fp (of a song with silenceAtStart seconds of silence at its
+   start) with the songs at the given indexes of m_fingerprints and return
+   the similar ones sorted by index. It doesn't use any Python object so
+   it can run without the GIL */
+std::vector<Match> FingerprintManager::compareWithSongs(const Fingerprint &fp, double silenceAtStart, const std::vector<uint32_t> &songs, double cancelThreshold) const
+{
+    // Each thread stores its matches in its own buffer
+    std::vector<std::vector<Match>> buffers(std::max(omp_get_max_threads(), 1));
+
+    __gnu_parallel::for_each(songs.begin(), songs.end(),
+        [&](uint32_t song)
+        {
+            auto [offset, similarity] = compareChromaprintFingerprintsAndOffset(m_fingerprints[song].second, fp, cancelThreshold,
+                                                                                offsetHint(song, silenceAtStart));
             if (similarity > cancelThreshold)
-            {
-                result_mutex.lock();
-                result.append(boost::python::make_tuple(itSongID, offset, similarity));
-                result_mutex.unlock();
-            }
+                buffers[omp_get_thread_num()].push_back(Match{song, offset, similarity});
         }, __gnu_parallel::parallel_balanced);
-    m_fingerprints.emplace_back(songID, std::move(v));
+
+    std::vector<Match> result;
+    for (const auto &buffer : buffers)
+        result.insert(result.end(), buffer.begin(), buffer.end());
+    std::sort(result.begin(), result.end(),
+            [](const Match &x, const Match &y)
+            { return x.song < y.song;
+            });
     return result;
 }
 
-std::pair<int, double> FingerprintManager::compareChromaprintFingerprintsAndOffset(const std::vector<int> &fp1, const std::vector<int> &fp2, double cancelThreshold) const
+/* Return a list with the (songID, offset, similarity) of each match */
+boost::python::list FingerprintManager::matchesToList(const std::vector<Match> &matches) const
 {
-    std::vector<int>::const_iterator it1, it2;
-    int offset;
-    int total_idx;
-    int remaining;
-    int threshold_bits;
-    int equal_bits, total_bits;
+    boost::python::list result;
+    for (const auto &match : matches)
+        result.append(boost::python::make_tuple(m_fingerprints[match.song].first, match.offset, match.similarity));
+    return result;
+}
+
+boost::python::list FingerprintManager::addSongAndCompare(long songID, const boost::python::object &fingerprint, double cancelThreshold, double duration, double silenceAtStart)
+{
+    Fingerprint v = fingerprintFromObject(songID, fingerprint);
+    std::vector<Match> matches;
+    {
+        ScopedGILRelease release;
+        std::vector<uint32_t> songs = songsToCompare(v, duration, m_fingerprints.size(), true);
+        matches = compareWithSongs(v, silenceAtStart, songs, cancelThreshold);
+        m_fingerprints.emplace_back(songID, v);
+        m_durations.push_back(duration);
+        m_silencesAtStart.push_back(silenceAtStart);
+        addSongDuration(m_fingerprints.size() - 1, duration);
+        if (!m_index.empty())
+            indexSong(m_fingerprints.size() - 1);
+    }
+    return matchesToList(matches);
+}
+
+/* Compare an added song with all the songs added before it within the
+   duration window, without using the index. Used to check the results
+   obtained with the index */
+boost::python::list FingerprintManager::compareSongWithPrevious(long songID, double cancelThreshold)
+{
+    const size_t song = songIndex(songID);
+    if (song == m_fingerprints.size())
+        return boost::python::list();
+    const Fingerprint &fp = m_fingerprints[song].second;
+    std::vector<Match> matches;
+    {
+        ScopedGILRelease release;
+        std::vector<uint32_t> songs = songsToCompare(fp, m_durations[song], song, false);
+        matches = compareWithSongs(fp, m_silencesAtStart[song], songs, cancelThreshold);
+    }
+    return matchesToList(matches);
+}
+
+/* Return the ratio of equal bits between fp1 and fp2 delayed by offset
+   positions, or -1 if it's certain to be lower than cancelThreshold.
+   The first offset sub-fingerprints of fp1 are compared against zeros, as
+   if fp2 was padded at the beginning with offset zeros. */
+double FingerprintManager::similarityAtOffset(const Fingerprint &fp1, const Fingerprint &fp2, int offset, double cancelThreshold)
+{
+    const int total_idx = std::min(fp1.size, fp2.size + offset);
+    const int total_bits = total_idx * 32;
+    const int threshold_bits = total_bits * cancelThreshold;
+    const int padding = std::min(offset, total_idx);
+    int remaining = total_bits;
+    int equal_bits = 0;
+    int idx = 0;
+    for (; idx < padding; ++idx)
+    {
+        equal_bits += 32 - __builtin_popcount(fp1.data[idx]);
+        remaining -= 32;
+        if (equal_bits + remaining < threshold_bits)
+            return -1;
+    }
+    // equal_bits + remaining never increases, so checking it after each
+    // block cancels the same comparisons as checking it after each word
+    const xor_popcount_function xor_popcount = xor_popcount_kernel->function;
+    const int block_size = 64;
+    for (; idx < total_idx; idx += block_size)
+    {
+        const int n = std::min(block_size, total_idx - idx);
+        equal_bits += 32 * n - xor_popcount(fp1.data + idx, fp2.data + idx - offset, n);
+        remaining -= 32 * n;
+        if (equal_bits + remaining < threshold_bits)
+            return -1;
+    }
+    return equal_bits/(double)total_bits;
+}
+
+/* Estimate the result of similarityAtOffset using only one out of every
+   step sub-fingerprints */
+double FingerprintManager::sampledSimilarityAtOffset(const Fingerprint &fp1, const Fingerprint &fp2, int offset, int step)
+{
+    const int total_idx = std::min(fp1.size, fp2.size + offset);
+    if (total_idx <= 0)
+        return -1;
+    // Sub-fingerprints at the beginning of fp1 are compared against the
+    // zeros fp2 would be padded with
+    const int padding = std::min(offset, total_idx);
+    int different_bits = 0;
+    int idx = 0;
+    for (; idx < padding; idx += step)
+        different_bits += __builtin_popcount(fp1.data[idx]);
+    different_bits += xor_popcount_kernel->strided_function(fp1.data + idx, fp2.data + idx - offset, total_idx - idx, step);
+    const int sampled = (total_idx + step - 1) / step;
+    return 1 - different_bits/(32.0 * sampled);
+}
+
+std::pair<int, double> FingerprintManager::compareCoarseToFine(const Fingerprint &fp1, const Fingerprint &fp2, double cancelThreshold) const
+{
+    // Offsets are numbered in the order used by
+    // compareChromaprintFingerprintsAndOffset: 0 .. m_maxoffset-1 and then
+    // -1 .. -(m_maxoffset-1)
+    const int offsets = 2 * m_maxoffset - 1;
+    auto offset_at = [this](int k) { return k < m_maxoffset ? k : m_maxoffset - 1 - k; };
+    // Short fingerprints are sampled more densely so estimations aren't too
+    // noisy
+    const int min_samples = 32;
+    const int step = std::clamp(std::min(fp1.size, fp2.size) / min_samples, 1, m_coarseStep);
+    std::vector<std::pair<double, int>> estimations(offsets);
+    for (int k = 0; k < offsets; ++k)
+    {
+        const int offset = offset_at(k);
+        estimations[k].first = offset >= 0 ? sampledSimilarityAtOffset(fp2, fp1, offset, step)
+                                           : sampledSimilarityAtOffset(fp1, fp2, -offset, step);
+        estimations[k].second = k;
+    }
+    const int candidates = std::min(m_coarseCandidates, offsets);
+    std::partial_sort(estimations.begin(), estimations.begin() + candidates, estimations.end(),
+            [](const auto &x, const auto &y)
+            { return x.first > y.first || (x.first == y.first && x.second < y.second);
+            });
+    const double best_estimation = estimations[0].first;
+    // Check the candidates in the same order as the exhaustive search so
+    // ties are resolved in the same way
+    std::sort(estimations.begin(), estimations.begin() + candidates,
+            [](const auto &x, const auto &y)
+            { return x.second < y.second;
+            });
+
+    // Exact similarities are calculated with a lower threshold so results
+    // close to cancelThreshold are known
+    const double refineThreshold = cancelThreshold - m_coarseMargin;
+    std::vector<double> results(offsets, -2);
+    auto result_at = [&](int offset)
+    {
+        const int k = offset >= 0 ? offset : m_maxoffset - 1 - offset;
+        if (results[k] == -2)
+            results[k] = offset >= 0 ? similarityAtOffset(fp2, fp1, offset, refineThreshold)
+                                     : similarityAtOffset(fp1, fp2, -offset, refineThreshold);
+        return results[k];
+    };
+
     double best_result = -1;
     int best_offset = -1;
-    bool ok;
-    for (offset=0; offset < m_maxoffset; ++offset)
+    for (int i = 0; i < candidates; ++i)
     {
-//        std::cout << "offset " << offset << "----------" << std::endl;
-        it1 = fp1.cbegin() + (m_maxoffset - offset);
-        it2 = fp2.cbegin() + m_maxoffset;
-        ok = true;
-        equal_bits = 0;
-        total_idx = std::min(fp1.size()-m_maxoffset+offset, fp2.size()-m_maxoffset);
-//        std::cout << "total_idx " << total_idx << std::endl;
-        remaining = total_bits = total_idx * 32;
-        threshold_bits = total_bits * cancelThreshold;
-//        std::cout << "threshold " << threshold_bits << std::endl;
-        int idx=0;
-        for (; it1!=fp1.end() && it2!=fp2.end() ; ++it1, ++it2, ++idx)
+        const int offset = offset_at(estimations[i].second);
+        const double result = result_at(offset);
+        if (result > best_result)
         {
-//            std::cout << "(" << (idx-offset) << ") " << *it1 << " (" << idx << ") " << *it2 << std::endl;
-            equal_bits += 32 - __builtin_popcount(*it1 ^ *it2);
-            remaining -= 32;
-//            std::cout << "equal_bits " << equal_bits << "  remaining " << remaining << " threshold_bits " << threshold_bits << std::endl;
-            if (equal_bits + remaining < threshold_bits)
-            {
-                ok = false;
-//                std::cout << "break" << *it2 << std::endl;
-                break;
-            }
+            best_result = result;
+            best_offset = offset;
         }
-       if (ok)
-       {
-           double result = equal_bits/(double)total_bits;
-           if (result > best_result)
-           {
-               best_result = result;
-               best_offset = offset;
-           }
-       }
     }
-    for (offset=1; offset < m_maxoffset; ++offset)
+    // The similarity changes smoothly with the offset, so climb to the local
+    // maximum around the best candidate
+    for (bool improved = true; improved; )
     {
-//        std::cout << "offset " << offset << "----------" << std::endl;
-        it1 = fp1.cbegin() + m_maxoffset;
-        it2 = fp2.cbegin() + (m_maxoffset - offset);
-        ok = true;
-        equal_bits = 0;
-        total_idx = std::min(fp1.size()-m_maxoffset, fp2.size()-m_maxoffset+offset);
-//        std::cout << "total_idx " << total_idx << std::endl;
-        remaining = total_bits = total_idx * 32;
-        threshold_bits = total_bits * cancelThreshold;
-//        std::cout << "threshold " << threshold_bits << std::endl;
-        int idx = 0;
-        for (; it1!=fp1.end() && it2!=fp2.end() ; ++it1, ++it2, ++idx)
+        improved = false;
+        for (int offset : {best_offset - 1, best_offset + 1})
         {
-//            std::cout << "(" << (idx) << ") " << *it1 << " (" << idx-offset << ") " << *it2 << std::endl;
-            equal_bits += 32 - __builtin_popcount(*it1 ^ *it2);
-            remaining -= 32;
-//            std::cout << "equal_bits " << equal_bits << "  remaining " << remaining << " threshold_bits " << threshold_bits << std::endl;
-            if (equal_bits + remaining < threshold_bits)
-            {
-                ok = false;
-//                std::cout << "break" << *it2 << std::endl;
-                break;
-            }
-        }
-        if (ok)
-        {
-            double result = equal_bits/(double)total_bits;
+            if (offset <= -m_maxoffset || offset >= m_maxoffset)
+                continue;
+            const double result = result_at(offset);
             if (result > best_result)
             {
                 best_result = result;
-                best_offset = -offset;
+                best_offset = offset;
+                improved = true;
             }
         }
     }
+    // The estimations are noisy, so when the songs are close to being
+    // similar check all offsets to find the same result as the exhaustive
+    // search
+    if (best_result < cancelThreshold &&
+        (best_result >= refineThreshold || best_estimation >= cancelThreshold))
+        return compareAllOffsets(fp1, fp2, cancelThreshold);
+
     return std::make_pair(best_offset, best_result);
 }
 
-boost::python::list FingerprintManager::compareChromaprintFingerprintsAndOffsetVerbose(std::vector<int> fp1, std::vector<int> fp2) const
+/* Compare the offsets around offsetHint in the same order as
+   compareAllOffsets. The result is only valid if its similarity is higher
+   than cancelThreshold. It's not if the best offset is at the border of
+   the window, since offsets out of the window could be better */
+std::pair<int, double> FingerprintManager::compareAroundOffset(const Fingerprint &fp1, const Fingerprint &fp2, double cancelThreshold, int offsetHint) const
 {
-    std::vector<int>::const_iterator it1, it2;
-    boost::python::list result;
+    const int first = std::max(offsetHint - m_offsetHintWindow, -(m_maxoffset - 1));
+    const int last = std::min(offsetHint + m_offsetHintWindow, m_maxoffset - 1);
+    double best_result = -1;
+    int best_offset = -1;
+    for (int offset = std::max(first, 0); offset <= last; ++offset)
+    {
+        double result = similarityAtOffset(fp2, fp1, offset, cancelThreshold);
+        if (result > best_result)
+        {
+            best_result = result;
+            best_offset = offset;
+        }
+    }
+    for (int offset = std::min(last, -1); offset >= first; --offset)
+    {
+        double result = similarityAtOffset(fp1, fp2, -offset, cancelThreshold);
+        if (result > best_result)
+        {
+            best_result = result;
+            best_offset = offset;
+        }
+    }
+    if ((best_offset == first && first > -(m_maxoffset - 1)) ||
+        (best_offset == last && last < m_maxoffset - 1))
+        return std::make_pair(-1, -1.0);
+    return std::make_pair(best_offset, best_result);
+}
+
+std::pair<int, double> FingerprintManager::compareChromaprintFingerprintsAndOffset(const Fingerprint &fp1, const Fingerprint &fp2, double cancelThreshold, int offsetHint) const
+{
+    if (offsetHint != no_offset_hint)
+    {
+        auto result = compareAroundOffset(fp1, fp2, cancelThreshold, offsetHint);
+        if (result.second > cancelThreshold)
+            return result;
+    }
+    if (m_coarseStep > 0)
+        return compareCoarseToFine(fp1, fp2, cancelThreshold);
+    return compareAllOffsets(fp1, fp2, cancelThreshold);
+}
+
+std::pair<int, double> FingerprintManager::compareAllOffsets(const Fingerprint &fp1, const Fingerprint &fp2, double cancelThreshold) const
+{
+    double best_result = -1;
+    int best_offset = -1;
     int offset;
-    int equal_bits, total_bits;
     for (offset=0; offset < m_maxoffset; ++offset)
     {
-        it1 = fp1.cbegin() + (m_maxoffset - offset);
-        it2 = fp2.cbegin() + m_maxoffset;
-        total_bits = std::min(fp1.size()-m_maxoffset+offset, fp2.size()-m_maxoffset) * 32;
-        equal_bits = 0;
-        for (; it1!=fp1.end() && it2!=fp2.end() ; ++it1, ++it2)
+        double result = similarityAtOffset(fp2, fp1, offset, cancelThreshold);
+        if (result > best_result)
         {
-            equal_bits += 32 - __builtin_popcount(*it1 ^ *it2);
+            best_result = result;
+            best_offset = offset;
         }
-        result.append(boost::python::make_tuple(offset, equal_bits/(double)total_bits));
     }
     for (offset=1; offset < m_maxoffset; ++offset)
     {
-        it1 = fp1.cbegin() + m_maxoffset;
-        it2 = fp2.cbegin() + (m_maxoffset - offset);
-        total_bits = std::min(fp1.size()-m_maxoffset, fp2.size()-m_maxoffset+offset) * 32;
-        equal_bits = 0;
-        for (; it1!=fp1.end() && it2!=fp2.end() ; ++it1, ++it2)
+        double result = similarityAtOffset(fp1, fp2, offset, cancelThreshold);
+        if (result > best_result)
         {
-            equal_bits += 32 - __builtin_popcount(*it1 ^ *it2);
+            best_result = result;
+            best_offset = -offset;
         }
-        result.append(boost::python::make_tuple(-offset, equal_bits/(double)total_bits));
+    }
+    return std::make_pair(best_offset, best_result);
+}
+
+boost::python::list FingerprintManager::compareChromaprintFingerprintsAndOffsetVerbose(const Fingerprint &fp1, const Fingerprint &fp2) const
+{
+    boost::python::list result;
+    int offset;
+    for (offset=0; offset < m_maxoffset; ++offset)
+    {
+        result.append(boost::python::make_tuple(offset, similarityAtOffset(fp2, fp1, offset, 0)));
+    }
+    for (offset=1; offset < m_maxoffset; ++offset)
+    {
+        result.append(boost::python::make_tuple(-offset, similarityAtOffset(fp1, fp2, offset, 0)));
     }
     return result;
 }
 
 std::pair<int, double> FingerprintManager::compareSongs(long songID1, long songID2, double cancelThreshold)
 {
-    return compareChromaprintFingerprintsAndOffset(songFingerprint(songID1), songFingerprint(songID2), cancelThreshold);
+    const size_t song1 = songIndex(songID1), song2 = songIndex(songID2);
+    if (song1 == m_fingerprints.size() || song2 == m_fingerprints.size())
+        return compareChromaprintFingerprintsAndOffset(Fingerprint(), Fingerprint(), cancelThreshold);
+    return compareChromaprintFingerprintsAndOffset(m_fingerprints[song1].second, m_fingerprints[song2].second, cancelThreshold,
+                                                   offsetHint(song1, m_silencesAtStart[song2]));
 }
 
 boost::python::list FingerprintManager::compareSongsVerbose(long songID1, long songID2)
@@ -272,14 +1168,43 @@ boost::python::list FingerprintManager::compareSongsVerbose(long songID1, long s
     return compareChromaprintFingerprintsAndOffsetVerbose(songFingerprint(songID1), songFingerprint(songID2));
 }
 
+/* Convert pairs returned to python to tuples */
+template <typename T1, typename T2>
+struct pair_to_tuple
+{
+    static PyObject *convert(const std::pair<T1, T2> &pair)
+    {
+        return boost::python::incref(boost::python::make_tuple(pair.first, pair.second).ptr());
+    }
+};
+
+BOOST_PYTHON_MEMBER_FUNCTION_OVERLOADS(addSong_overloads, addSong, 2, 4)
+BOOST_PYTHON_MEMBER_FUNCTION_OVERLOADS(addSongAndCompare_overloads, addSongAndCompare, 2, 5)
+BOOST_PYTHON_MEMBER_FUNCTION_OVERLOADS(addSongs_overloads, addSongs, 3, 5)
+
 BOOST_PYTHON_MODULE(bard_ext)
 {
     using namespace boost::python;
     def("greet", greet<int>);
     def("greet2", greet2);
-    class_<FingerprintManager>("FingerprintManager")
-        .def("addSong", &FingerprintManager::addSong)
-        .def("addSongAndCompare", &FingerprintManager::addSongAndCompare)
+    def("xorPopcountKernel", xorPopcountKernel);
+    def("xorPopcountKernels", xorPopcountKernels);
+    def("setXorPopcountKernel", setXorPopcountKernel);
+    def("xorPopcount", xorPopcount, xorPopcount_overloads());
+    setXorPopcountKernel("");
+    to_python_converter<std::pair<int, double>, pair_to_tuple<int, double>>();
+    class_<FingerprintManager, boost::noncopyable>("FingerprintManager")
+        .def("openArena", &FingerprintManager::openArena)
+        .def("isInArena", &FingerprintManager::isInArena)
+        .def("arenaFingerprintLength", &FingerprintManager::arenaFingerprintLength)
+        .def("enableIndex", &FingerprintManager::enableIndex)
+        .def("setCoarseSearch", &FingerprintManager::setCoarseSearch)
+        .def("setDurationWindow", &FingerprintManager::setDurationWindow)
+        .def("setOffsetHintWindow", &FingerprintManager::setOffsetHintWindow)
+        .def("addSong", &FingerprintManager::addSong, addSong_overloads())
+        .def("addSongs", &FingerprintManager::addSongs, addSongs_overloads())
+        .def("addSongAndCompare", &FingerprintManager::addSongAndCompare, addSongAndCompare_overloads())
+        .def("compareSongWithPrevious", &FingerprintManager::compareSongWithPrevious)
         .def("compareSongs", &FingerprintManager::compareSongs)
         .def("compareSongsVerbose", &FingerprintManager::compareSongsVerbose)
         .def("setMaxOffset", &FingerprintManager::setMaxOffset)
@@ -287,5 +1212,3 @@ BOOST_PYTHON_MODULE(bard_ext)
         .def("setExpectedSize", &FingerprintManager::setExpectedSize)
         .def("size", &FingerprintManager::size);
 }
-
-
@@ -22,3 +22,16 @@ config = readConfiguration()
 
 if 'username' not in config:
     config['username'] = pwd.getpwuid(os.getuid()).pw_name
+
+defaults = {'queryCache': False,
+            'queryCachePath': '~/.cache/bard/querycache.db',
+            'queryCacheSize': 64,
+            'snapshotMaxMemory': 1024,
+            'shardedDatabase': False,
+            'similaritiesMinScore': 0.58,
+            'similaritiesTopK': 0,
+            'fingerprintArenaPath': None}
+
+for key, value in defaults.items():
+    if key not in config:
+        config[key] = value
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from contextlib import contextmanager
+
+
+class ConnectionManager:
+    """Hand out sqlite connections to the threads using the database.
+
+    There's a single writer connection which is used by the thread that
+    created the manager and by any thread inside a writing() block, so
+    writes from different threads are serialized with a lock. Every other
+    thread gets its own read-only connection, created on first use with
+    the connect function.
+    """
+
+    def __init__(self, connect, writer=None):
+        """Create a ConnectionManager.
+
+        connect is a function returning a new configured connection. If
+        writer is not given, one is created with connect. If connect is
+        None, all threads share the writer connection.
+        """
+        self.connect = connect
+        self.writer = writer if writer is not None else connect()
+        self.writerThread = threading.get_ident()
+        self.writeLock = threading.RLock()
+        self.local = threading.local()
+        self.readers = []
+        self.readersLock = threading.Lock()
+
+    def connection(self):
+        """Return the connection the current thread should use."""
+        if threading.get_ident() == self.writerThread or \
+           getattr(self.local, 'writing', 0) or self.connect is None:
+            return self.writer
+        try:
+            return self.local.reader
+        except AttributeError:
+            pass
+        self.local.reader = self.connect()
+        self.local.reader.execute('pragma query_only = ON')
+        with self.readersLock:
+            self.readers.append(self.local.reader)
+        return self.local.reader
+
+    @contextmanager
+    def writing(self):
+        """Use the writer connection in this thread during the block."""
+        with self.writeLock:
+            self.local.writing = getattr(self.local, 'writing', 0) + 1
+            try:
+                yield self.writer
+            finally:
+                self.local.writing -= 1
+
+    def close(self):
+        with self.readersLock:
+            for reader in self.readers:
+                reader.close()
+            self.readers = []
+        self.writer.close()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import os
+import fcntl
+import struct
+
+
+class FingerprintArena:
+    """Append-only files with the decoded fingerprints of songs.
+
+    The sub-fingerprints of all songs are stored contiguously as uint32 in
+    little endian in path. path + '.idx' contains a header followed by a
+    (song id, offset, length) record for each fingerprint, with offset and
+    length counted in sub-fingerprints. When a song is appended more than
+    once, its last record is the valid one. FingerprintManager.openArena
+    maps both files in memory so fingerprints don't need to be loaded
+    from the database.
+    """
+
+    magic = b'BARDFPA1'
+    record = struct.Struct('<qqq')
+
+    def __init__(self, path):
+        self.path = path
+        self.indexPath = path + '.idx'
+
+    def append(self, fingerprints):
+        """Append a list of (song id, decoded fingerprint) to the arena.
+
+        Decoded fingerprints are bytes as returned by decodeFingerprint.
+        """
+        if not fingerprints:
+            return
+        with open(self.indexPath, 'ab') as index, \
+                open(self.path, 'ab') as data:
+            # Serialize writers from different processes
+            fcntl.flock(index, fcntl.LOCK_EX)
+            indexSize = index.seek(0, os.SEEK_END)
+            if indexSize < len(self.magic):
+                index.truncate(0)
+                index.write(self.magic)
+            else:
+                # Drop a partial record left by an interrupted write
+                extra = (indexSize - len(self.magic)) % self.record.size
+                if extra:
+                    index.truncate(indexSize - extra)
+            size = data.seek(0, os.SEEK_END)
+            if size % 4:
+                data.write(b'\0' * (4 - size % 4))
+                size += 4 - size % 4
+            offset = size // 4
+            records = []
+            for songID, fingerprint in fingerprints:
+                data.write(fingerprint)
+                length = len(fingerprint) // 4
+                records.append(self.record.pack(songID, offset, length))
+                offset += length
+            # Records must never point to data that isn't written yet
+            data.flush()
+            index.write(b''.join(records))
+
+    def remove(self):
+        """Remove the arena files."""
+        for path in (self.path, self.indexPath):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
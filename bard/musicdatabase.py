@@ -1,13 +1,25 @@
 # -*- coding: utf-8 -*-
 
 from bard.config import config
-from bard.normalizetags import normalizeTagValues
+from bard.normalizetags import normalizeTagValues, normalizeGenres
+from bard.querycache import QueryCache
+from bard.connectionmanager import ConnectionManager
+from bard.fingerprintarena import FingerprintArena
+from contextlib import contextmanager
 import sqlite3
+import shlex
+import uuid
+import time
 import os
 import re
 import mutagen
 
 
+# Maximum number of song ids bound in a single "IN (...)" query.
+# This is kept below SQLITE_MAX_VARIABLE_NUMBER of old sqlite versions (999)
+maxIDsPerQuery = 900
+
+
 def toString(v):
     if isinstance(v, list):
         return ', '.join(v)
@@ -15,30 +27,414 @@ def toString(v):
     return v
 
 
-class MusicDatabase:
-    conn = None
+def inChunks(seq, size=maxIDsPerQuery):
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def songPropertiesFromRow(row):
+    info = type('info', (), {})()
+
+    info.length = row['duration']
+    info.bitrate = row['bitrate']
+    info.bits_per_sample = row['bits_per_sample']
+    info.sample_rate = row['sample_rate']
+    info.channels = row['channels']
+
+    return row['format'], info, row['audio_sha256sum'], \
+        (row['silence_at_start'], row['silence_at_end'])
+
+
+def prefixUpperBound(prefix):
+    """Return the smallest string greater than all strings starting by prefix.
+
+    This allows to match a path prefix with "path >= ? AND path < ?" which
+    (unlike LIKE) can use the index on songs.path. Returns None if there's
+    no such string (i.e. for an empty prefix), so there's no upper bound.
+    """
+    # The last character can't be incremented past the maximum code point
+    prefix = prefix.rstrip('\U0010ffff')
+    if not prefix:
+        return None
+    code = ord(prefix[-1]) + 1
+    if 0xd800 <= code <= 0xdfff:
+        # Skip the surrogates, which can't be encoded as UTF-8
+        code = 0xe000
+    return prefix[:-1] + chr(code)
+
+
+class MusicDatabaseType(type):
+    @property
+    def conn(cls):
+        """Connection to the database to be used in the current thread."""
+        if cls.connections is None:
+            return None
+        return cls.connections.connection()
+
+    @conn.setter
+    def conn(cls, conn):
+        if conn is None:
+            cls.connections = None
+        else:
+            cls.connections = ConnectionManager(None, writer=conn)
+
+
+class MusicDatabase(metaclass=MusicDatabaseType):
+    connections = None
     mtime_cache_by_path = {}
     mtime_cache_by_id = {}
+    tag_name_ids = {}
+    genre_ids = {}
+    # Version of the schema created by createDatabase + upgradeDatabase.
+    # Each version N > 0 is created by the upgradeToVersionN method.
+    schemaVersion = 13
+    hasPathSubstringIndex = False
+    hasSearchIndex = False
+    queryCache = None
+    # Identifies this database in the keys of the query cache
+    cacheNamespace = ''
+    fingerprintArena = None
+    # (song id, decoded fingerprint) to append to the arena on commit
+    pendingArenaFingerprints = []
+    # (id, root, path) of the attached databases of each root
+    shards = []
+    # Tables that are stored in the database of each root
+    shardedTables = ['songs', 'properties', 'covers', 'checksums',
+                     'fingerprints', 'tag_names', 'tags', 'genres',
+                     'song_genres']
+    # Minimum id of songs, tag names and genres in this database
+    idBase = 0
+    # Value of conn.total_changes when the last transaction was committed
+    committedChanges = 0
+    # Song fields indexed in songs_fts to search songs
+    searchColumns = ['title', 'artist', 'album', 'albumartist', 'genre']
+    # Tag names containing the MusicBrainz track id of a song
+    musicBrainzTrackIDTags = ['%musicbrainz_trackid',
+                              'UFID:http://musicbrainz.org',
+                              '%MusicBrainz Track Id',
+                              '%MusicBrainz/Track Id']
+
+    def __init__(self, ro=False, snapshot=False, snapshotMaxMemory=None,
+                 root=None):
+        """Create a MusicDatabase object.
 
-    def __init__(self, ro=False):
-        """Create a MusicDatabase object."""
+        If snapshot is True, the database is opened read-only from a
+        private copy loaded in memory. An exception is raised if it's
+        larger than snapshotMaxMemory bytes.
+
+        With the shardedDatabase option, the songs of each root are stored
+        in their own database file. If root is given, only the database of
+        that root is opened (and created if needed). Otherwise, the catalog
+        database is opened with all the root databases attached read-only.
+        """
         _databasepath = config['databasePath']
         databasepath = os.path.expanduser(os.path.expandvars(_databasepath))
         if not os.path.isdir(os.path.dirname(databasepath)):
             os.makedirs(os.path.dirname(databasepath))
+        # The roots of a sharded database share the arena
+        arenaPath = (config['fingerprintArenaPath'] or
+                     os.path.splitext(databasepath)[0] + '.fingerprints')
+        MusicDatabase.fingerprintArena = \
+            FingerprintArena(os.path.expanduser(arenaPath))
+        MusicDatabase.pendingArenaFingerprints = []
+        if snapshot:
+            ro = True
+        shardID = None
+        shards = []
+        pragmas = []
+        MusicDatabase.shards = []
+        if config['shardedDatabase']:
+            if snapshot:
+                raise Exception("Snapshots of sharded databases are not "
+                                "supported")
+            if root is not None:
+                shardID, databasepath = self.getShard(databasepath, root, ro)
+            else:
+                shards = self.getShards(databasepath)
+                if not ro:
+                    self.upgradeShards(shards)
+                # Similarities and ratings stored in the catalog refer to
+                # songs in the attached databases
+                pragmas = ['foreign_keys=OFF']
+
+        MusicDatabase.tag_name_ids = {}
+        MusicDatabase.genre_ids = {}
+        MusicDatabase.idBase = 0
         if not os.path.isfile(databasepath):
             if ro:
                 raise Exception("Database doesn't exist and read-only was "
                                 "requested")
-            MusicDatabase.conn = sqlite3.connect(databasepath)
+            uri = 'file:' + databasepath
+            MusicDatabase.connections = ConnectionManager(
+                lambda: MusicDatabase.connect(uri))
+            if root is None:
+                # Song ids in an old arena would refer to other songs
+                MusicDatabase.fingerprintArena.remove()
             self.createDatabase()
+        elif snapshot:
+            MusicDatabase.connections = self.openSnapshot(databasepath,
+                                                          snapshotMaxMemory)
         else:
             uri = 'file:' + databasepath
             if ro:
                 uri += '?mode=ro'
-            MusicDatabase.conn = sqlite3.connect(uri, uri=True)
-        MusicDatabase.conn.execute('pragma foreign_keys=ON')
-        MusicDatabase.conn.row_factory = sqlite3.Row
+            MusicDatabase.connections = ConnectionManager(
+                lambda: MusicDatabase.connect(uri, pragmas))
+        self.upgradeDatabase(ro)
+        if shardID is not None and not ro:
+            MusicDatabase.initializeShard(shardID)
+        if shards:
+            # Attach them after upgrading the catalog so the views don't
+            # hide its tables to the upgrade code
+            MusicDatabase.shards = shards
+            MusicDatabase.attachShards(MusicDatabase.connections.writer,
+                                       shards)
+        MusicDatabase.idBase = MusicDatabase.getState('shard_id', 0) << 40
+
+        if MusicDatabase.shards:
+            # The full-text indexes can't be queried through the views
+            MusicDatabase.hasPathSubstringIndex = False
+            MusicDatabase.hasSearchIndex = False
+        else:
+            MusicDatabase.hasPathSubstringIndex = \
+                MusicDatabase.tableExists('songs_path_fts')
+            MusicDatabase.hasSearchIndex = \
+                MusicDatabase.tableExists('songs_fts')
+
+        if config['queryCache']:
+            MusicDatabase.queryCache = \
+                QueryCache(config['queryCachePath'],
+                           config['queryCacheSize'] * 1024 * 1024)
+            # The cache is shared by all databases and their generations
+            # start at 0, so results are also keyed by database
+            MusicDatabase.cacheNamespace = '%s:%s' % (
+                os.path.realpath(databasepath),
+                MusicDatabase.getState('database_id', ''))
+        MusicDatabase.committedChanges = MusicDatabase.conn.total_changes
+
+    @staticmethod
+    def connectToCatalog(databasepath):
+        conn = sqlite3.connect(databasepath)
+        conn.execute('''
+CREATE TABLE IF NOT EXISTS shards(
+                  id INTEGER PRIMARY KEY,
+                  root TEXT UNIQUE,
+                  path TEXT
+                  )''')
+        conn.commit()
+        # Songs stored in the catalog itself would be hidden by the views
+        # over the databases of each root
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                        "AND name = 'songs'").fetchone() and \
+           conn.execute('SELECT 1 FROM songs LIMIT 1').fetchone():
+            conn.close()
+            raise Exception("The database has songs that aren't stored in "
+                            "the database of a root. The shardedDatabase "
+                            "option can't be used with it")
+        return conn
+
+    @staticmethod
+    def getShard(databasepath, root, ro=False):
+        """Return the (id, path) of the database that stores root songs."""
+        conn = MusicDatabase.connectToCatalog(databasepath)
+        # Different spellings of the same directory share the database.
+        # Catalogs created before roots were normalized store them as given
+        realRoot = os.path.realpath(os.path.expanduser(root))
+        result = conn.execute('SELECT id, path FROM shards WHERE root IN '
+                              '(?, ?) ORDER BY id',
+                              (realRoot, root)).fetchone()
+        if not result:
+            root = realRoot
+            if ro:
+                raise Exception("There's no database for root %s" % root)
+            c = conn.cursor()
+            c.execute('INSERT INTO shards(root) VALUES (?)', (root,))
+            path = os.path.join(os.path.dirname(databasepath), 'shards',
+                                '%d.db' % c.lastrowid)
+            c.execute('UPDATE shards SET path = ? WHERE id = ?',
+                      (path, c.lastrowid))
+            conn.commit()
+            result = (c.lastrowid, path)
+        conn.close()
+        if not os.path.isdir(os.path.dirname(result[1])):
+            os.makedirs(os.path.dirname(result[1]))
+        return result
+
+    @staticmethod
+    def getShards(databasepath):
+        """Return the (id, root, path) of the databases of each root."""
+        if not os.path.isfile(databasepath):
+            return []
+        conn = MusicDatabase.connectToCatalog(databasepath)
+        result = conn.execute('SELECT id, root, path FROM shards '
+                              'ORDER BY id').fetchall()
+        conn.close()
+        return result
+
+    @staticmethod
+    def upgradeShards(shards):
+        """Upgrade the schema of the databases of each root if needed."""
+        for shardID, root, path in shards:
+            conn = sqlite3.connect(path)
+            version = conn.execute('pragma user_version').fetchone()[0]
+            conn.close()
+            if version < MusicDatabase.schemaVersion:
+                print('Upgrading database of %s' % root)
+                MusicDatabase(root=root)
+                MusicDatabase.connections.close()
+
+    @staticmethod
+    def initializeShard(shardID):
+        """Make the ids generated in the database of a root unique.
+
+        Ids of songs, tag names and genres start at shardID << 40 so they
+        don't collide with the ones of other roots.
+        """
+        c = MusicDatabase.conn.cursor()
+        if MusicDatabase.getState('shard_id') is not None:
+            return
+        c.execute("INSERT INTO state(name, value) VALUES ('shard_id', ?)",
+                  (shardID,))
+        c.execute("INSERT INTO sqlite_sequence(name, seq) "
+                  "SELECT 'songs', ? WHERE NOT EXISTS "
+                  "(SELECT 1 FROM sqlite_sequence WHERE name = 'songs')",
+                  (shardID << 40,))
+        MusicDatabase.conn.commit()
+
+    @staticmethod
+    def attachShards(conn, shards):
+        """Attach the databases of each root and create views over them.
+
+        The temporary views have the names of the tables and take
+        precedence over the (empty) tables in the catalog database, so the
+        same queries work on the union of all the roots.
+        """
+        maxAttached = conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+        if len(shards) > maxAttached:
+            raise Exception('There are %d root databases but sqlite can '
+                            'only attach %d' % (len(shards), maxAttached))
+        for shardID, root, path in shards:
+            conn.execute('ATTACH DATABASE ? AS shard%d' % shardID,
+                         ('file:%s?mode=ro' % path,))
+
+        def union(table, columns='*'):
+            return ' UNION ALL '.join('SELECT %s FROM shard%d.%s' %
+                                      (columns, shardID, table)
+                                      for shardID, root, path in shards)
+
+        for table in MusicDatabase.shardedTables:
+            conn.execute('CREATE TEMP VIEW %s AS %s' % (table, union(table)))
+        conn.execute('CREATE TEMP VIEW statistics AS '
+                     'SELECT name, SUM(value) AS value FROM (%s) '
+                     'GROUP BY name' % union('statistics'))
+        conn.execute('CREATE TEMP VIEW format_statistics AS '
+                     'SELECT format, SUM(songs) AS songs, '
+                     'SUM(duration) AS duration FROM (%s) '
+                     'GROUP BY format' % union('format_statistics'))
+        conn.execute('CREATE TEMP VIEW audio_hashes AS '
+                     'SELECT audio_sha256sum, SUM(songs) AS songs FROM (%s) '
+                     'GROUP BY audio_sha256sum' % union('audio_hashes'))
+        conn.execute("CREATE TEMP VIEW state AS "
+                     "SELECT name, SUM(value) AS value FROM "
+                     "(SELECT * FROM main.state UNION ALL %s) "
+                     "WHERE name = 'generation' GROUP BY name "
+                     "UNION ALL SELECT name, value FROM main.state "
+                     "WHERE name != 'generation'" % union('state'))
+
+    @staticmethod
+    def detachShards():
+        """Detach the databases of each root from the catalog."""
+        conn = MusicDatabase.connections.writer
+        for table in MusicDatabase.shardedTables + \
+                ['statistics', 'format_statistics', 'audio_hashes', 'state']:
+            conn.execute('DROP VIEW IF EXISTS temp.%s' % table)
+        for shardID, root, path in MusicDatabase.shards:
+            conn.execute('DETACH DATABASE shard%d' % shardID)
+        MusicDatabase.shards = []
+
+    @staticmethod
+    def removeOrphanedSongData():
+        """Remove similarities and ratings of songs that were removed.
+
+        With the shardedDatabase option they're stored in the catalog
+        database so they're not removed by foreign keys.
+        """
+        c = MusicDatabase.conn.cursor()
+        c.execute('DELETE FROM main.similarities '
+                  'WHERE song_id1 NOT IN (SELECT id FROM songs) '
+                  '   OR song_id2 NOT IN (SELECT id FROM songs)')
+        c.execute('DELETE FROM main.ratings '
+                  'WHERE song_id NOT IN (SELECT id FROM songs)')
+
+    @staticmethod
+    def connect(uri, pragmas=[]):
+        """Open and configure a new connection to the database at uri."""
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        MusicDatabase.configureConnection(conn, pragmas)
+        if MusicDatabase.shards:
+            MusicDatabase.attachShards(conn, MusicDatabase.shards)
+        return conn
+
+    @staticmethod
+    def configureConnection(conn, pragmas=[]):
+        for pragma in ['foreign_keys=ON'] + pragmas:
+            conn.execute('pragma ' + pragma)
+        conn.row_factory = sqlite3.Row
+
+    @staticmethod
+    def openSnapshot(databasepath, maxMemory=None):
+        """Return a ConnectionManager to a snapshot of the database.
+
+        The whole database is copied in memory with the backup API, so
+        it must fit in maxMemory bytes.
+        """
+        source = sqlite3.connect('file:' + databasepath + '?mode=ro',
+                                 uri=True)
+        pageSize = source.execute('pragma page_size').fetchone()[0]
+        pageCount = source.execute('pragma page_count').fetchone()[0]
+        size = pageSize * pageCount
+        if maxMemory is not None and size > maxMemory:
+            source.close()
+            raise Exception('Database size (%d MB) is larger than the '
+                            'snapshot memory limit (%d MB)' %
+                            (size // (1024 * 1024),
+                             maxMemory // (1024 * 1024)))
+        pragmas = ['query_only=ON']
+        # The shared cache lets other threads open their own
+        # connection to the same in-memory database
+        uri = 'file:bard-snapshot-%d?mode=memory&cache=shared' % os.getpid()
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        source.backup(conn)
+        source.close()
+        MusicDatabase.configureConnection(conn, pragmas)
+        return ConnectionManager(
+            lambda: MusicDatabase.connect(uri, pragmas), writer=conn)
+
+    @staticmethod
+    @contextmanager
+    def transaction():
+        """Run a block of code in a transaction of the writer connection.
+
+        This must be used to modify the database from threads other than
+        the one that opened it. The transaction is committed at the end of
+        the block or rolled back if an exception is raised.
+        """
+        with MusicDatabase.connections.writing():
+            try:
+                yield MusicDatabase.conn
+            except BaseException:
+                MusicDatabase.conn.rollback()
+                MusicDatabase.pendingArenaFingerprints.clear()
+                raise
+            MusicDatabase.commit()
+
+    @staticmethod
+    def tableExists(name):
+        c = MusicDatabase.conn.cursor()
+        result = c.execute("SELECT 1 FROM sqlite_master WHERE name = ?",
+                           (name,))
+        return result.fetchone() is not None
 
     def createDatabase(self):
         if config['immutableDatabase']:
@@ -46,6 +442,8 @@ class MusicDatabase:
                   "The database is configured as immutable")
             return
         c = MusicDatabase.conn.cursor()
+        # Let db-maintain return free pages without a full VACUUM
+        c.execute('pragma auto_vacuum = INCREMENTAL')
         c.execute('''
 CREATE TABLE songs (
                     id INTEGER PRIMARY KEY ASC AUTOINCREMENT,
@@ -129,6 +527,467 @@ CREATE TABLE similarities(
                   FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE
                   )''')
 
+    def upgradeDatabase(self, ro=False):
+        c = MusicDatabase.conn.cursor()
+        version = c.execute('pragma user_version').fetchone()[0]
+        if version >= MusicDatabase.schemaVersion:
+            return
+        if ro:
+            raise Exception("Database needs to be upgraded and read-only was "
+                            "requested")
+        if config['immutableDatabase']:
+            print("Error: Can't upgrade database: "
+                  "The database is configured as immutable")
+            return
+
+        for v in range(version + 1, MusicDatabase.schemaVersion + 1):
+            print('Upgrading database to schema version %d' % v)
+            getattr(self, 'upgradeToVersion%d' % v)(c)
+            c.execute('pragma user_version = %d' % v)
+            MusicDatabase.conn.commit()
+        MusicDatabase.increaseGeneration()
+        MusicDatabase.conn.commit()
+
+    def upgradeToVersion1(self, c):
+        """Add indexes to search songs by path prefix and substring."""
+        c.execute('CREATE INDEX IF NOT EXISTS songs_path_idx ON songs(path)')
+        try:
+            c.execute('''
+CREATE VIRTUAL TABLE songs_path_fts USING fts5(
+                  path,
+                  content='songs',
+                  content_rowid='id',
+                  tokenize='trigram'
+                  )''')
+        except sqlite3.OperationalError as e:
+            print('Path substring index not available '
+                  '(sqlite >= 3.34 with FTS5 is needed):', e)
+            return
+        c.execute('''
+CREATE TRIGGER songs_path_fts_insert AFTER INSERT ON songs BEGIN
+    INSERT INTO songs_path_fts(rowid, path) VALUES (new.id, new.path);
+END''')
+        c.execute('''
+CREATE TRIGGER songs_path_fts_delete AFTER DELETE ON songs BEGIN
+    INSERT INTO songs_path_fts(songs_path_fts, rowid, path)
+         VALUES ('delete', old.id, old.path);
+END''')
+        c.execute('''
+CREATE TRIGGER songs_path_fts_update AFTER UPDATE OF path ON songs BEGIN
+    INSERT INTO songs_path_fts(songs_path_fts, rowid, path)
+         VALUES ('delete', old.id, old.path);
+    INSERT INTO songs_path_fts(rowid, path) VALUES (new.id, new.path);
+END''')
+        c.execute("INSERT INTO songs_path_fts(songs_path_fts) "
+                  "VALUES ('rebuild')")
+
+    def upgradeToVersion2(self, c):
+        """Add a full-text search index over the main song tags."""
+        columns = ', '.join(MusicDatabase.searchColumns)
+        for tokenizer in ('trigram', 'unicode61'):
+            try:
+                c.execute("CREATE VIRTUAL TABLE songs_fts USING fts5(%s, "
+                          "tokenize='%s')" % (columns, tokenizer))
+                break
+            except sqlite3.OperationalError as e:
+                error = e
+        else:
+            print('Full-text search index not available '
+                  '(sqlite with FTS5 is needed):', error)
+            return
+        c.execute('INSERT INTO songs_fts(rowid, %s) '
+                  'SELECT id, %s FROM songs' % (columns, columns))
+
+    def upgradeToVersion3(self, c):
+        """Store tag names in a tag_names table referenced from tags."""
+        c.execute('''
+CREATE TABLE tag_names(
+                  id INTEGER PRIMARY KEY,
+                  name TEXT UNIQUE
+                  )''')
+        c.execute('INSERT INTO tag_names(name) '
+                  'SELECT DISTINCT name FROM tags WHERE name IS NOT NULL')
+        c.execute('''
+CREATE TABLE tags_new(
+                  song_id INTEGER,
+                  name_id INTEGER,
+                  pos INTEGER,
+                  value TEXT,
+                  PRIMARY KEY(song_id, name_id, pos),
+                  FOREIGN KEY(song_id) REFERENCES songs(id) ON DELETE CASCADE,
+                  FOREIGN KEY(name_id) REFERENCES tag_names(id)
+                  ) WITHOUT ROWID''')
+        c.execute('''
+INSERT INTO tags_new(song_id, name_id, pos, value)
+     SELECT song_id, tag_names.id,
+            row_number() OVER (PARTITION BY song_id, tag_names.id
+                               ORDER BY tags.rowid) - 1,
+            value
+       FROM tags, tag_names
+      WHERE tags.name = tag_names.name
+        AND song_id IS NOT NULL''')
+        c.execute('DROP TABLE tags')
+        c.execute('ALTER TABLE tags_new RENAME TO tags')
+        c.execute('CREATE INDEX tags_name_id_idx ON tags(name_id)')
+
+    def upgradeToVersion4(self, c):
+        """Add a song_genres table with the normalized genres of songs."""
+        c.execute('''
+CREATE TABLE genres(
+                  id INTEGER PRIMARY KEY,
+                  name TEXT UNIQUE COLLATE NOCASE
+                  )''')
+        c.execute('''
+CREATE TABLE song_genres(
+                  song_id INTEGER,
+                  genre_id INTEGER,
+                  PRIMARY KEY(song_id, genre_id),
+                  FOREIGN KEY(song_id) REFERENCES songs(id) ON DELETE CASCADE,
+                  FOREIGN KEY(genre_id) REFERENCES genres(id)
+                  ) WITHOUT ROWID''')
+        c.execute('CREATE INDEX song_genres_genre_idx '
+                  'ON song_genres(genre_id, song_id)')
+
+        nameIDs = MusicDatabase.tagNameIDsCondition(['genre', 'TCON'])
+        result = c.execute('SELECT song_id, value FROM tags '
+                           'WHERE name_id IN %s ORDER BY song_id, pos' %
+                           nameIDs)
+        genres = {}
+        for songID, value in result.fetchall():
+            genres.setdefault(songID, []).append(value)
+        for songID, values in genres.items():
+            MusicDatabase.setSongGenres(songID, normalizeGenres(values))
+
+    def upgradeToVersion5(self, c):
+        """Add statistics tables maintained by triggers."""
+        c.execute('''
+CREATE TABLE statistics(
+                  name TEXT PRIMARY KEY,
+                  value INTEGER
+                  )''')
+        c.execute('''
+CREATE TABLE format_statistics(
+                  format TEXT PRIMARY KEY,
+                  songs INTEGER,
+                  duration REAL
+                  )''')
+        c.execute('''
+CREATE TABLE audio_hashes(
+                  audio_sha256sum TEXT PRIMARY KEY,
+                  songs INTEGER
+                  ) WITHOUT ROWID''')
+        c.execute('CREATE INDEX audio_hashes_duplicated_idx '
+                  'ON audio_hashes(songs) WHERE songs > 1')
+
+        c.execute('''
+CREATE TRIGGER statistics_songs_insert AFTER INSERT ON songs BEGIN
+    UPDATE statistics SET value = value + 1 WHERE name = 'songs';
+END''')
+        c.execute('''
+CREATE TRIGGER statistics_songs_delete AFTER DELETE ON songs BEGIN
+    UPDATE statistics SET value = value - 1 WHERE name = 'songs';
+END''')
+
+        self.createPropertiesStatisticsTriggers(c)
+
+        musicBrainzNameIDs = ('(SELECT id FROM tag_names WHERE %s)' %
+                              ' OR '.join("name LIKE '%s'" % x for x in
+                                          MusicDatabase.musicBrainzTrackIDTags))
+        c.execute('''
+CREATE TRIGGER statistics_tags_insert AFTER INSERT ON tags
+  WHEN new.name_id IN %(ids)s
+   AND (SELECT COUNT(*) FROM tags
+         WHERE song_id = new.song_id AND name_id IN %(ids)s) = 1 BEGIN
+    UPDATE statistics SET value = value + 1 WHERE name = 'musicbrainz_songs';
+END''' % {'ids': musicBrainzNameIDs})
+        c.execute('''
+CREATE TRIGGER statistics_tags_delete AFTER DELETE ON tags
+  WHEN old.name_id IN %(ids)s
+   AND NOT EXISTS (SELECT 1 FROM tags
+                    WHERE song_id = old.song_id AND name_id IN %(ids)s) BEGIN
+    UPDATE statistics SET value = value - 1 WHERE name = 'musicbrainz_songs';
+END''' % {'ids': musicBrainzNameIDs})
+
+        MusicDatabase.rebuildStatistics()
+
+    @staticmethod
+    def createPropertiesStatisticsTriggers(c):
+        """Create the triggers that keep the format and audio hash statistics.
+
+        Songs whose audio hash isn't calculated yet are not counted in
+        audio_hashes.
+        """
+        addProperties = '''
+    INSERT INTO format_statistics(format, songs, duration)
+         VALUES (coalesce(new.format, ''), 1, coalesce(new.duration, 0))
+    ON CONFLICT(format) DO UPDATE SET songs = songs + 1,
+                                      duration = duration + excluded.duration;
+    INSERT INTO audio_hashes(audio_sha256sum, songs)
+         SELECT new.audio_sha256sum, 1
+          WHERE new.audio_sha256sum IS NOT NULL
+    ON CONFLICT(audio_sha256sum) DO UPDATE SET songs = songs + 1;'''
+        removeProperties = '''
+    UPDATE format_statistics
+       SET songs = songs - 1, duration = duration - coalesce(old.duration, 0)
+     WHERE format = coalesce(old.format, '');
+    UPDATE audio_hashes SET songs = songs - 1
+     WHERE audio_sha256sum = old.audio_sha256sum;
+    DELETE FROM audio_hashes
+     WHERE audio_sha256sum = old.audio_sha256sum AND songs <= 0;'''
+        c.execute('''
+CREATE TRIGGER statistics_properties_insert AFTER INSERT ON properties BEGIN
+%s
+END''' % addProperties)
+        c.execute('''
+CREATE TRIGGER statistics_properties_delete AFTER DELETE ON properties BEGIN
+%s
+END''' % removeProperties)
+        c.execute('''
+CREATE TRIGGER statistics_properties_update
+ AFTER UPDATE OF format, duration, audio_sha256sum ON properties BEGIN
+%s
+%s
+END''' % (removeProperties, addProperties))
+
+    def upgradeToVersion6(self, c):
+        """Add a state table with the generation of the database."""
+        c.execute('''
+CREATE TABLE state(
+                  name TEXT PRIMARY KEY,
+                  value
+                  )''')
+        c.execute("INSERT INTO state(name, value) VALUES ('generation', 0)")
+
+    def upgradeToVersion7(self, c):
+        """Add the table of databases of each root in sharded mode."""
+        c.execute('''
+CREATE TABLE IF NOT EXISTS shards(
+                  id INTEGER PRIMARY KEY,
+                  root TEXT UNIQUE,
+                  path TEXT
+                  )''')
+
+    def upgradeToVersion8(self, c):
+        """Store similarities in a WITHOUT ROWID table keyed by song ids."""
+        # Rows are copied as they are, even if they reference removed songs
+        foreignKeys = c.execute('pragma foreign_keys').fetchone()[0]
+        c.execute('pragma foreign_keys = OFF')
+        # Keep track of the songs already compared so similarities can be
+        # pruned without losing that information
+        c.execute("INSERT INTO state(name, value) "
+                  "SELECT 'similarities_last_song_id', max(song_id2) "
+                  "FROM similarities HAVING max(song_id2) IS NOT NULL")
+        c.execute('''
+CREATE TABLE similarities_new(
+                  song_id1 INTEGER,
+                  song_id2 INTEGER,
+                  offset INTEGER,
+                  similarity REAL,
+                  PRIMARY KEY(song_id1, song_id2),
+                  FOREIGN KEY(song_id1) REFERENCES songs(id) ON DELETE CASCADE,
+                  FOREIGN KEY(song_id2) REFERENCES songs(id) ON DELETE CASCADE
+                  ) WITHOUT ROWID''')
+        c.execute('INSERT OR REPLACE INTO similarities_new '
+                  '(song_id1, song_id2, offset, similarity) '
+                  'SELECT min(song_id1, song_id2), max(song_id1, song_id2), '
+                  '       offset, similarity '
+                  '  FROM similarities '
+                  ' WHERE song_id1 IS NOT NULL AND song_id2 IS NOT NULL')
+        c.execute('DROP TABLE similarities')
+        c.execute('ALTER TABLE similarities_new RENAME TO similarities')
+        c.execute('CREATE INDEX similarities_song_id2_idx '
+                  'ON similarities(song_id2)')
+        MusicDatabase.conn.commit()
+        c.execute('pragma foreign_keys = %d' % foreignKeys)
+
+    def upgradeToVersion9(self, c):
+        """Add the size, inode, device and mode of files to songs."""
+        # They're filled when songs are added or by the next update
+        for column in ('size', 'inode', 'device', 'mode'):
+            c.execute('ALTER TABLE songs ADD COLUMN %s INTEGER' % column)
+
+    def upgradeToVersion10(self, c):
+        """Add the decoded sub-fingerprints of songs to fingerprints."""
+        # Existing rows are filled by find-audio-duplicates the first time
+        # it decodes them
+        c.execute('ALTER TABLE fingerprints '
+                  'ADD COLUMN decoded_fingerprint BLOB')
+
+    def upgradeToVersion11(self, c):
+        """Don't count songs without an audio hash in audio_hashes."""
+        for trigger in ('insert', 'delete', 'update'):
+            c.execute('DROP TRIGGER statistics_properties_%s' % trigger)
+        self.createPropertiesStatisticsTriggers(c)
+        MusicDatabase.rebuildStatistics()
+
+    def upgradeToVersion12(self, c):
+        """Add a random id that identifies the database to the state."""
+        c.execute("INSERT OR IGNORE INTO state(name, value) "
+                  "VALUES ('database_id', ?)", (uuid.uuid4().hex,))
+
+    def upgradeToVersion13(self, c):
+        """Use a write-ahead log so readers don't block writers."""
+        MusicDatabase.conn.commit()
+        mode = c.execute('pragma journal_mode=WAL').fetchone()[0]
+        if mode != 'wal':
+            print('Warning: The database could not be switched to a '
+                  'write-ahead log (journal mode: %s)' % mode)
+
+    @staticmethod
+    def getState(name, default=None):
+        c = MusicDatabase.conn.cursor()
+        result = c.execute('SELECT value FROM state WHERE name = ?', (name,))
+        value = result.fetchone()
+        return value[0] if value else default
+
+    @staticmethod
+    def setState(name, value):
+        c = MusicDatabase.conn.cursor()
+        c.execute('INSERT INTO main.state(name, value) VALUES (?, ?) '
+                  'ON CONFLICT(name) DO UPDATE SET value = excluded.value',
+                  (name, value))
+
+    @staticmethod
+    def increaseGeneration():
+        """Mark that the database contents changed.
+
+        The generation is increased on every commit that changes the
+        database and is used to invalidate cached query results.
+        """
+        c = MusicDatabase.conn.cursor()
+        c.execute("UPDATE main.state SET value = value + 1 "
+                  "WHERE name = 'generation'")
+
+    @staticmethod
+    def generation():
+        return MusicDatabase.getState('generation')
+
+    @staticmethod
+    def fetchAll(sql, values=(), asDicts=False):
+        """Execute a read-only query and return all the resulting rows.
+
+        Rows are returned as tuples (or dicts if asDicts is True). If the
+        query cache is enabled, results are served from the cache as long
+        as the database didn't change since they were stored.
+        """
+        cache = MusicDatabase.queryCache
+        if cache and MusicDatabase.conn.in_transaction:
+            # There are uncommitted changes in this connection
+            cache = None
+        if cache:
+            key = QueryCache.key(MusicDatabase.cacheNamespace, sql, values)
+            generation = MusicDatabase.generation()
+            rows = cache.get(key, generation)
+            if rows is not None:
+                return rows if asDicts else [tuple(row) for row in rows]
+
+        c = MusicDatabase.conn.cursor()
+        result = c.execute(sql, values)
+        if asDicts:
+            columns = [x[0] for x in result.description]
+            rows = [dict(zip(columns, row)) for row in result.fetchall()]
+        else:
+            rows = [tuple(row) for row in result.fetchall()]
+
+        if cache:
+            cache.set(key, generation, rows)
+        return rows
+
+    @staticmethod
+    def searchCondition(terms):
+        """Return a (condition, values) tuple to select songs matching terms.
+
+        Each term has to be found in the title, artist, album, album artist
+        or genre of a song. A term can be restricted to one of those with a
+        column prefix (i.e. "artist:beatles"). Terms shorter than 3
+        characters can't use the trigram index and are matched with LIKE.
+        """
+        if isinstance(terms, str):
+            try:
+                terms = shlex.split(terms)
+            except ValueError:
+                # Unbalanced quotes, like the apostrophe in "guns n' roses"
+                terms = terms.split()
+
+        match = []
+        conditions = []
+        values = []
+        for term in terms:
+            column, sep, text = term.partition(':')
+            if not sep or column.lower() not in MusicDatabase.searchColumns:
+                column, text = None, term
+            if not text:
+                continue
+            if MusicDatabase.hasSearchIndex and len(text) >= 3:
+                phrase = '"%s"' % text.replace('"', '""')
+                match.append('%s : %s' % (column, phrase) if column
+                             else phrase)
+                continue
+            columns = [column] if column else MusicDatabase.searchColumns
+            conditions.append('(%s)' % ' OR '.join('%s LIKE ?' % x
+                                                  for x in columns))
+            values.extend(['%' + text + '%'] * len(columns))
+
+        if not match and not conditions:
+            return None, []
+
+        if not MusicDatabase.hasSearchIndex:
+            return ' AND '.join(conditions), values
+
+        if match:
+            conditions.insert(0, 'songs_fts MATCH ?')
+            values.insert(0, ' AND '.join(match))
+        return ('id IN (SELECT rowid FROM songs_fts WHERE %s)' %
+                ' AND '.join(conditions), values)
+
+    @staticmethod
+    def updateSearchIndex(song):
+        if not MusicDatabase.hasSearchIndex:
+            return
+        c = MusicDatabase.conn.cursor()
+        c.execute('DELETE FROM songs_fts WHERE rowid = ?', (song.id,))
+        c.execute('INSERT INTO songs_fts(rowid, %s) VALUES (?,?,?,?,?,?)' %
+                  ', '.join(MusicDatabase.searchColumns),
+                  (song.id, toString(song['title']),
+                   toString(song['artist']), toString(song['album']),
+                   toString(song['albumartist']), toString(song['genre'])))
+
+    @staticmethod
+    def genreCondition(genre):
+        """Return a (condition, values) tuple to select songs by genre."""
+        return ('id IN (SELECT song_id FROM song_genres WHERE genre_id IN '
+                '(SELECT id FROM genres WHERE name LIKE ?))', [genre])
+
+    @staticmethod
+    def pathCondition(path):
+        """Return a (condition, values) tuple to select songs by path.
+
+        Absolute directories are matched as a path prefix using an index
+        range scan, relative paths that don't exist in the filesystem are
+        matched as a substring of the song paths and any other path must
+        match exactly.
+        """
+        if not path:
+            return None, []
+
+        if not path.startswith('/') and os.path.isdir(path):
+            path = os.path.abspath(path)
+
+        if path.startswith('/'):
+            if not path.endswith('/') and not os.path.isdir(path):
+                return 'path = ?', [path]
+            prefix = os.path.join(os.path.normpath(path), '')
+            upperBound = prefixUpperBound(prefix)
+            if upperBound is None:
+                return 'path >= ?', [prefix]
+            return 'path >= ? AND path < ?', [prefix, upperBound]
+
+        if MusicDatabase.hasPathSubstringIndex:
+            return ('id IN (SELECT rowid FROM songs_path_fts '
+                    'WHERE path LIKE ?)', ['%' + path + '%'])
+
+        return 'path LIKE ?', ['%' + path + '%']
+
     @staticmethod
     def addSong(song):
         if config['immutableDatabase']:
@@ -143,6 +1002,7 @@ CREATE TABLE similarities(
         songID = result.fetchone()
 
         values = [(song.root(), song.path(), song.filename(), song.mtime(),
+                   song.size(), song.inode(), song.device(), song.mode(),
                    song['title'], toString(song['artist']), song['album'],
                    song['albumartist'], song['tracknumber'], song['date'],
                    toString(song['genre']), song['discnumber'],
@@ -153,7 +1013,8 @@ CREATE TABLE similarities(
             song.id = songID[0]
             print('Updating song %s' % song.path())
             values = [values[0][3:] + (song.path(), )]
-            sql = ('UPDATE songs SET mtime=?, title=?, artist=?, album=?, '
+            sql = ('UPDATE songs SET mtime=?, size=?, inode=?, device=?, '
+                   'mode=?, title=?, artist=?, album=?, '
                    'albumArtist=?, track=?, date=?, genre=?, discNumber=?, '
                    'coverWidth=?, coverHeight=?, coverMD5=?, completeness=? '
                    'WHERE path = ?')
@@ -163,9 +1024,10 @@ CREATE TABLE similarities(
             c.executemany('UPDATE checksums SET sha256sum=? WHERE song_id=?',
                           values)
 
-            values = [(song.fingerprint, song.id), ]
-            c.executemany('UPDATE fingerprints SET fingerprint=? '
-                          'WHERE song_id=?', values)
+            values = [(song.fingerprint, song.decodedFingerprint,
+                       song.id), ]
+            c.executemany('UPDATE fingerprints SET fingerprint=?, '
+                          'decoded_fingerprint=? WHERE song_id=?', values)
 
             values = [(song.format(), song.duration(), song.bitrate(),
                        song.bits_per_sample(), song.sample_rate(),
@@ -177,31 +1039,17 @@ CREATE TABLE similarities(
                           'silence_at_end=? WHERE song_id=?''',
                           values)
 
-            values = [(song.id), ]
-            c.execute('''DELETE from tags where song_id = ?''', (song.id,))
-
-            tags = []
-            for key, values in song.metadata.items():
-                values = normalizeTagValues(values, song.metadata, key)
-
-                if isinstance(values, list):
-                    for value in values:
-                        tags.append((song.id, key, value))
-                else:
-                    if isinstance(values, mutagen.apev2.APEBinaryValue):
-                        continue
-                    tags.append((song.id, key, str(values)))
-            # print(tags)
-            c.executemany('INSERT INTO tags(song_id, name, value) '
-                          'VALUES (?,?,?)', tags)
+            MusicDatabase.setSongTags(song.id, MusicDatabase.songTags(song))
         else:
             print('Adding new song %s' % song.path())
             print(values[0][3:])
             c.executemany('INSERT INTO songs(root, path, filename, mtime, '
+                          'size, inode, device, mode, '
                           'title, artist, album, albumArtist, track, date, '
                           'genre, discNumber, coverWidth, coverHeight, '
                           'coverMD5, completeness) '
-                          'VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', values)
+                          'VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                          values)
 
             result = c.execute('''SELECT last_insert_rowid()''')
             song.id = result.fetchone()[0]
@@ -210,9 +1058,9 @@ CREATE TABLE similarities(
             c.executemany('INSERT INTO checksums(song_id, sha256sum) '
                           'VALUES (?,?)', values)
 
-            values = [(song.id, song.fingerprint), ]
-            c.executemany('INSERT INTO fingerprints(song_id, fingerprint) '
-                          'VALUES (?,?)', values)
+            values = [(song.id, song.fingerprint, song.decodedFingerprint), ]
+            c.executemany('INSERT INTO fingerprints(song_id, fingerprint, '
+                          'decoded_fingerprint) VALUES (?,?,?)', values)
 
             values = [(song.id, song.format(), song.duration(), song.bitrate(),
                        song.bits_per_sample(), song.sample_rate(),
@@ -223,20 +1071,175 @@ CREATE TABLE similarities(
                           'audio_sha256sum, silence_at_start, silence_at_end) '
                           'VALUES (?,?,?,?,?,?,?,?,?,?)', values)
 
-            tags = []
-            for key, values in song.metadata.items():
-                values = normalizeTagValues(values, song.metadata, key)
+            MusicDatabase.setSongTags(song.id, MusicDatabase.songTags(song))
+
+        MusicDatabase.setSongGenres(song.id, normalizeGenres(song['genre']))
+        MusicDatabase.updateSearchIndex(song)
+        if song.decodedFingerprint:
+            # The arena can't be rolled back, so it's only appended once the
+            # song is committed
+            MusicDatabase.pendingArenaFingerprints.append(
+                (song.id, song.decodedFingerprint))
+
+    @staticmethod
+    def getFingerprint(songID):
+        """Return the (fingerprint, decoded_fingerprint) of a song."""
+        c = MusicDatabase.conn.cursor()
+        result = c.execute('SELECT fingerprint, decoded_fingerprint '
+                           'FROM fingerprints WHERE song_id = ?', (songID,))
+        return result.fetchone() or (None, None)
+
+    @staticmethod
+    def setDecodedFingerprints(values):
+        """Store a list of (decoded_fingerprint, song_id) in the db."""
+        c = MusicDatabase.conn.cursor()
+        c.executemany('UPDATE fingerprints SET decoded_fingerprint=? '
+                      'WHERE song_id=?', values)
+
+    @staticmethod
+    def setSongsFileStat(songs):
+        """Store the size, inode, device and mode of songs in the db."""
+        c = MusicDatabase.conn.cursor()
+        c.executemany('UPDATE songs SET size=?, inode=?, device=?, mode=? '
+                      'WHERE id=?',
+                      [(song.size(), song.inode(), song.device(), song.mode(),
+                        song.id) for song in songs])
+
+    @staticmethod
+    def getDirectoriesSizes(where_clause='', where_values=()):
+        """Return (directory, size, songs) for the directories of songs.
+
+        The size is the sum of the sizes of the songs in the directory
+        matching where_clause. Directories are sorted by name.
+        """
+        sql = ('SELECT substr(path, 1, length(path) - length(filename) - 1) '
+               '       AS directory, SUM(size), COUNT(*) '
+               '  FROM songs %s '
+               ' GROUP BY directory ORDER BY directory' % where_clause)
+        return MusicDatabase.fetchAll(sql, where_values)
+
+    @staticmethod
+    def songTags(song):
+        """Return the list of (name, value) tags of song to store in the db."""
+        tags = []
+        for key, values in song.metadata.items():
+            values = normalizeTagValues(values, song.metadata, key)
+
+            if isinstance(values, list):
+                for value in values:
+                    tags.append((key, value))
+            else:
+                if isinstance(values, mutagen.apev2.APEBinaryValue):
+                    continue
+                tags.append((key, str(values)))
+        return tags
+
+    @classmethod
+    def getTagNameID(cls, name, create=True):
+        try:
+            return cls.tag_name_ids[name]
+        except KeyError:
+            pass
+        c = MusicDatabase.conn.cursor()
+        result = c.execute('SELECT id FROM tag_names WHERE name = ?', (name,))
+        nameID = result.fetchone()
+        if nameID:
+            nameID = nameID[0]
+        elif create:
+            c.execute('INSERT INTO tag_names(id, name) '
+                      'SELECT max(coalesce(max(id), 0), ?) + 1, ? '
+                      'FROM tag_names', (MusicDatabase.idBase, name))
+            nameID = c.lastrowid
+        else:
+            return None
+        cls.tag_name_ids[name] = nameID
+        return nameID
+
+    @staticmethod
+    def tagNameIDsCondition(patterns):
+        """Return an SQL list of the ids of tag names matching patterns.
+
+        patterns is a list of LIKE patterns. Tag names are matched on the
+        small tag_names table so the tags table can be searched by name_id.
+        """
+        c = MusicDatabase.conn.cursor()
+        sql = ('SELECT id FROM tag_names WHERE %s' %
+               ' OR '.join(['name LIKE ?'] * len(patterns)))
+        ids = [str(x[0]) for x in c.execute(sql, patterns)]
+        return '(%s)' % ','.join(ids)
+
+    @staticmethod
+    def setSongTags(songID, tags):
+        """Store the (name, value) tags of a song in the database.
+
+        Only the tags that differ from the ones already stored for the song
+        are written, so updating a song with one changed tag only writes
+        one row.
+        """
+        c = MusicDatabase.conn.cursor()
+        result = c.execute('SELECT name_id, pos, value FROM tags '
+                           'WHERE song_id = ?', (songID,))
+        existing = {(nameID, pos): value for nameID, pos, value in result}
+
+        new = {}
+        positions = {}
+        for name, value in tags:
+            if isinstance(value, (int, float)):
+                # TEXT affinity would store the value as text anyway
+                value = str(value)
+            nameID = MusicDatabase.getTagNameID(name)
+            pos = positions.get(nameID, 0)
+            positions[nameID] = pos + 1
+            new[(nameID, pos)] = value
 
-                if isinstance(values, list):
-                    for value in values:
-                        tags.append((song.id, key, value))
-                else:
-                    if isinstance(values, mutagen.apev2.APEBinaryValue):
-                        continue
-                    tags.append((song.id, key, str(values)))
-            # print(tags)
-            c.executemany('INSERT INTO tags(song_id, name, value) '
-                          'VALUES (?,?,?)', tags)
+        removed = [(songID, nameID, pos) for (nameID, pos) in existing
+                   if (nameID, pos) not in new]
+        changed = [(value, songID, nameID, pos)
+                   for (nameID, pos), value in new.items()
+                   if (nameID, pos) in existing and
+                   existing[(nameID, pos)] != value]
+        added = [(songID, nameID, pos, value)
+                 for (nameID, pos), value in new.items()
+                 if (nameID, pos) not in existing]
+
+        c.executemany('DELETE FROM tags '
+                      'WHERE song_id = ? AND name_id = ? AND pos = ?', removed)
+        c.executemany('UPDATE tags SET value = ? '
+                      'WHERE song_id = ? AND name_id = ? AND pos = ?', changed)
+        c.executemany('INSERT INTO tags(song_id, name_id, pos, value) '
+                      'VALUES (?,?,?,?)', added)
+
+    @classmethod
+    def getGenreID(cls, name):
+        try:
+            return cls.genre_ids[name]
+        except KeyError:
+            pass
+        c = MusicDatabase.conn.cursor()
+        result = c.execute('SELECT id FROM genres WHERE name = ?', (name,))
+        genreID = result.fetchone()
+        if genreID:
+            genreID = genreID[0]
+        else:
+            c.execute('INSERT INTO genres(id, name) '
+                      'SELECT max(coalesce(max(id), 0), ?) + 1, ? '
+                      'FROM genres', (MusicDatabase.idBase, name))
+            genreID = c.lastrowid
+        cls.genre_ids[name] = genreID
+        return genreID
+
+    @staticmethod
+    def setSongGenres(songID, genres):
+        c = MusicDatabase.conn.cursor()
+        result = c.execute('SELECT genre_id FROM song_genres '
+                           'WHERE song_id = ?', (songID,))
+        existing = {x[0] for x in result}
+        new = {MusicDatabase.getGenreID(genre) for genre in genres}
+        c.executemany('DELETE FROM song_genres '
+                      'WHERE song_id = ? AND genre_id = ?',
+                      [(songID, x) for x in existing - new])
+        c.executemany('INSERT INTO song_genres(song_id, genre_id) '
+                      'VALUES (?,?)', [(songID, x) for x in new - existing])
 
     @staticmethod
     def removeSong(song=None, byID=None):
@@ -252,8 +1255,11 @@ CREATE TABLE similarities(
         c.execute('DELETE FROM checksums where song_id = ? ', (byID,))
         c.execute('DELETE FROM fingerprints where song_id = ? ', (byID,))
         c.execute('DELETE FROM tags where song_id = ? ', (byID,))
+        c.execute('DELETE FROM song_genres where song_id = ? ', (byID,))
         c.execute('DELETE FROM properties where song_id = ? ', (byID,))
         c.execute('DELETE FROM ratings where song_id = ? ', (byID,))
+        if MusicDatabase.hasSearchIndex:
+            c.execute('DELETE FROM songs_fts where rowid = ? ', (byID,))
         c.execute('DELETE FROM songs where id = ? ', (byID,))
         MusicDatabase.commit()
 
@@ -269,10 +1275,238 @@ CREATE TABLE similarities(
     def getSongsWithMusicBrainzTagsCount():
         c = MusicDatabase.conn.cursor()
 
-        result = c.execute("SELECT COUNT(*) FROM tags where name like '%musicbrainz_trackid' or name like 'UFID:http://musicbrainz.org' or name like '%MusicBrainz Track Id' or name like '%MusicBrainz/Track Id'")
+        nameIDs = MusicDatabase.tagNameIDsCondition(
+            MusicDatabase.musicBrainzTrackIDTags)
+        result = c.execute('SELECT COUNT(DISTINCT song_id) FROM tags '
+                           'WHERE name_id IN %s' % nameIDs)
         count = result.fetchone()
         return count[0]
 
+    @staticmethod
+    def rebuildStatistics():
+        """Recalculate the statistics tables from scratch.
+
+        The statistics are kept up to date by triggers, so this is only
+        needed if they ever get out of sync.
+        """
+        c = MusicDatabase.conn.cursor()
+        c.execute('DELETE FROM statistics')
+        c.execute('DELETE FROM format_statistics')
+        c.execute('DELETE FROM audio_hashes')
+        c.execute("INSERT INTO statistics(name, value) "
+                  "SELECT 'songs', COUNT(*) FROM songs")
+        c.execute("INSERT INTO statistics(name, value) VALUES "
+                  "('musicbrainz_songs', ?)",
+                  (MusicDatabase.getSongsWithMusicBrainzTagsCount(),))
+        c.execute("INSERT INTO format_statistics(format, songs, duration) "
+                  "SELECT coalesce(format, ''), COUNT(*), "
+                  "       coalesce(SUM(duration), 0) "
+                  "  FROM properties GROUP BY coalesce(format, '')")
+        c.execute("INSERT INTO audio_hashes(audio_sha256sum, songs) "
+                  "SELECT audio_sha256sum, COUNT(*) FROM properties "
+                  " WHERE audio_sha256sum IS NOT NULL "
+                  " GROUP BY audio_sha256sum")
+
+    @staticmethod
+    def getStatistics():
+        """Return a dict with the statistics of the music library."""
+        c = MusicDatabase.conn.cursor()
+        stats = {name: value for name, value in
+                 c.execute('SELECT name, value FROM statistics')}
+        result = c.execute('SELECT format, songs, duration '
+                           'FROM format_statistics WHERE songs > 0 '
+                           'ORDER BY songs DESC')
+        stats['formats'] = [tuple(x) for x in result]
+        result = c.execute('SELECT COUNT(*), coalesce(SUM(songs), 0) '
+                           'FROM audio_hashes WHERE songs > 1')
+        stats['duplicated_audio_hashes'], stats['duplicated_songs'] = \
+            result.fetchone()
+        return stats
+
+    @staticmethod
+    def getDatabaseSizes():
+        """Return the page usage of the database and the size of each table.
+
+        Returns a dict with page_size, page_count and freelist_count and a
+        tables dict with the bytes used by each table and its indexes (only
+        if sqlite was built with the dbstat virtual table).
+        """
+        c = MusicDatabase.conn.cursor()
+        sizes = {}
+        for name in ['page_size', 'page_count', 'freelist_count']:
+            sizes[name] = c.execute('pragma main.%s' % name).fetchone()[0]
+        try:
+            result = c.execute('''
+                SELECT coalesce(m.tbl_name, d.name) AS tbl, SUM(d.pgsize)
+                  FROM dbstat('main') AS d
+                  LEFT JOIN main.sqlite_master AS m ON m.name = d.name
+                 GROUP BY tbl''')
+            sizes['tables'] = dict(result.fetchall())
+        except sqlite3.OperationalError:
+            sizes['tables'] = {}
+        return sizes
+
+    @staticmethod
+    def checkIntegrity(full=False, foreignKeys=True):
+        """Return the errors found by an integrity and foreign key check.
+
+        A quick_check is done unless full is True, in which case indexes are
+        also checked to match their tables (which is much slower).
+        """
+        c = MusicDatabase.conn.cursor()
+        pragma = 'integrity_check' if full else 'quick_check'
+        errors = [x[0] for x in c.execute('pragma main.%s' % pragma)
+                  if x[0] != 'ok']
+        if not foreignKeys:
+            return errors
+        for table, rowid, parent, _ in \
+                c.execute('pragma main.foreign_key_check'):
+            errors.append('%s row %s references a missing row in %s' %
+                          (table, rowid, parent))
+        return errors
+
+    @staticmethod
+    def analyze(limit=None):
+        """Gather statistics used by the query planner.
+
+        If limit is given, only that number of rows of each index are
+        examined, which is enough for the planner and bounds the time used.
+        """
+        c = MusicDatabase.conn.cursor()
+        if limit:
+            c.execute('pragma analysis_limit = %d' % limit)
+        if MusicDatabase.tableExists('sqlite_stat1'):
+            # Only analyze the tables whose statistics are out of date
+            c.execute('pragma main.optimize')
+        else:
+            c.execute('ANALYZE main')
+        c.execute('pragma analysis_limit = 0')
+
+    @staticmethod
+    def enableIncrementalVacuum():
+        """Enable auto_vacuum=INCREMENTAL rebuilding the database.
+
+        Return False if it was already enabled. Note that this runs a full
+        VACUUM that can take a long time on big databases.
+        """
+        c = MusicDatabase.conn.cursor()
+        if c.execute('pragma main.auto_vacuum').fetchone()[0] == 2:
+            return False
+        MusicDatabase.conn.commit()
+        c.execute('pragma main.auto_vacuum = INCREMENTAL')
+        c.execute('VACUUM main')
+        return True
+
+    @staticmethod
+    def incrementalVacuum(deadline=None, step=1024):
+        """Return free pages to the filesystem until deadline.
+
+        Pages are freed in groups of step pages so the operation can stop
+        at the given time.time() deadline. Returns the number of pages
+        freed or None if incremental vacuum is not enabled.
+        """
+        c = MusicDatabase.conn.cursor()
+        if c.execute('pragma main.auto_vacuum').fetchone()[0] != 2:
+            return None
+        initialFree = c.execute('pragma main.freelist_count').fetchone()[0]
+        free = initialFree
+        while free and (deadline is None or time.time() < deadline):
+            c.execute('pragma main.incremental_vacuum(%d)' % step).fetchall()
+            MusicDatabase.conn.commit()
+            free = c.execute('pragma main.freelist_count').fetchone()[0]
+        return initialFree - free
+
+    @staticmethod
+    def checkpoint():
+        """Checkpoint and truncate the write-ahead log if it's used.
+
+        Returns the (busy, log pages, checkpointed pages) result or None
+        if the database doesn't use a write-ahead log.
+        """
+        c = MusicDatabase.conn.cursor()
+        if c.execute('pragma main.journal_mode').fetchone()[0] != 'wal':
+            return None
+        MusicDatabase.conn.commit()
+        return tuple(c.execute('pragma main.wal_checkpoint(TRUNCATE)')
+                     .fetchone())
+
+    @staticmethod
+    def backup(path, pages=256, sleep=0.05, progress=None, name='main',
+               maxRestarts=10):
+        """Copy the database to path using the sqlite online backup API.
+
+        The database is copied in steps of the given number of pages,
+        sleeping between steps so other processes can keep writing. name
+        is the attached database to copy. With a write-ahead log, the copy
+        is made in a single read transaction so it's a consistent snapshot
+        that doesn't block writers. Otherwise, each write from another
+        process restarts the copy, so it fails after maxRestarts restarts.
+        """
+        restarts = 0
+        lastRemaining = None
+
+        def checkProgress(status, remaining, total):
+            nonlocal restarts, lastRemaining
+            if lastRemaining is not None and remaining > lastRemaining:
+                restarts += 1
+                if restarts > maxRestarts:
+                    # Raising from the callback aborts the backup
+                    raise Exception('The database was modified by other '
+                                    'processes while copying it and the '
+                                    'backup was restarted %d times' %
+                                    restarts)
+            lastRemaining = remaining
+            if progress:
+                progress(status, remaining, total)
+            # sqlite3 only sleeps itself when a step finds the database
+            # busy or locked
+            if remaining > 0:
+                time.sleep(sleep)
+
+        conn = MusicDatabase.connections.writer
+        conn.commit()
+        wal = conn.execute('pragma "%s".journal_mode' %
+                           name).fetchone()[0] == 'wal'
+        if wal:
+            # Keep the source read transaction open between steps so
+            # commits from other processes don't restart the copy
+            conn.execute('BEGIN')
+            conn.execute('SELECT 1 FROM "%s".sqlite_master LIMIT 1' %
+                         name).fetchall()
+        destination = sqlite3.connect(path)
+        try:
+            conn.backup(destination, pages=pages, progress=checkProgress,
+                        name=name)
+            # A restored backup is a different database for the query
+            # cache, even if it's restored to the same path
+            destination.execute("UPDATE state SET value = ? "
+                                "WHERE name = 'database_id'",
+                                (uuid.uuid4().hex,))
+            destination.commit()
+        finally:
+            destination.close()
+            if wal:
+                conn.rollback()
+
+    @staticmethod
+    def verifyBackup(path):
+        """Return a list of errors found in a backup and its songs count."""
+        # Not read-only, so the write-ahead log and shared memory files of
+        # a backup made from a database that uses them are removed on close
+        conn = sqlite3.connect('file:%s?mode=rw' % path, uri=True)
+        try:
+            errors = [x[0] for x in conn.execute('pragma quick_check')
+                      if x[0] != 'ok']
+            version = conn.execute('pragma user_version').fetchone()[0]
+            if version != MusicDatabase.schemaVersion:
+                errors.append('Schema version is %d instead of %d' %
+                              (version, MusicDatabase.schemaVersion))
+            count = conn.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+        except sqlite3.DatabaseError as e:
+            return [str(e)], 0
+        finally:
+            conn.close()
+        return errors, count
 
     @staticmethod
     def addCover(pathToSong, pathToCover):
@@ -324,8 +1558,9 @@ CREATE TABLE similarities(
     @staticmethod
     def getSongTags(songID):
         c = MusicDatabase.conn.cursor()
-        result = c.execute('SELECT name, value FROM tags where song_id = ? ',
-                           (songID,))
+        result = c.execute('SELECT name, value FROM tags, tag_names '
+                           'WHERE song_id = ? AND name_id = tag_names.id '
+                           'ORDER BY name_id, pos', (songID,))
         tags = {}
         for name, value in result.fetchall():
             if name not in tags:
@@ -334,6 +1569,24 @@ CREATE TABLE similarities(
                 tags[name] += [value]
         return tags
 
+    @staticmethod
+    def getSongsTags(songIDs):
+        """Return a dict with the tags of each song in songIDs.
+
+        This loads the tags of many songs using one query for each chunk
+        of maxIDsPerQuery song ids instead of one query for each song.
+        """
+        c = MusicDatabase.conn.cursor()
+        tags = {songID: {} for songID in songIDs}
+        for chunk in inChunks(tags.keys()):
+            sql = ('SELECT song_id, name, value FROM tags, tag_names '
+                   'WHERE song_id IN (%s) AND name_id = tag_names.id '
+                   'ORDER BY song_id, name_id, pos' %
+                   ','.join('?' * len(chunk)))
+            for songID, name, value in c.execute(sql, chunk):
+                tags[songID].setdefault(name, []).append(value)
+        return tags
+
     @staticmethod
     def getSongProperties(songID):
         c = MusicDatabase.conn.cursor()
@@ -342,34 +1595,56 @@ CREATE TABLE similarities(
                      silence_at_start, silence_at_end
                      FROM properties where song_id = ? ''', (songID,))
         row = result.fetchone()
-        info = type('info', (), {})()
 
         try:
-            info.length = row['duration']
-            info.bitrate = row['bitrate']
-            info.bits_per_sample = row['bits_per_sample']
-            info.sample_rate = row['sample_rate']
-            info.channels = row['channels']
-        except KeyError:
+            return songPropertiesFromRow(row)
+        except (KeyError, TypeError):
             print('Error getting song properties for song ID %d' % songID)
             raise
 
-        return row['format'], info, row['audio_sha256sum'], \
-            (row['silence_at_start'], row['silence_at_end'])
+    @staticmethod
+    def getSongsProperties(songIDs):
+        """Return a dict with the properties of each song in songIDs.
+
+        The values have the same format as the ones returned by
+        getSongProperties. Songs without properties are not included.
+        """
+        c = MusicDatabase.conn.cursor()
+        properties = {}
+        for chunk in inChunks(songIDs):
+            sql = ('''SELECT song_id, format, duration, bitrate,
+                     bits_per_sample, sample_rate, channels, audio_sha256sum,
+                     silence_at_start, silence_at_end
+                     FROM properties WHERE song_id IN (%s)''' %
+                   ','.join('?' * len(chunk)))
+            for row in c.execute(sql, chunk):
+                properties[row['song_id']] = songPropertiesFromRow(row)
+        return properties
 
     @staticmethod
-    def getSimilarSongsToSongID(songID, similarityThreshold=0.85):
+    def getSongsFileSha256sums(songIDs):
+        """Return a dict with the file checksum of each song in songIDs."""
         c = MusicDatabase.conn.cursor()
-        result = c.execute('select song_id1, offset, similarity '
-                           '  from similarities '
-                           ' where song_id2=? and similarity>=? '
-                           '   union '
-                           'select song_id2, offset, similarity '
-                           '  from similarities '
-                           ' where song_id1=? and similarity>=?''',
-                           (songID, similarityThreshold,
-                            songID, similarityThreshold))
-        similarSongs = [(x[0], x[1], x[2]) for x in result.fetchall()]
+        checksums = {}
+        for chunk in inChunks(songIDs):
+            sql = ('SELECT song_id, sha256sum FROM checksums '
+                   'WHERE song_id IN (%s)' % ','.join('?' * len(chunk)))
+            for songID, sha256sum in c.execute(sql, chunk):
+                checksums[songID] = sha256sum
+        return checksums
+
+    @staticmethod
+    def getSimilarSongsToSongID(songID, similarityThreshold=0.85):
+        result = MusicDatabase.fetchAll('select song_id1, offset, similarity '
+                                        '  from similarities '
+                                        ' where song_id2=? and similarity>=? '
+                                        '   union '
+                                        'select song_id2, offset, similarity '
+                                        '  from similarities '
+                                        ' where song_id1=? and similarity>=?',
+                                        (songID, similarityThreshold,
+                                         songID, similarityThreshold))
+        similarSongs = [(x[0], x[1], x[2]) for x in result]
 
         return similarSongs
 
@@ -398,10 +1673,21 @@ CREATE TABLE similarities(
 
     @staticmethod
     def commit():
+        conn = MusicDatabase.conn
+        if conn is not MusicDatabase.connections.writer:
+            # Read connections have nothing to commit
+            return
         if config['immutableDatabase']:
-            MusicDatabase.conn.rollback()
+            conn.rollback()
+            MusicDatabase.pendingArenaFingerprints.clear()
             return
-        MusicDatabase.conn.commit()
+        if conn.total_changes != MusicDatabase.committedChanges:
+            MusicDatabase.increaseGeneration()
+        conn.commit()
+        MusicDatabase.committedChanges = conn.total_changes
+        MusicDatabase.fingerprintArena.append(
+            MusicDatabase.pendingArenaFingerprints)
+        MusicDatabase.pendingArenaFingerprints.clear()
 
     @staticmethod
     def addFileSha256sum(songid, sha256sum):
@@ -436,29 +1722,77 @@ CREATE TABLE similarities(
 
     @staticmethod
     def addSongsSimilarity(songid1, songid2, offset, similarity):
+        MusicDatabase.addSongsSimilarities([(songid1, songid2, offset,
+                                             similarity)])
+
+    @staticmethod
+    def addSongsSimilarities(similarities):
+        """Store a list of (songid1, songid2, offset, similarity) tuples."""
         if config['immutableDatabase']:
             print("Error: Can't add song similarity: "
                   "The database is configured as immutable")
             return
-        if songid1 > songid2:
-            songid1, songid2 = songid2, songid1
-        elif songid1 == songid2 and (similarity != 1.0 or offset != 0):
-            print("Error: A song should be exactly similar to itself")
-            print(songid1, songid2, similarity, offset)
-            return
-        elif songid1 == songid2:
-            print("Error: A song shouldn't be compared with itself")
-            print(songid1, songid2, similarity, offset)
-            return
+        rows = []
+        for songid1, songid2, offset, similarity in similarities:
+            if songid1 > songid2:
+                songid1, songid2 = songid2, songid1
+            elif songid1 == songid2 and (similarity != 1.0 or offset != 0):
+                print("Error: A song should be exactly similar to itself")
+                print(songid1, songid2, similarity, offset)
+                continue
+            elif songid1 == songid2:
+                print("Error: A song shouldn't be compared with itself")
+                print(songid1, songid2, similarity, offset)
+                continue
+            rows.append((songid1, songid2, offset, similarity))
         c = MusicDatabase.conn.cursor()
-        c.execute('UPDATE similarities set offset=?, similarity=? '
-                  'where song_id1=? and song_id2=?',
-                  (offset, similarity, songid1, songid2))
-        if c.rowcount == 0:
-            c.execute('INSERT INTO similarities '
+        c.executemany('INSERT INTO similarities '
                       '(song_id1, song_id2, offset, similarity) '
-                      'VALUES (?,?,?,?)',
-                      (songid1, songid2, offset, similarity))
+                      'VALUES (?,?,?,?) '
+                      'ON CONFLICT(song_id1, song_id2) DO UPDATE '
+                      'SET offset = excluded.offset, '
+                      '    similarity = excluded.similarity', rows)
+
+    @staticmethod
+    def pruneSimilarities(topK=None, minScore=None):
+        """Remove stored similarities according to a retention policy.
+
+        Similarities lower than minScore are removed. If topK is given, a
+        pair of songs is only kept if it's one of the topK most similar
+        songs of any of them. Returns the number of removed rows.
+        """
+        c = MusicDatabase.conn.cursor()
+        removed = 0
+        if minScore is not None:
+            c.execute('DELETE FROM similarities WHERE similarity < ?',
+                      (minScore,))
+            removed += c.rowcount
+        if topK:
+            c.execute('''
+CREATE TEMP TABLE kept_similarities(
+                  song_id1 INTEGER,
+                  song_id2 INTEGER,
+                  PRIMARY KEY(song_id1, song_id2)
+                  ) WITHOUT ROWID''')
+            c.execute('''
+INSERT OR IGNORE INTO kept_similarities
+SELECT min(a, b), max(a, b)
+  FROM (SELECT a, b, ROW_NUMBER() OVER (PARTITION BY a
+                                       ORDER BY similarity DESC) AS r
+          FROM (SELECT song_id1 AS a, song_id2 AS b, similarity
+                  FROM similarities
+                 UNION ALL
+                SELECT song_id2, song_id1, similarity
+                  FROM similarities))
+ WHERE r <= ?''', (topK,))
+            c.execute('''
+DELETE FROM similarities
+ WHERE NOT EXISTS (SELECT 1 FROM kept_similarities AS k
+                    WHERE k.song_id1 = similarities.song_id1
+                      AND k.song_id2 = similarities.song_id2)''')
+            removed += c.rowcount
+            c.execute('DROP TABLE kept_similarities')
+        return removed
 
     @staticmethod
     def getSimilarSongs(condition=None):
@@ -466,50 +1800,47 @@ CREATE TABLE similarities(
             condition = '> 0.85'
         else:
             condition = re.match(r'[0-9<>= .]*', condition).group()
-        c = MusicDatabase.conn.cursor()
-        result = c.execute('SELECT song_id1, song_id2, offset, similarity '
-                           'FROM similarities WHERE similarity %s' % condition)
+        result = MusicDatabase.fetchAll('SELECT song_id1, song_id2, offset, '
+                                        'similarity FROM similarities '
+                                        'WHERE similarity %s' % condition)
         pairs = []
-        for songid1, songid2, offset, similarity in result.fetchall():
+        for songid1, songid2, offset, similarity in result:
             pairs.append((songid1, songid2, offset, similarity))
         return pairs
 
     @staticmethod
     def getGenres(ids=[], paths=[], root=None):
-        tables = 'tags'
+        conditions = []
+        variables = []
+        selection = []
+        if ids:
+            selection.append('id IN (%s)' % ','.join([str(x) for x in ids]))
+        for path in paths:
+            condition, values = MusicDatabase.pathCondition(path)
+            if condition:
+                selection.append('(%s)' % condition)
+                variables.extend(values)
+        if selection:
+            conditions.append(' OR '.join(selection))
         if root:
-            condition = 'AND song_id IN (select id from songs where root = ?)'
-            variables = (root,)
+            conditions.append('root = ?')
+            variables.append(root)
+
+        if conditions:
+            where = ('WHERE song_id IN (SELECT id FROM songs WHERE %s)' %
+                     ' AND '.join('(%s)' % x for x in conditions))
         else:
-            condition = ''
-            variables = ()
-        if ids:
-            condition += (' AND song_id in (%s)' %
-                          (','.join([str(x) for x in ids])))
-        if paths:
-            part = ''
-            for path in paths:
-                if part:
-                    part += ' OR path like ?'
-                else:
-                    part = 'path like ?'
-                variables += ('%' + paths[0] + '%',)
-            condition += ' AND id = song_id AND (%s)' % part
-            tables += ',songs'
-
-        sql = '''select value, count(*) 'c'
-                   from %s
-                  where (name like 'genre' OR name='TCON')
-                        %s
-                  group by value
-                  order by c''' % (tables, condition)
-        print(sql, variables)
-        c = MusicDatabase.conn.cursor()
-        result = c.execute(sql, variables)
-        pairs = []
-        for genre, count in result.fetchall():
-            pairs.append((genre.split('\0'), count))
-        return pairs
+            where = ''
+
+        sql = '''SELECT name, SUM(c)
+                   FROM (SELECT genre_id, count(*) 'c'
+                           FROM song_genres
+                           %s
+                          GROUP BY genre_id), genres
+                  WHERE genres.id = genre_id
+                  GROUP BY name
+                  ORDER BY 2''' % where
+        return MusicDatabase.fetchAll(sql, variables)
 
     @staticmethod
     def getUserID(username, create=True):
@@ -543,10 +1874,13 @@ CREATE TABLE similarities(
 
     @staticmethod
     def lastSongIDWithCalculatedSimilarities():
+        songID = MusicDatabase.getState('similarities_last_song_id')
+        if songID is not None:
+            return songID
         sql = 'select max(song_id2) from similarities'
         c = MusicDatabase.conn.cursor()
         result = c.execute(sql)
         x = result.fetchone()
-        if x:
+        if x and x[0] is not None:
             return x[0]
         return 0
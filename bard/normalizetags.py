@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import re
 import mutagen
 import mutagen.mp3
 import mutagen.mp4
@@ -261,3 +262,23 @@ def getTag(mutagenFile, tag, fileformat=None):
 
     result = normalizeTagValues(result, mutagenFile, tag)
     return result
+
+
+def normalizeGenres(values):
+    """Return the list of genres contained in a genre tag value.
+
+    Values can contain several genres separated by '\\0' or ';' and
+    genres are stripped of quotes and whitespace.
+    """
+    if not values:
+        return []
+    if not isinstance(values, list):
+        values = [values]
+
+    genres = []
+    for value in values:
+        for genre in re.split('[\0;]', str(value)):
+            genre = genre.strip().strip('"\'').strip()
+            if genre and genre not in genres:
+                genres.append(genre)
+    return genres
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import threading
+import hashlib
+import json
+import time
+import os
+
+
+class QueryCache:
+    """On-disk cache of the results of read-only queries.
+
+    Results are stored in a separate sqlite database keyed by the
+    database they were read from, the normalized SQL statement and its
+    parameters. Each result is stored together with the generation of the
+    music database it was read from, so a result is only used while the
+    music database generation doesn't change. The cache is bounded to
+    maxSize bytes, evicting the least recently used results first.
+    """
+
+    def __init__(self, path, maxSize):
+        """Open (or create) the cache database at path."""
+        path = os.path.expanduser(os.path.expandvars(path))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.maxSize = maxSize
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        # Last use time of the results read since the last write, so
+        # cache hits don't write to the cache database
+        self.lastUsed = {}
+        self.conn.execute('''
+CREATE TABLE IF NOT EXISTS results(
+                  key TEXT PRIMARY KEY,
+                  generation INTEGER,
+                  value TEXT,
+                  size INTEGER,
+                  last_used REAL
+                  )''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS results_last_used_idx '
+                          'ON results(last_used)')
+        self.conn.commit()
+
+    @staticmethod
+    def key(namespace, sql, values):
+        """Return the key of a query.
+
+        namespace identifies the database the query is run on.
+        """
+        data = json.dumps([namespace, ' '.join(sql.split()), list(values)])
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key, generation):
+        """Return the cached result for key or None if it's not valid."""
+        with self.lock:
+            return self._get(key, generation)
+
+    def _get(self, key, generation):
+        c = self.conn.cursor()
+        result = c.execute('SELECT generation, value FROM results '
+                           'WHERE key = ?', (key,))
+        row = result.fetchone()
+        if not row:
+            return None
+        if row[0] != generation:
+            c.execute('DELETE FROM results WHERE key = ?', (key,))
+            self.conn.commit()
+            return None
+        self.lastUsed[key] = time.time()
+        return json.loads(row[1])
+
+    def set(self, key, generation, value):
+        try:
+            data = json.dumps(value)
+        except TypeError:
+            # Results containing blobs are not cached
+            return
+        if len(data) > self.maxSize:
+            return
+        with self.lock:
+            c = self.conn.cursor()
+            c.execute('INSERT OR REPLACE INTO results '
+                      '(key, generation, value, size, last_used) '
+                      'VALUES (?,?,?,?,?)',
+                      (key, generation, data, len(data), time.time()))
+            self.lastUsed.pop(key, None)
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        c = self.conn.cursor()
+        c.executemany('UPDATE results SET last_used = ? WHERE key = ?',
+                      [(t, key) for key, t in self.lastUsed.items()])
+        self.lastUsed.clear()
+        total = c.execute('SELECT coalesce(SUM(size), 0) '
+                          'FROM results').fetchone()[0]
+        if total <= self.maxSize:
+            return
+        result = c.execute('SELECT key, size FROM results '
+                           'ORDER BY last_used').fetchall()
+        evicted = []
+        for key, size in result:
+            if total <= self.maxSize:
+                break
+            evicted.append((key,))
+            total -= size
+        c.executemany('DELETE FROM results WHERE key = ?', evicted)
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM results')
+            self.conn.commit()
+            self.lastUsed.clear()
@@ -4,7 +4,7 @@ from bard.config import config
 from bard.utils import md5, calculateAudioTrackSHA256_audioread, \
     extractFrontCover, md5FromData, calculateFileSHA256, manualAudioCmp, \
     printDictsDiff, printPropertiesDiff, calculateSHA256_data, \
-    detect_silence_at_beginning_and_end
+    detect_silence_at_beginning_and_end, decodeFingerprint
 from bard.musicdatabase import MusicDatabase
 from bard.normalizetags import getTag
 from bard.ffprobemetadata import FFProbeMetadata
@@ -76,16 +76,21 @@ class Ratings:
 class Song:
     silence_threshold = -67
     min_silence_length = 10
+    losslessFormats = ['flac', 'wv', 'ape', 'mpc']
 
     def __init__(self, x, rootDir=None):
         """Create a Song oject."""
         self.tags = {}
         Song.ratings = None
-        if type(x) == sqlite3.Row:
+        if isinstance(x, (sqlite3.Row, dict)):
             self.id = x['id']
             self._root = x['root']
             self._path = x['path']
             self._mtime = x['mtime']
+            self._size = x['size']
+            self._inode = x['inode']
+            self._device = x['device']
+            self._mode = x['mode']
             self._coverWidth = x['coverWidth']
             self._coverHeight = x['coverHeight']
             self._coverMD5 = x['coverMD5']
@@ -127,6 +132,33 @@ class Song:
         self._silenceAtStart = silences[0]
         self._silenceAtEnd = silences[1]
 
+    def setMetadataFromDB(self, tags, properties=None, fileSha256sum=None):
+        self.metadata = type('info', (dict,), {})()
+        self.metadata.update(tags)
+        if properties:
+            (self._format, self.metadata.info, self._audioSha256sum,
+             silences) = properties
+            self._silenceAtStart = silences[0]
+            self._silenceAtEnd = silences[1]
+        if fileSha256sum is not None:
+            self._fileSha256sum = fileSha256sum
+
+    @staticmethod
+    def loadSongsMetadata(songs):
+        """Load the metadata of all songs from the database at once.
+
+        Tags, properties and checksums are read with a few set-based
+        queries instead of the queries done by each song when loading
+        its metadata on demand.
+        """
+        songIDs = [song.id for song in songs]
+        tags = MusicDatabase.getSongsTags(songIDs)
+        properties = MusicDatabase.getSongsProperties(songIDs)
+        checksums = MusicDatabase.getSongsFileSha256sums(songIDs)
+        for song in songs:
+            song.setMetadataFromDB(tags[song.id], properties.get(song.id),
+                                   checksums.get(song.id))
+
     def loadCoverImageData(self, path):
         self._coverWidth, self._coverHeight = 0, 0
         self._coverMD5 = ''
@@ -228,24 +260,37 @@ class Song:
             self._coverHeight = image.height
             self._coverMD5 = md5FromData(data)
 
-        self._mtime = os.path.getmtime(path)
+        self.setFileStat(os.stat(path))
         self._fileSha256sum = calculateFileSHA256(path)
 
         self.fingerprint = self.getAcoustidFingerprint()
+        self.decodedFingerprint = decodeFingerprint(self.fingerprint)
 
         self.isValid = True
 
+    def setFileStat(self, st):
+        """Set the file attributes of the song from an os.stat result."""
+        self._mtime = st.st_mtime
+        self._size = st.st_size
+        self._inode = st.st_ino
+        self._device = st.st_dev
+        self._mode = st.st_mode
+
     def root(self):
         return self._root
 
-    def path(self):
+    @staticmethod
+    def translatePath(path):
         if config['translatePaths']:
             for (src, tgt) in config['pathTranslationMap']:
                 src = src.rstrip('/')
                 tgt = tgt.rstrip('/')
-                if self._path.startswith(src):
-                    return tgt + self._path[len(src):]
-        return self._path
+                if path.startswith(src):
+                    return tgt + path[len(src):]
+        return path
+
+    def path(self):
+        return Song.translatePath(self._path)
 
     def filename(self):
         return os.path.basename(self._path)
@@ -253,6 +298,18 @@ class Song:
     def mtime(self):
         return self._mtime
 
+    def size(self):
+        return self._size
+
+    def inode(self):
+        return self._inode
+
+    def device(self):
+        return self._device
+
+    def mode(self):
+        return self._mode
+
     def silenceAtStart(self):
         try:
             return self._silenceAtStart
@@ -273,7 +330,7 @@ class Song:
 
     def isLossless(self):
         self.loadMetadataInfo()
-        return self._format in ['flac', 'wv', 'ape', 'mpc']
+        return self._format in Song.losslessFormats
 
     def audioCmp(self, other, forceSimilar=False, interactive=True,
                  useColors=None, printSongsInfoCallback=None,
@@ -3,6 +3,11 @@
 import subprocess
 import time
 import hashlib
+import gzip
+import shutil
+import os
+import sys
+import array
 import audioread
 from pydub import AudioSegment
 import mutagen
@@ -14,7 +19,7 @@ import mutagen.asf
 import mutagen.flac
 import mutagen.wavpack
 import chromaprint
-from collections import namedtuple
+from collections import namedtuple, deque
 from PIL import Image
 from bard.terminalcolors import TerminalColors
 from pydub.utils import db_to_float
@@ -98,6 +103,22 @@ def fingerprint_AudioSegment(audio_segment, maxlength=120000):
                                                      "failed")
 
 
+def decodeFingerprint(fingerprint):
+    """Return the sub-fingerprints of an encoded fingerprint as bytes.
+
+    Sub-fingerprints are stored as uint32 in little endian, which is
+    the format stored in the database and accepted by the
+    FingerprintManager. Returns None if the fingerprint is empty.
+    """
+    values = chromaprint.decode_fingerprint(fingerprint)[0]
+    if not values:
+        return None
+    data = array.array('I', (x & 0xffffffff for x in values))
+    if sys.byteorder == 'big':
+        data.byteswap()
+    return data.tobytes()
+
+
 def printSongsInfo(song1, song2,
                    useColors=(TerminalColors.First, TerminalColors.Second)):
     song1.calculateCompleteness()
@@ -387,6 +408,41 @@ def calculateFileSHA256(filename):
     return hash_sha256.hexdigest()
 
 
+def parallelMap(executor, function, iterable, maxPending):
+    """Like executor.map, but with at most maxPending queued calls.
+
+    Results are yielded in the same order as the iterable items, which is
+    consumed lazily.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= maxPending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def dropFromPageCache(path):
+    """Flush a file and ask the kernel to drop it from the page cache."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def compressFile(source, destination):
+    """Write a gzip compressed copy of source to destination."""
+    with open(source, 'rb') as f_in, gzip.open(destination, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, 4096 * 1024)
+    dropFromPageCache(source)
+    dropFromPageCache(destination)
+
+
 def calculateSHA256(filelike):
     hash_sha256 = hashlib.sha256()
     for chunk in iter(lambda: filelike.read(4096 * 1024), b""):
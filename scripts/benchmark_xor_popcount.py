@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""Check and benchmark the XOR-popcount kernels of bard_ext.
+
+Every kernel supported by the CPU is first checked against the scalar
+kernel with random fingerprints of several lengths, comparing all the
+sub-fingerprints and only every step-th one. Then each kernel is timed
+comparing two fingerprints and comparing one song with many others at
+every offset.
+"""
+
+import argparse
+import random
+import sys
+import time
+from bard import bard_ext
+
+
+def randomFingerprint(length):
+    return [random.getrandbits(32) - 2**31 for _ in range(length)]
+
+
+def checkKernels(kernels):
+    """Compare the results of each kernel with the scalar kernel."""
+    errors = 0
+    lengths = list(range(0, 80)) + [127, 128, 129, 950, 1100, 4099]
+    cases = [(randomFingerprint(n), randomFingerprint(n)) for n in lengths]
+    for step in (1, 2, 3, 4, 32):
+        bard_ext.setXorPopcountKernel('scalar')
+        expected = [bard_ext.xorPopcount(a, b, step) for a, b in cases]
+        for kernel in kernels:
+            bard_ext.setXorPopcountKernel(kernel)
+            for (a, b), bits in zip(cases, expected):
+                result = bard_ext.xorPopcount(a, b, step)
+                if result != bits:
+                    print('Error: %s kernel returned %d instead of %d for '
+                          '%d sub-fingerprints with step %d' %
+                          (kernel, result, bits, len(a), step))
+                    errors += 1
+    return errors
+
+
+def timeIt(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmarkKernels(kernels, songs, length, iterations):
+    a = randomFingerprint(length)
+    b = randomFingerprint(length)
+    fingerprints = [randomFingerprint(length) for _ in range(songs)]
+    print('%-16s %12s %12s %16s' % ('Kernel', 'ns/word', 'strided',
+                                    '1 vs %d songs' % songs))
+    for kernel in kernels:
+        bard_ext.setXorPopcountKernel(kernel)
+        words = length * iterations
+        t = timeIt(lambda: bard_ext.xorPopcount(a, b, 1, iterations))
+        strided = timeIt(lambda: bard_ext.xorPopcount(a, b, 32, iterations))
+
+        fpm = bard_ext.FingerprintManager()
+        fpm.setMaxOffset(100)
+        for songID, fingerprint in enumerate(fingerprints + [a]):
+            fpm.addSong(songID, fingerprint)
+        # A threshold of 0 disables the early abort, so every offset is
+        # compared completely
+        songTime = timeIt(lambda: fpm.compareSongWithPrevious(songs, 0.0))
+        print('%-16s %12.3f %12.3f %13.1f ms' %
+              (kernel, t * 1e9 / words, strided * 1e9 * 32 / words,
+               songTime * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--songs', type=int, default=3000,
+                        help='Songs to compare a song with (default: '
+                        '%(default)s)')
+    parser.add_argument('--length', type=int, default=950,
+                        help='Sub-fingerprints of each song (default: '
+                        '%(default)s)')
+    parser.add_argument('--iterations', type=int, default=100000,
+                        help='Comparisons of two fingerprints to time '
+                        '(default: %(default)s)')
+    parser.add_argument('--check-only', action='store_true',
+                        help="Only check the kernels' results")
+    options = parser.parse_args()
+
+    random.seed(45)
+    kernels = bard_ext.xorPopcountKernels()
+    default = bard_ext.xorPopcountKernel()
+    print('Kernels supported by this CPU: %s (default: %s)' %
+          (', '.join(kernels), default))
+    errors = checkKernels(kernels)
+    if errors:
+        print('%d kernel results differ from the scalar kernel' % errors)
+        return 1
+    print('All the kernels return the same results as the scalar kernel')
+    if not options.check_only:
+        benchmarkKernels(kernels, options.songs, options.length,
+                         options.iterations)
+    bard_ext.setXorPopcountKernel(default)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""Compare the coarse offset search of bard_ext with the full sweep.
+
+A synthetic corpus is generated with random fingerprints that change
+slowly like real ones, and noisy copies of them shifted by random
+offsets. All the songs are compared with each other at every offset and
+with the coarse search used by find-audio-duplicates --coarse-search, and
+the similarities found by both are compared.
+"""
+
+import argparse
+import random
+import sys
+import time
+from bard import bard_ext
+
+
+def toInt32(x):
+    return x - (1 << 32) if x >= 1 << 31 else x
+
+
+def randomFingerprint(length):
+    """Return a fingerprint that flips a few bits in each sub-fingerprint."""
+    x = random.getrandbits(32)
+    fingerprint = []
+    for _ in range(length):
+        for _ in range(random.choice((0, 1, 2, 3, 6))):
+            x ^= 1 << random.randrange(32)
+        fingerprint.append(toInt32(x))
+    return fingerprint
+
+
+def noisyCopy(fingerprint, noise, shift):
+    """Return a copy of fingerprint shifted by shift sub-fingerprints.
+
+    Each bit is flipped with a probability of about noise, with bursts of
+    more noise.
+    """
+    if shift >= 0:
+        fingerprint = fingerprint[shift:]
+    else:
+        fingerprint = [random.getrandbits(32) for _ in range(-shift)] + \
+            fingerprint
+    result = []
+    burst = 0
+    for x in fingerprint:
+        if random.random() < 0.05:
+            burst = random.randrange(0, 15)
+        p = min(0.5, noise * (2.5 if burst else 0.5))
+        burst = max(0, burst - 1)
+        for bit in range(32):
+            if random.random() < p:
+                x ^= 1 << bit
+        result.append(toInt32(x & 0xffffffff))
+    return result
+
+
+def generateCorpus(songs, maxOffset):
+    fingerprints = []
+    while len(fingerprints) < songs:
+        original = randomFingerprint(random.choice((300, 950, 950, 950)))
+        fingerprints.append(original)
+        while random.random() < 0.4:
+            noise = random.choice((0.02, 0.05, 0.1, 0.2, 0.3, 0.35, 0.4))
+            shift = random.randrange(-maxOffset + 5, maxOffset - 5)
+            fingerprints.append(noisyCopy(original, noise, shift))
+    return fingerprints[:songs]
+
+
+def findSimilarities(fingerprints, threshold, maxOffset, coarseSearch):
+    fpm = bard_ext.FingerprintManager()
+    fpm.setMaxOffset(maxOffset)
+    if coarseSearch:
+        fpm.setCoarseSearch(*coarseSearch)
+    similarities = {}
+    start = time.perf_counter()
+    for songID, fingerprint in enumerate(fingerprints):
+        for songID2, offset, similarity in fpm.addSongAndCompare(
+                songID, fingerprint, threshold):
+            similarities[(songID2, songID)] = (offset, similarity)
+    return similarities, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--songs', type=int, default=1000,
+                        help='Songs in the corpus (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=46,
+                        help='Random seed (default: %(default)s)')
+    parser.add_argument('--threshold', type=float, default=0.58,
+                        help='Minimum similarity (default: %(default)s)')
+    parser.add_argument('--max-offset', type=int, default=100,
+                        help='Maximum offset (default: %(default)s)')
+    parser.add_argument('--coarse-search', type=float, nargs=3,
+                        default=[32, 4, 0.03],
+                        metavar=('step', 'candidates', 'margin'),
+                        help='Parameters of setCoarseSearch (default: the '
+                        'ones used by find-audio-duplicates)')
+    options = parser.parse_args()
+
+    random.seed(options.seed)
+    fingerprints = generateCorpus(options.songs, options.max_offset)
+    step, candidates, margin = options.coarse_search
+    full, fullTime = findSimilarities(fingerprints, options.threshold,
+                                      options.max_offset, None)
+    coarse, coarseTime = findSimilarities(fingerprints, options.threshold,
+                                          options.max_offset,
+                                          (int(step), int(candidates),
+                                           margin))
+
+    missing = full.keys() - coarse.keys()
+    extra = coarse.keys() - full.keys()
+    common = full.keys() & coarse.keys()
+    differentOffset = [x for x in common if full[x][0] != coarse[x][0]]
+    lowerSimilarity = [full[x][1] - coarse[x][1] for x in common
+                       if coarse[x][1] < full[x][1] - 1e-9]
+    total = len(full) or 1
+    print('Corpus: %d songs, %d pairs' %
+          (len(fingerprints), len(fingerprints) * (len(fingerprints) - 1)
+           // 2))
+    print('Full sweep:    %d similarities in %.1fs' % (len(full), fullTime))
+    print('Coarse search: %d similarities in %.1fs (%.1fx faster)' %
+          (len(coarse), coarseTime, fullTime / coarseTime))
+    print('Missing:           %d (%.2f%%)' %
+          (len(missing), len(missing) * 100 / total))
+    print('Extra:             %d' % len(extra))
+    print('Different offset:  %d (%.2f%%)' %
+          (len(differentOffset), len(differentOffset) * 100 / total))
+    print('Lower similarity:  %d (%.2f%%), up to %.4f lower' %
+          (len(lowerSimilarity), len(lowerSimilarity) * 100 / total,
+           max(lowerSimilarity, default=0)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,7 +10,6 @@ module1 = Extension('bard_ext',
                     library_dirs=['/usr/lib'],
                     sources=['bard/bard_ext.cpp'],
                     extra_compile_args=['-std=gnu++17', '-fopenmp', '-Ofast',
-                                        '-march=native', '-mtune=native',
                                         '-funroll-loops'])
 
 setup(